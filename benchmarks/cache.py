@@ -0,0 +1,143 @@
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# xdnmb.cache不依赖xdnmb中的其他模块，可以直接导入
+import xdnmb.cache
+
+# 比较改用xdnmb.cache前后LRU缓存读取和写入的耗时
+# 两种实现的表中都预先填满了ROWS行，读取随机的已有的键，写入新的键
+# 命令行参数可以指定行数，例如python benchmarks/cache.py 16384
+ROWS = (16384, 1000000)
+VALUE_SIZE = 200
+GET_ROUNDS = 2000
+SET_ROUNDS = 2000
+# 旧的实现每次写入都会对整个表排序，行数很多时只测试几次
+OLD_SET_ROUNDS = {16384: 200, 1000000: 3}
+
+VALUE = os.urandom(VALUE_SIZE)
+
+
+def makeKey(i: int) -> str:
+    return f'http:https://api.nmb.best/api/thread?id={50000000 + i}&page=1'
+
+
+# 改用xdnmb.cache之前的实现：读取时立即写回访问时间，写入时先检查是否存在，然后删除访问时间排在ROWS之后的行
+def connectOld(path: str, rows: int) -> sqlite3.Cursor:
+    db = sqlite3.connect(path, isolation_level=None)
+    db.executescript(''.join(x.strip() for x in '''
+    PRAGMA journal_mode = wal;
+    CREATE TABLE IF NOT EXISTS "cache" (
+        "id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+        "timestamp" DATE NOT NULL,
+        "key" TEXT NOT NULL,
+        "value" BLOB,
+        CONSTRAINT "const_key" UNIQUE ("key")
+    );
+    CREATE UNIQUE INDEX IF NOT EXISTS "main"."idx_key"
+    ON "cache" (
+        "key"
+    );
+    CREATE INDEX IF NOT EXISTS "main"."idx_timestamp"
+    ON "cache" (
+        "timestamp"
+    );
+    '''.splitlines()))
+    now = int(time.time())
+    db.execute('BEGIN')
+    db.executemany(
+        'INSERT INTO `cache`(`timestamp`, `key`, `value`) VALUES (?, ?, ?)',
+        ((now, makeKey(i), VALUE) for i in range(rows)),
+    )
+    db.execute('COMMIT')
+    return db.cursor()
+
+
+def oldGet(cursor: sqlite3.Cursor, key: str) -> bytes | None:
+    row = cursor.execute(
+        'SELECT `value` FROM `cache` WHERE `key` = ?',
+        (key, ),
+    ).fetchone()
+    if row:
+        cursor.execute(
+            'UPDATE `cache` SET `timestamp` = ? WHERE `key` = ?',
+            (int(time.time()), key),
+        )
+        return row[0]
+    else:
+        return None
+
+
+def oldSet(cursor: sqlite3.Cursor, key: str, value: bytes | None, rowLimit: int):
+    if cursor.execute(
+            'SELECT EXISTS(SELECT 1 FROM `cache` WHERE `key` = ?)',
+        (key, ),
+    ).fetchone()[0]:
+        cursor.execute(
+            'UPDATE `cache` SET `timestamp` = ?, `value` = ? WHERE `key` = ?',
+            (int(time.time()), value, key),
+        )
+    else:
+        cursor.execute(
+            'INSERT INTO `cache`(`timestamp`, `key`, `value`) VALUES (?, ?, ?)',
+            (int(time.time()), key, value),
+        )
+    cursor.execute(
+        'DELETE FROM `cache` WHERE `id` NOT IN (SELECT `id` FROM `cache` ORDER BY `timestamp` DESC LIMIT ?)',
+        (rowLimit, ),
+    )
+
+
+def connectNew(path: str, rows: int):
+    xdnmb.cache.connect(path)
+    db = xdnmb.cache.connection()
+    now = time.time()
+    db.execute('BEGIN')
+    db.executemany(
+        'INSERT INTO `cache`(`timestamp`, `key`, `value`, `namespace`, `size`) VALUES (?, ?, ?, ?, ?)',
+        ((now, key, VALUE, 'http', len(key) + VALUE_SIZE) for key in map(makeKey, range(rows))),
+    )
+    db.execute('COMMIT')
+    # 上限为预先填入的大小，和启动时一样先统计一次各个命名空间的占用
+    xdnmb.cache.budgets['http'] = db.execute('SELECT SUM(`size`) FROM `cache`').fetchone()[0]
+    xdnmb.cache.evict(xdnmb.cache.HIGH_WATER_RATIO)
+
+
+def measure(func, keys: list[str]) -> float:
+    start = time.perf_counter()
+    for key in keys:
+        func(key)
+    return (time.perf_counter() - start) / len(keys)
+
+
+def formatTime(seconds: float) -> str:
+    return f'{seconds * 1e3:.1f}ms' if seconds >= 1e-3 else f'{seconds * 1e6:.0f}us'
+
+
+if __name__ == '__main__':
+    rng = random.Random(1)
+    print(f'{"rows":>10} {"old get":>10} {"old set":>10} {"new get":>10} {"new set":>10}')
+    for rows in (tuple(map(int, sys.argv[1:])) or ROWS):
+        getKeys = [makeKey(rng.randrange(rows)) for _ in range(GET_ROUNDS)]
+        with tempfile.TemporaryDirectory() as path:
+            cursor = connectOld(os.path.join(path, 'old.db'), rows)
+            oldGetTime = measure(lambda key: oldGet(cursor, key), getKeys)
+            oldSetTime = measure(
+                lambda key: oldSet(cursor, key, VALUE, rows),
+                [makeKey(rows + i) for i in range(OLD_SET_ROUNDS.get(rows, 20))],
+            )
+            cursor.connection.close()
+
+            connectNew(os.path.join(path, 'new.db'), rows)
+            newGetTime = measure(lambda key: xdnmb.cache.lruCacheGet('http', key), getKeys)
+            newSetTime = measure(
+                lambda key: xdnmb.cache.lruCacheSet('http', key, VALUE),
+                [makeKey(rows + i) for i in range(SET_ROUNDS)],
+            )
+            xdnmb.cache.close()
+        print(f'{rows:>10} {formatTime(oldGetTime):>10} {formatTime(oldSetTime):>10} {formatTime(newGetTime):>10} {formatTime(newSetTime):>10}')
@@ -0,0 +1,121 @@
+import io
+import os
+import sys
+import tempfile
+import time
+
+# xdnmb.util会导入xdnmb.globals，导入时会读取命令行参数和配置文件、打开缓存数据库，这里全部指向临时目录
+TEMP_PATH = tempfile.mkdtemp()
+os.environ['XDG_CONFIG_HOME'] = os.path.join(TEMP_PATH, 'config')
+os.environ['XDG_CACHE_HOME'] = os.path.join(TEMP_PATH, 'cache')
+os.environ['XDG_DATA_HOME'] = os.path.join(TEMP_PATH, 'data')
+sys.argv = [sys.argv[0], '--config', os.path.join(TEMP_PATH, 'config.ini')]
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 和main.py一样先导入xdnmb.globals，避免循环导入
+import xdnmb.globals
+import xdnmb.halfblock
+import xdnmb.util
+
+import numpy
+
+from PIL import Image
+
+try:
+    import chafa
+except ImportError:
+    chafa = None
+
+# 比较内置的渲染器（xdnmb.halfblock）和chafa生成缩略图预览的耗时和输出的大小
+# chafa命令行：和实际使用时一样通过xdnmb.util.renderChafaImage调用，包括启动进程的耗时，使用配置文件中默认的--work和--optimize
+# libchafa：安装了chafa.py（pip install chafa.py）时也在进程内直接调用libchafa比较，不包括启动进程的耗时
+# 测试用的图片是加上了随机噪声的渐变，和岛上的照片、截图一样不能被大块的纯色压缩
+WIDTH = 24
+HEIGHT = 6
+ROUNDS = 200
+CHAFA_ROUNDS = 20
+
+
+def makeImage(rng: numpy.random.Generator, width: int, height: int, transparent: bool = False) -> bytes:
+    y, x = numpy.mgrid[0:height, 0:width]
+    pixels = numpy.stack((
+        x * 255 // width,
+        y * 255 // height,
+        (x + y) * 127 // (width + height) + 64,
+    ), -1).astype(numpy.int16)
+    pixels += rng.integers(-30, 30, pixels.shape, dtype=numpy.int16)
+    image = Image.fromarray(numpy.clip(pixels, 0, 255).astype(numpy.uint8))
+    buffer = io.BytesIO()
+    if transparent:
+        # 圆形以外的部分透明
+        alpha = numpy.where((x - width / 2) ** 2 + (y - height / 2) ** 2 < (min(width, height) / 2.2) ** 2, 255, 0)
+        image = image.convert('RGBA')
+        image.putalpha(Image.fromarray(alpha.astype(numpy.uint8)))
+        image.save(buffer, 'PNG')
+    else:
+        image.save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+
+def renderLibchafa(data: bytes, width: int, height: int) -> str:
+    image = Image.open(io.BytesIO(data)).convert('RGBA')
+    config = chafa.CanvasConfig()
+    config.width = width
+    config.height = height
+    config.calc_canvas_geometry(image.width, image.height, .5)
+    config.canvas_mode = chafa.CanvasMode.CHAFA_CANVAS_MODE_TRUECOLOR
+    config.work_factor = 1.
+    config.optimizations = [chafa.Optimizations.CHAFA_OPTIMIZATION_ALL]
+    canvas = chafa.Canvas(config)
+    canvas.draw_all_pixels(
+        chafa.PixelType.CHAFA_PIXEL_RGBA8_UNASSOCIATED,
+        image.tobytes(),
+        image.width,
+        image.height,
+        image.width * 4,
+    )
+    return canvas.print(termInfo).decode('utf-8')
+
+
+def renderChafa(data: bytes, width: int, height: int) -> str:
+    return xdnmb.util.renderChafaImage(data, width, height)[0]
+
+
+def measure(func, data: bytes, rounds: int) -> tuple[float, int]:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        result = func(data, WIDTH, HEIGHT)
+    return (time.perf_counter() - start) / rounds, len(result.encode('utf-8'))
+
+
+if __name__ == '__main__':
+    if not xdnmb.halfblock.available():
+        sys.exit('需要安装Pillow和NumPy')
+    rng = numpy.random.default_rng(1)
+    images = {
+        'jpeg 250x250': makeImage(rng, 250, 250),
+        'jpeg 250x400': makeImage(rng, 250, 400),
+        'jpeg 400x250': makeImage(rng, 400, 250),
+        'png rgba 250x250': makeImage(rng, 250, 250, True),
+    }
+    renderers = [('builtin', xdnmb.halfblock.renderHalfBlock, ROUNDS)]
+    if xdnmb.util.detectChafa():
+        renderers.append(('chafa', renderChafa, CHAFA_ROUNDS))
+    else:
+        print('没有找到chafa命令，跳过', file=sys.stderr)
+    if chafa is not None:
+        # libchafa根据环境变量判断终端支持的转义序列，按照支持24位色的终端输出，和内置的渲染器保持一致
+        os.environ['TERM'] = 'xterm-256color'
+        os.environ['COLORTERM'] = 'truecolor'
+        termInfo = chafa.TermDb().detect()
+        renderers.append(('libchafa', renderLibchafa, ROUNDS))
+    else:
+        print('没有安装chafa.py，跳过libchafa', file=sys.stderr)
+
+    print(f'{WIDTH}x{HEIGHT}，耗时/输出字节数')
+    print(f'{"image":18}' + ''.join(f'{name:>12} {"bytes":>6}' for name, _, _ in renderers))
+    for name, data in images.items():
+        print(f'{name:18}' + ''.join(
+            f'{elapsed * 1e6:10.0f}us {size:6}'
+            for elapsed, size in (measure(func, data, rounds) for _, func, rounds in renderers)
+        ))
@@ -0,0 +1,64 @@
+import datetime
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+# xdnmb.util会导入xdnmb.globals，导入时会读取命令行参数和配置文件、打开缓存数据库，这里全部指向临时目录
+TEMP_PATH = tempfile.mkdtemp()
+os.environ['XDG_CONFIG_HOME'] = os.path.join(TEMP_PATH, 'config')
+os.environ['XDG_CACHE_HOME'] = os.path.join(TEMP_PATH, 'cache')
+os.environ['XDG_DATA_HOME'] = os.path.join(TEMP_PATH, 'data')
+sys.argv = [sys.argv[0], '--config', os.path.join(TEMP_PATH, 'config.ini')]
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 和main.py一样先导入xdnmb.globals，避免循环导入
+import xdnmb.globals
+import xdnmb.util
+
+# 比较parseThreadTime改用fromisoformat前后解析一次时间的耗时
+# strptime：原来的实现；fast path：不经过lru_cache的新实现；cache hit：同一个时间第二次解析
+# 每次解析不同的时间，避免fast path被lru_cache命中
+ROUNDS = 100000
+WEEKDAYS = '一二三四五六日'
+
+
+def parseThreadTimeWithStrptime(text: str) -> datetime.datetime:
+    # 改用fromisoformat之前的实现
+    return datetime.datetime.strptime(
+        re.sub(r'\([日一二三四五六]\)', ' ', text),
+        '%Y-%m-%d %H:%M:%S',
+    )
+
+
+def randomTimes(seed: int, count: int) -> list[str]:
+    rng = random.Random(seed)
+    start = datetime.datetime(2022, 1, 1)
+    result = []
+    for _ in range(count):
+        t = start + datetime.timedelta(seconds=rng.randrange(86400 * 365 * 3))
+        result.append(t.strftime(f'%Y-%m-%d({WEEKDAYS[t.weekday()]})%H:%M:%S'))
+    return result
+
+
+def measure(func, texts: list[str]) -> float:
+    start = time.perf_counter()
+    for text in texts:
+        func(text)
+    return (time.perf_counter() - start) / len(texts)
+
+
+if __name__ == '__main__':
+    texts = randomTimes(1, ROUNDS)
+    fastPath = xdnmb.util.parseThreadTime.__wrapped__
+    for text in texts[:1000]:
+        assert fastPath(text) == parseThreadTimeWithStrptime(text)
+    old = measure(parseThreadTimeWithStrptime, texts)
+    new = measure(fastPath, texts)
+    xdnmb.util.parseThreadTime(texts[0])
+    hit = measure(xdnmb.util.parseThreadTime, [texts[0]] * ROUNDS)
+    print(f'strptime:  {old * 1e6:6.2f} us')
+    print(f'fast path: {new * 1e6:6.2f} us')
+    print(f'cache hit: {hit * 1e6:6.2f} us')
@@ -0,0 +1,59 @@
+import os
+import re
+import sys
+import tempfile
+import time
+import warnings
+
+# xdnmb.util会导入xdnmb.globals，导入时会读取命令行参数和配置文件、打开缓存数据库，这里全部指向临时目录
+TEMP_PATH = tempfile.mkdtemp()
+os.environ['XDG_CONFIG_HOME'] = os.path.join(TEMP_PATH, 'config')
+os.environ['XDG_CACHE_HOME'] = os.path.join(TEMP_PATH, 'cache')
+os.environ['XDG_DATA_HOME'] = os.path.join(TEMP_PATH, 'data')
+sys.argv = [sys.argv[0], '--config', os.path.join(TEMP_PATH, 'config.ini')]
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 和main.py一样先导入xdnmb.globals，避免循环导入
+import xdnmb.globals
+import xdnmb.util
+
+from bs4 import BeautifulSoup
+from bs4 import MarkupResemblesLocatorWarning
+
+warnings.filterwarnings('ignore', category=MarkupResemblesLocatorWarning)
+
+# 比较stripHTML改用HTMLTextExtractor前后处理一页回应的耗时
+# 典型的一页：10条带有引用、换行和实体的回应，9条纯文本回应
+PAGE = (
+    *(
+        f'<font color="#789922">&gt;&gt;No.{50000000 + i}</font><br />\r\n这是一条回应的内容，带有一些&amp;符号和表情(ﾟ∀ﾟ)<br />\r\n第二行'
+        for i in range(10)
+    ),
+    *(f'纯文本回应，没有任何标签（´ﾟДﾟ`）第{i}条' for i in range(9)),
+)
+ROUNDS = 500
+
+
+def stripHTMLWithBeautifulSoup(text: str) -> str:
+    # 改用HTMLTextExtractor之前的实现
+    text = re.sub(r'<br ?/?>\r?\n?', '\n', text)
+    text = re.sub(r'^\s+|\s+$', '\n', text, flags=re.M)
+    return BeautifulSoup(text, features='html.parser').text
+
+
+def measure(func) -> float:
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        for text in PAGE:
+            func(text)
+    return (time.perf_counter() - start) / ROUNDS / len(PAGE)
+
+
+if __name__ == '__main__':
+    for text in PAGE:
+        assert xdnmb.util.stripHTML(text) == stripHTMLWithBeautifulSoup(text)
+    old = measure(stripHTMLWithBeautifulSoup)
+    new = measure(xdnmb.util.stripHTML)
+    print(f'bs4:               {old * 1e6:6.1f} us/post')
+    print(f'HTMLTextExtractor: {new * 1e6:6.1f} us/post')
+    print(f'{old / new:.1f}x')
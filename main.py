@@ -1,11 +1,32 @@
+import sys
+import xdnmb.profiler
 import xdnmb.globals
 import xdnmb.action
+import xdnmb.cache
 
 from prompt_toolkit import Application
 from prompt_toolkit.output.color_depth import ColorDepth
 from prompt_toolkit.styles import Style
 
+# 只有使用对应的功能时才导入存档和搜索的模块
+if xdnmb.globals.args.archive is not None:
+    import xdnmb.archive
+    import xdnmb.search
+    # 和在界面中存档时一样，存档的串也会写入搜索索引
+    xdnmb.search.connect()
+    sys.exit(xdnmb.archive.archiveFromCommandLine())
+if (
+    xdnmb.globals.args.cacheStats
+    or xdnmb.globals.args.cachePrune
+    or xdnmb.globals.args.cacheClear is not None
+):
+    sys.exit(xdnmb.cache.cacheFromCommandLine(xdnmb.globals.args))
+if xdnmb.globals.args.search is not None:
+    import xdnmb.search
+    sys.exit(xdnmb.search.searchFromCommandLine())
+
 xdnmb.action.loadForumGroup()
+xdnmb.profiler.mark('加载版面列表')
 
 Application(
     layout=xdnmb.globals.layout,
@@ -32,9 +53,13 @@ Application(
         'form-label': 'bg:#eeaa88',
         'form-textarea': 'bg:#ffffff',
     }),
+    after_render=xdnmb.profiler.afterRender if xdnmb.globals.args.profileStartup else None,
     color_depth=(
         ColorDepth.DEPTH_1_BIT
         if xdnmb.globals.config['Config'].getboolean('Monochrome') else
         ColorDepth.DEPTH_24_BIT
     ),
-).run()
+).run(pre_run=xdnmb.action.startBackgroundTasks)
+
+if xdnmb.globals.args.profileStartup:
+    xdnmb.profiler.report()
@@ -0,0 +1,120 @@
+import os
+import random
+import re
+import sys
+import tempfile
+import unittest
+import warnings
+
+# xdnmb.util会导入xdnmb.globals，导入时会读取命令行参数和配置文件、打开缓存数据库，这里全部指向临时目录
+TEMP_PATH = tempfile.mkdtemp()
+os.environ['XDG_CONFIG_HOME'] = os.path.join(TEMP_PATH, 'config')
+os.environ['XDG_CACHE_HOME'] = os.path.join(TEMP_PATH, 'cache')
+os.environ['XDG_DATA_HOME'] = os.path.join(TEMP_PATH, 'data')
+sys.argv = [sys.argv[0], '--config', os.path.join(TEMP_PATH, 'config.ini')]
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 和main.py一样先导入xdnmb.globals，避免循环导入
+import xdnmb.globals
+import xdnmb.util
+
+from bs4 import BeautifulSoup
+from bs4 import MarkupResemblesLocatorWarning
+
+warnings.filterwarnings('ignore', category=MarkupResemblesLocatorWarning)
+
+# 网站上实际会出现的内容，以及解析器需要和bs4保持一致的各种边界情况
+SITE_SAMPLES = (
+    '<font color="#789922">&gt;&gt;No.50000001</font><br />\r\n正文内容',
+    '<font color="#789922">&gt;&gt;No.50000001</font><br />\r\n<font color="#789922">&gt;&gt;No.50000002</font><br />\r\n两条引用',
+    '第一行<br />\r\n第二行<br />\r\n<br />\r\n第四行',
+    '<b>粗体</b><i>斜体</i><span class="h">[h]剧透[/h]</span>',
+    '<p>版规</p>\n<p>请勿发布违法内容</p>',
+    '<a href="https://www.nmbxd.com/t/50000001?a=1&b=2">链接</a>',
+    'ｷﾀ━━━(ﾟ∀ﾟ)━━━!!',
+    '（´ﾟДﾟ`）&nbsp;&nbsp;颜文字',
+    '1 < 2 and 3 > 2',
+    '&lt;br /&gt;',
+    'plain text only',
+    '  leading\n trailing  \n',
+    '\r\n\r\n',
+    'line\r\nline',
+    'a &amp; b &lt;c&gt; &quot;d&quot; &#039;e&#039; &nbsp;f',
+    '&unknown; &unknown &amp &lt &copy x',
+    '&AElig &AElig; &notit; &notin;',
+    '&#128512; &#x1F600; &#X41; &#0; &#xD800; &#1114112;',
+    ''.join(f'&#{n};' for n in range(0x7E, 0xA1)),
+    '&#65x &#x41g &#12345',
+    '&#9;&#10;&#13;',
+    'a &#x80; b &#x81;',
+    'a<b',
+    '<',
+    '&',
+    '&#',
+    '&#x',
+    '< b>x</ b>',
+    '<img src=x>',
+    '<br><br/><br />\n\n',
+    '</p>stray end',
+    'x<!-- comment -->y',
+    '<!DOCTYPE html>z',
+    '<?pi x?>w',
+    '<![CDATA[raw <b>]]>q',
+    '<script>alert(1)</script>s',
+    '<style>.a{}</style>t',
+    '<template>tp</template>after',
+    '<ruby>漢<rp>(</rp><rt>kan</rt><rp>)</rp></ruby>',
+    '<pre>  a\n\n  b  </pre>',
+)
+
+# 随机组合这些片段，覆盖标签嵌套错误、未闭合的实体、只有空白的文本等情况
+RANDOM_ATOMS = (
+    '<br />\n', '<br>', '</br>', '<b>', '</b>', '<b/>', '<font color="#789922">', '</font>',
+    '&gt;', '&lt;', '&amp;', '&#039;', '&nbsp;', '&foo', '&#65;', '&#x9f;', '&#150;', '&#0;', '&#xd800;', '&#x',
+    '<', '>', '&', ';', '#', '9', 'a', 'x', '中文', '(ﾟ∀ﾟ)',
+    ' ', '\t', '\n', '\r\n', '　',
+    '<script>', '</script>', '<pre>', '</pre>', '<textarea>', '<rt>', '</rt>', '<rt/>',
+    '<!DOCTYPE x>', '<?x?>', '<!--', '-->', '<![CDATA[', ']]>',
+)
+RANDOM_SPACES = ' \t\n\r\x0c　x'
+RANDOM_SEED = 1
+RANDOM_CASES = 20000
+
+
+def stripHTMLWithBeautifulSoup(text: str) -> str:
+    # 改用HTMLTextExtractor之前的实现
+    text = re.sub(r'<br ?/?>\r?\n?', '\n', text)
+    text = re.sub(r'^\s+|\s+$', '\n', text, flags=re.M)
+    return BeautifulSoup(text, features='html.parser').text
+
+
+def randomSamples(seed: int, count: int):
+    rng = random.Random(seed)
+    for _ in range(count):
+        yield ''.join(rng.choice(RANDOM_SPACES) for _ in range(rng.randint(0, 6)))
+        yield ''.join(rng.choice(RANDOM_ATOMS) for _ in range(rng.randint(1, 30)))
+
+
+class StripHTMLTest(unittest.TestCase):
+    def assertSameAsBeautifulSoup(self, samples):
+        mismatches = [
+            (text, expected, actual)
+            for text in samples
+            if (expected := stripHTMLWithBeautifulSoup(text)) != (actual := xdnmb.util.stripHTML(text))
+        ]
+        self.assertEqual(mismatches[:10], [], f'{len(mismatches)} 条结果和bs4不同')
+
+    def test_siteSamples(self):
+        self.assertSameAsBeautifulSoup(SITE_SAMPLES)
+
+    def test_randomSamples(self):
+        self.assertSameAsBeautifulSoup(randomSamples(RANDOM_SEED, RANDOM_CASES))
+
+    def test_tag(self):
+        # 发串失败时从返回的网页中找到的错误信息节点
+        soup = BeautifulSoup('<div class="error"> 错误\r\n  信息 </div>', 'html.parser').select_one('.error')
+        self.assertEqual(xdnmb.util.stripHTML(soup), re.sub(r'^\s+|\s+$', '\n', soup.text.replace('\r', ''), flags=re.M))
+
+
+if __name__ == '__main__':
+    unittest.main()
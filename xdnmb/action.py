@@ -1,16 +1,117 @@
 from __future__ import annotations
+import asyncio
+import dataclasses
+import functools
+import math
+import typing
 import xdnmb.api
+import xdnmb.cache
 import xdnmb.model
 import xdnmb.globals
 import xdnmb.util
+import xdnmb.virtuallist
+
+from prompt_toolkit.application.current import get_app
+from prompt_toolkit.formatted_text import ANSI
 
 def loadForumGroup():
+    # 启动时只要有缓存就直接使用，不管是否过期，之后再由refreshForumGroup在后台更新
+    if not xdnmb.globals.config['Config'].get('CDNPath'):
+        xdnmb.api.CDN_PATH = xdnmb.api.getCDNPath(math.inf)
+    applyForumGroup(
+        xdnmb.api.getTimelineList(math.inf),
+        xdnmb.api.getForumList(math.inf),
+    )
+
+def refreshForumGroup():
+    async def task():
+        loop = asyncio.get_running_loop()
+        try:
+            timelines, forumGroups = await asyncio.gather(
+                loop.run_in_executor(None, xdnmb.api.getTimelineList, 0),
+                loop.run_in_executor(None, xdnmb.api.getForumList, 0),
+            )
+        except Exception:
+            # 更新失败时继续使用缓存中的版面列表
+            return
+        if not xdnmb.globals.config['Config'].get('CDNPath'):
+            try:
+                xdnmb.api.CDN_PATH = await loop.run_in_executor(None, xdnmb.api.getCDNPath)
+            except Exception:
+                pass
+        if (
+            timelines == xdnmb.globals.forumGroups[0].forums
+            and forumGroups == tuple(xdnmb.globals.forumGroups[2:])
+        ):
+            return
+        # 替换之前光标所在的版面按钮会消失，需要移到新的列表中对应的版面上
+        focused = next(
+            (
+                forum
+                for forumGroup in xdnmb.globals.forumGroups
+                for forum in forumGroup.forums
+                if xdnmb.globals.layout.current_window is forum.__pt_container__()
+            ),
+            None,
+        )
+        applyForumGroup(timelines, forumGroups)
+        if focused is not None:
+            forum = next(
+                (
+                    forum
+                    for forumGroup in xdnmb.globals.forumGroups
+                    for forum in forumGroup.forums
+                    if type(forum) is type(focused) and getattr(forum, 'fid', None) == getattr(focused, 'fid', None)
+                ),
+                None,
+            )
+            if forum is not None:
+                xdnmb.globals.layout.focus(forum.__pt_container__())
+        get_app().invalidate()
+
+    get_app().create_background_task(task())
+
+def loadNotice():
+    if xdnmb.globals.config['Config'].getboolean('IgnoreNotice'):
+        return
+
+    async def task():
+        try:
+            notice = (await asyncio.get_running_loop().run_in_executor(
+                None,
+                xdnmb.api.session.get,
+                'https://nmb.ovear.info/nmb-notice.json',
+            )).json()
+        except Exception:
+            return
+        if notice['enable']:
+            xdnmb.globals.homepageLabel.text = ANSI(
+                xdnmb.globals.homepageLabelText
+                + f'\n== 公告 ==\n{str(notice["date"])[0:4]}-{str(notice["date"])[4:6]}-{str(notice["date"])[6:8]}\n\n{xdnmb.util.stripHTML(notice["content"])}'
+            )
+            get_app().invalidate()
+
+    get_app().create_background_task(task())
+
+def startBackgroundTasks():
+    # 搜索索引和订阅的串的新回应只在界面中使用，命令行的功能不需要导入这两个模块
+    import xdnmb.feedwatch
+    import xdnmb.search
+    xdnmb.search.connect()
+    xdnmb.feedwatch.load()
+    refreshForumGroup()
+    loadNotice()
+    xdnmb.cache.startMaintenance()
+    xdnmb.feedwatch.start()
+    startAutoRefresh()
+
+def applyForumGroup(timelines: tuple[xdnmb.model.Timeline, ...], forumGroups: tuple[xdnmb.model.ForumGroup, ...]):
     xdnmb.globals.forumGroups = [
         xdnmb.model.ForumGroup(
             gid=0,
             sort=0,
             name='时间线',
-            forums=xdnmb.api.getTimelineList(),
+            forums=timelines,
         ),
         xdnmb.model.ForumGroup(
             gid=0,
@@ -21,16 +122,37 @@ def loadForumGroup():
             ),
         ),
     ]
-    forumGroups = xdnmb.api.getForumList()
     xdnmb.globals.forumGroups.extend(forumGroups)
     xdnmb.globals.forums = sum((list(forumGroup.forums) for forumGroup in forumGroups), [])
+    xdnmb.globals.forumIndex = {forum.fid: forum for forum in xdnmb.globals.forums}
+    xdnmb.globals.forumNameIndex = {forum.name: forum for forum in xdnmb.globals.forums}
+    xdnmb.globals.bumpUiVersion()
 
-@xdnmb.util.floatAlertExceptionCatch
 def loadForum(forum: xdnmb.model.Forum|xdnmb.model.Timeline|xdnmb.model.Feed, page: int = 1):
-    if isinstance(forum, xdnmb.model.Feed):
-        forumThreads = xdnmb.api.getFeed(page)
-    else:
-        forumThreads = xdnmb.api.getForum(forum, page)
+    forumThreads = xdnmb.api.pageCacheGet(xdnmb.api.pageCacheKey(forum, page))
+    if forumThreads is not None:
+        xdnmb.util.cancelLoading()
+        applyForum(forum, page, forumThreads)
+        return
+    xdnmb.util.runInBackground(
+        functools.partial(fetchForum, forum, page),
+        functools.partial(applyForum, forum, page),
+    )
+
+def fetchForum(forum: xdnmb.model.Forum|xdnmb.model.Timeline|xdnmb.model.Feed, page: int = 1) -> tuple[xdnmb.model.Thread, ...]:
+    import xdnmb.feedwatch
+    key = xdnmb.api.pageCacheKey(forum, page)
+    forumThreads = xdnmb.api.pageCacheGet(key)
+    if forumThreads is None:
+        if isinstance(forum, xdnmb.model.Feed):
+            forumThreads = xdnmb.api.getFeed(page)
+            xdnmb.feedwatch.update(forumThreads)
+        else:
+            forumThreads = xdnmb.api.getForum(forum, page)
+        xdnmb.api.pageCacheSet(key, forumThreads)
+    return forumThreads
+
+def applyForum(forum: xdnmb.model.Forum|xdnmb.model.Timeline|xdnmb.model.Feed, page: int, forumThreads: tuple[xdnmb.model.Thread, ...]):
     if not forumThreads:
         if isinstance(forum, xdnmb.model.Feed):
             xdnmb.util.floatAlert('我真的……一条都没有了', '订阅列表是空的' if page == 1 else '你已经翻到了订阅列表的最后一页')
@@ -38,16 +160,289 @@ def loadForum(forum: xdnmb.model.Forum|xdnmb.model.Timeline|xdnmb.model.Feed, pa
             xdnmb.util.floatAlert('我真的……一条都没有了', '你已经翻到了这个版面的最后一页')
         return
     xdnmb.globals.forumThreads = forumThreads
+    xdnmb.globals.forumReferenceGraph = xdnmb.model.ReferenceGraph(forumPosts(forumThreads))
     xdnmb.globals.forum = forum
     xdnmb.globals.forumPage = page
+    xdnmb.globals.forumResidentPages = [(page, len(forumThreads))]
+    xdnmb.globals.forumLastPageReached = False
     xdnmb.globals.thread = None
+    xdnmb.globals.threadReferenceGraph = xdnmb.model.ReferenceGraph()
     xdnmb.globals.threadPage = None
+    xdnmb.globals.bumpUiVersion()
     xdnmb.globals.forumContentControl.vertical_scroll = 0
     xdnmb.util.focusToButton(None, xdnmb.model.ButtonType.Forum)
+    prefetch()
+
+def loadThread(thread: xdnmb.model.Thread|int, page: int = 1, focusTid: int|None = None):
+    # thread可以只是串号，focusTid为显示之后要把光标移到的回应
+    cached = xdnmb.api.pageCacheGet(xdnmb.api.pageCacheKey(thread, page))
+    if cached is not None:
+        xdnmb.util.cancelLoading()
+        applyThread(page, cached, focusTid)
+        return
+    xdnmb.util.runInBackground(
+        functools.partial(fetchThread, thread, page),
+        functools.partial(applyThread, page, focusTid=focusTid),
+    )
+
+def fetchThread(thread: xdnmb.model.Thread|int, page: int = 1) -> xdnmb.model.Thread:
+    key = xdnmb.api.pageCacheKey(thread, page)
+    cached = xdnmb.api.pageCacheGet(key)
+    if cached is None:
+        cached = xdnmb.api.getThread(thread, page)
+        xdnmb.api.pageCacheSet(key, cached)
+    return cached
 
-@xdnmb.util.floatAlertExceptionCatch
-def loadThread(thread: xdnmb.model.Thread, page: int = 1):
-    xdnmb.globals.thread = xdnmb.api.getThread(thread, page)
+def applyThread(page: int, thread: xdnmb.model.Thread, focusTid: int|None = None):
+    import xdnmb.feedwatch
+    xdnmb.globals.thread = thread
+    xdnmb.globals.threadReferenceGraph = xdnmb.model.ReferenceGraph((thread, *thread.replies))
     xdnmb.globals.threadPage = page
+    xdnmb.globals.threadResidentPages = [(page, len(thread.replies))]
+    xdnmb.feedwatch.markSeen(thread)
+    xdnmb.globals.bumpUiVersion()
     xdnmb.globals.forumContentControl.vertical_scroll = 0
     xdnmb.util.focusToButton(None, xdnmb.model.ButtonType.Forum)
+    post = xdnmb.globals.threadReferenceGraph.posts.get(focusTid)
+    if post is not None:
+        focusPost(post)
+    prefetch()
+
+def loadMore():
+    # 连续滚动模式下，滚动到接近底部时在后台加载下一页并追加到当前的页面
+    if (
+        not xdnmb.globals.config['Config'].getboolean('ContinuousScroll')
+        or xdnmb.globals.loadingTask
+        or xdnmb.globals.showReplyForm
+        # 加载失败时会弹出提示，关闭提示之前不再重试
+        or len(xdnmb.globals.container.floats) > 1
+    ):
+        return
+    thread = xdnmb.globals.thread
+    forum = xdnmb.globals.forum
+    if thread:
+        page = xdnmb.globals.threadPage + 1
+        if page > thread.maxPage:
+            return
+        xdnmb.util.runInBackground(
+            functools.partial(fetchThread, thread, page),
+            functools.partial(appendThread, thread, page),
+        )
+    elif forum:
+        page = xdnmb.globals.forumPage + 1
+        if (
+            xdnmb.globals.forumLastPageReached
+            or (isinstance(forum, xdnmb.model.Timeline) and page > forum.maxPage)
+        ):
+            return
+        xdnmb.util.runInBackground(
+            functools.partial(fetchForum, forum, page),
+            functools.partial(appendForum, forum, page),
+        )
+
+def appendForum(forum: xdnmb.model.Forum|xdnmb.model.Timeline|xdnmb.model.Feed, page: int, forumThreads: tuple[xdnmb.model.Thread, ...]):
+    if xdnmb.globals.thread or xdnmb.globals.forum is not forum:
+        return
+    if not forumThreads:
+        xdnmb.globals.forumLastPageReached = True
+        return
+    # 翻页期间被顶起的串会在前后两页重复出现
+    present = {t.tid for t in xdnmb.globals.forumThreads}
+    appended = tuple(t for t in forumThreads if t.tid not in present)
+    xdnmb.globals.forumThreads += appended
+    xdnmb.globals.forumReferenceGraph.add(forumPosts(appended))
+    xdnmb.globals.forumPage = page
+    xdnmb.globals.forumResidentPages.append((page, len(appended)))
+    dropped = 0
+    while len(xdnmb.globals.forumResidentPages) > max(xdnmb.globals.config['Config'].getint('ContinuousScrollMaxPages'), 2):
+        dropped += xdnmb.globals.forumResidentPages.pop(0)[1]
+    if dropped:
+        xdnmb.globals.forumContentControl.scrollPastRemoved(xdnmb.globals.forumThreads[:dropped])
+        xdnmb.globals.forumReferenceGraph.remove(forumPosts(xdnmb.globals.forumThreads[:dropped]))
+        xdnmb.globals.forumThreads = xdnmb.globals.forumThreads[dropped:]
+    xdnmb.globals.bumpUiVersion()
+    focusAppended(appended)
+    prefetch()
+
+def appendThread(thread: xdnmb.model.Thread, page: int, fetched: xdnmb.model.Thread):
+    import xdnmb.feedwatch
+    if xdnmb.globals.thread is not thread:
+        return
+    present = {r.tid for r in thread.replies}
+    appended = tuple(r for r in fetched.replies if r.tid not in present)
+    replies = thread.replies + appended
+    xdnmb.globals.threadReferenceGraph.add(appended)
+    xdnmb.globals.threadPage = page
+    # 刷新时重新获取的最后一页，新的回应算在原来的那一页中
+    if xdnmb.globals.threadResidentPages[-1][0] == page:
+        xdnmb.globals.threadResidentPages[-1] = (page, xdnmb.globals.threadResidentPages[-1][1] + len(appended))
+    else:
+        xdnmb.globals.threadResidentPages.append((page, len(appended)))
+    dropped = 0
+    while len(xdnmb.globals.threadResidentPages) > max(xdnmb.globals.config['Config'].getint('ContinuousScrollMaxPages'), 2):
+        dropped += xdnmb.globals.threadResidentPages.pop(0)[1]
+    if dropped:
+        xdnmb.globals.forumContentControl.scrollPastRemoved(tuple(
+            r for r in replies[:dropped]
+            if not (xdnmb.globals.config['Config'].getboolean('HideTips') and r.isTips)
+        ))
+        xdnmb.globals.threadReferenceGraph.remove(replies[:dropped])
+        replies = replies[dropped:]
+    xdnmb.globals.thread = dataclasses.replace(fetched, replies=replies)
+    xdnmb.globals.thread.inheritContainers(thread)
+    xdnmb.feedwatch.markSeen(fetched)
+    xdnmb.globals.bumpUiVersion()
+    focusAppended(appended)
+    prefetch()
+
+def refreshThread(auto: bool = False):
+    # 只重新获取串的最后一页，把新的回应追加到页面的末尾，滚动位置不变，已有的回应的界面也不会重新创建
+    # 回应数量增加到下一页时继续获取之后的页；显示的不是最后一页时只更新回应数量（标题栏中的总页数）
+    # auto为True时是定时的自动刷新，不显示加载动画，也不会取消其他的加载
+    thread = xdnmb.globals.thread
+    if not thread or xdnmb.globals.loadingTask:
+        return
+    fetch = functools.partial(fetchThreadTail, thread, thread.maxPage, xdnmb.globals.threadPage >= thread.maxPage)
+    apply = functools.partial(applyThreadTail, thread)
+    if not auto:
+        xdnmb.util.runInBackground(fetch, apply)
+        return
+
+    async def task():
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(None, fetch)
+        except Exception:
+            return
+        apply(results)
+        get_app().invalidate()
+
+    get_app().create_background_task(task())
+
+def fetchThreadTail(thread: xdnmb.model.Thread, page: int, follow: bool) -> list[tuple[int, xdnmb.model.Thread]]:
+    results: list[tuple[int, xdnmb.model.Thread]] = []
+    while True:
+        # 总是发送条件请求，没有新的回应时服务器可以只返回304
+        fetched = xdnmb.api.getThread(thread, page, 0)
+        xdnmb.api.pageCacheSet(xdnmb.api.pageCacheKey(thread, page), fetched)
+        results.append((page, fetched))
+        if not follow or page >= fetched.maxPage:
+            return results
+        page += 1
+
+def applyThreadTail(thread: xdnmb.model.Thread, results: list[tuple[int, xdnmb.model.Thread]]):
+    import xdnmb.feedwatch
+    if xdnmb.globals.thread is not thread:
+        return
+    if xdnmb.globals.threadPage < thread.maxPage:
+        fetched = results[-1][1]
+        if fetched.replyCount != thread.replyCount:
+            xdnmb.globals.thread = dataclasses.replace(fetched, replies=thread.replies)
+            xdnmb.globals.thread.inheritContainers(thread)
+            xdnmb.feedwatch.markSeen(fetched)
+            xdnmb.globals.bumpUiVersion()
+        return
+    for page, fetched in results:
+        current = xdnmb.globals.thread
+        present = {r.tid for r in current.replies}
+        if fetched.replyCount == current.replyCount and all(r.tid in present for r in fetched.replies):
+            continue
+        appendThread(current, page, fetched)
+
+def startAutoRefresh():
+    # 定时刷新正在显示的串，只在显示最后一页、没有在加载和打开弹窗时刷新
+    interval = xdnmb.globals.config['Config'].getfloat('AutoRefreshInterval')
+    if interval <= 0:
+        return
+
+    async def task():
+        while True:
+            await asyncio.sleep(interval)
+            thread = xdnmb.globals.thread
+            if (
+                thread
+                and xdnmb.globals.threadPage >= thread.maxPage
+                and not xdnmb.globals.showReplyForm
+                and len(xdnmb.globals.container.floats) <= 1
+            ):
+                refreshThread(True)
+
+    get_app().create_background_task(task())
+
+def forumPosts(forumThreads: typing.Iterable[xdnmb.model.Thread]) -> typing.Iterator[xdnmb.model.Reply]:
+    # 版面中的串连同附带的几条回应
+    for t in forumThreads:
+        yield t
+        yield from t.replies or ()
+
+def focusPost(post: xdnmb.model.Reply):
+    # 把光标移到页面中的串/回应上，VirtualList会滚动到它所在的位置
+    c = post.headContainer if isinstance(post, xdnmb.model.Thread) else post.__pt_container__()
+    xdnmb.globals.forumContentControl.focus(xdnmb.virtuallist.focusableWindows(c)[0], c)
+
+def focusAppended(appended: tuple[xdnmb.model.Reply, ...]):
+    # 光标停在底部的翻页按钮上时，ScrollablePane会一直滚动到底部，所以需要把光标移到新加载的第一个串/回应上
+    if appended and xdnmb.globals.layout.current_window is xdnmb.globals.forumBottomButton.window:
+        xdnmb.globals.forumContentControl.focus(appended[0])
+
+def prefetchReferences():
+    # 在后台同时请求当前页面中所有的引用
+    if not xdnmb.globals.config['Config'].getboolean('PrefetchReferences'):
+        return
+    xdnmb.api.prefetchReferences(sorted(xdnmb.globals.currentReferenceGraph().referenced))
+
+def prefetch():
+    # 在后台预加载当前页之后（以及之前）的页面，翻页时可以直接从pageCache中取出
+    # 显示新的页面之后都会调用这里，同时预加载页面中的引用
+    prefetchReferences()
+    if xdnmb.globals.prefetchTask:
+        xdnmb.globals.prefetchTask.cancel()
+        xdnmb.globals.prefetchTask = None
+    config = xdnmb.globals.config['Config']
+    depth = config.getint('PrefetchDepth')
+    if depth < 1:
+        return
+
+    thread = xdnmb.globals.thread
+    forum = xdnmb.globals.forum
+    if thread:
+        page = xdnmb.globals.threadPage
+        maxPage = thread.maxPage
+        fetch = functools.partial(fetchThread, thread)
+    elif forum:
+        page = xdnmb.globals.forumPage
+        maxPage = forum.maxPage if isinstance(forum, xdnmb.model.Timeline) else None
+        fetch = functools.partial(fetchForum, forum)
+    else:
+        return
+    pages = [page + i for i in range(1, depth + 1)]
+    if config.getboolean('PrefetchPrevious'):
+        pages.append(page - 1)
+    pages = [p for p in pages if p >= 1 and (maxPage is None or p <= maxPage)]
+
+    async def task():
+        loop = asyncio.get_running_loop()
+        for p in pages:
+            while config.getboolean('PrefetchIdleOnly') and xdnmb.globals.loadingTask:
+                await asyncio.sleep(.1)
+            try:
+                result = await loop.run_in_executor(None, fetch, p)
+            except Exception:
+                # 预加载失败不需要提示，翻页时会重新加载
+                break
+            if config.getboolean('PrefetchThumbnail'):
+                warmThumbnails(result)
+            if not result:
+                break
+
+    xdnmb.globals.prefetchTask = get_app().create_background_task(task())
+
+def warmThumbnails(result: xdnmb.model.Thread|tuple[xdnmb.model.Thread, ...]):
+    posts: list[xdnmb.model.Reply] = []
+    if isinstance(result, xdnmb.model.Thread):
+        posts.append(result)
+        posts.extend(result.replies or ())
+    else:
+        posts.extend(result)
+    for post in posts:
+        if post.imagePreviewAvailable:
+            post.requestImagePreview()
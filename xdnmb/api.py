@@ -1,15 +1,23 @@
 from __future__ import annotations
+import collections
+import concurrent.futures
 import dataclasses
 import functools
+import gzip
+import json
 import os
 import requests
 import secrets
+import sys
 import mimetypes
+import threading
+import time
+import typing
+import xdnmb.cache
 import xdnmb.globals
 import xdnmb.model
 import xdnmb.util
 
-from bs4 import BeautifulSoup
 from urllib.parse import urljoin
 
 try:
@@ -23,7 +31,7 @@ HTML_API_ENDPOINT = 'https://www.nmbxd.com/home/forum/'
 
 def responseHook(r: requests.Response, *args, **kwargs):
     r.raise_for_status()
-    if 'application/json' in r.headers['Content-Type']:
+    if 'application/json' in r.headers.get('Content-Type', ''):
         d = r.json()
         if isinstance(d, dict) and 'success' in d and 'error' in d and not d['success']:
             raise Exception(d['error'])
@@ -34,14 +42,168 @@ session.hooks['response'].append(responseHook)
 
 CDN_PATH: str = ''
 
+# 已经解析的版面/串的页面，用于预加载和翻页时直接显示
+# 键为(接口, 版面/串号, 页数, 只看PO)
+PAGE_CACHE_SIZE = 32
+PAGE_CACHE_TTL = 60
+pageCache: collections.OrderedDict[tuple[str, int, int, bool], tuple[float, typing.Any]] = collections.OrderedDict()
+pageCacheLock = threading.Lock()
+
+def pageCacheKey(target: xdnmb.model.Forum|xdnmb.model.Timeline|xdnmb.model.Feed|xdnmb.model.Thread|int, page: int) -> tuple[str, int, int, bool]:
+    # 整数表示串号
+    if isinstance(target, (xdnmb.model.Thread, int)):
+        poOnly = xdnmb.globals.config['Config'].getboolean('PoOnly')
+        return ('po' if poOnly else 'thread', target if isinstance(target, int) else target.tid, page, poOnly)
+    elif isinstance(target, xdnmb.model.Feed):
+        return ('feed', 0, page, False)
+    elif isinstance(target, xdnmb.model.Timeline):
+        return ('timeline', target.fid, page, False)
+    else:
+        return ('showf', target.fid, page, False)
+
+def pageCacheGet(key: tuple[str, int, int, bool]) -> typing.Any:
+    with pageCacheLock:
+        if key not in pageCache:
+            return None
+        t, value = pageCache[key]
+        if time.monotonic() - t > PAGE_CACHE_TTL:
+            del pageCache[key]
+            return None
+        pageCache.move_to_end(key)
+        return value
+
+def pageCacheSet(key: tuple[str, int, int, bool], value: typing.Any):
+    with pageCacheLock:
+        pageCache[key] = (time.monotonic(), value)
+        pageCache.move_to_end(key)
+        while len(pageCache) > PAGE_CACHE_SIZE:
+            pageCache.popitem(False)
+
+def pageCacheClear():
+    with pageCacheLock:
+        pageCache.clear()
+
+# 接口响应的缓存有效期（秒），在有效期内直接使用缓存，超过有效期后发送条件请求
+# 版面的第一页变化得很快，引用的内容则基本上不会变化
+CACHE_TTL: dict[str, typing.Callable[[dict], int]] = {
+    'getCDNPath': lambda params: 86400,
+    'getForumList': lambda params: 86400,
+    'getTimelineList': lambda params: 86400,
+    'showf': lambda params: 10 if params['page'] == 1 else 60,
+    'timeline': lambda params: 10 if params['page'] == 1 else 60,
+    'thread': lambda params: 30,
+    'po': lambda params: 30,
+    'ref': lambda params: 86400 * 7,
+    'feed': lambda params: 0,
+}
+
+# 发串、回复和订阅之后，在这之前缓存的对应的接口的响应即使还在有效期内也需要重新验证，否则看不到自己刚发的内容
+# 键为(接口, id参数)，id参数为None时表示这个接口的所有响应
+cacheInvalidated: dict[tuple[str, str|None], float] = {}
+
+def cachedGetInvalidate(endpoint: str, id: int|None = None):
+    cacheInvalidated[(endpoint, None if id is None else str(id))] = time.time()
+
+def cachedGet(endpoint: str, params: dict|None = None, ttl: float|None = None) -> requests.Response:
+    # ttl为None时使用CACHE_TTL中的有效期，math.inf表示只要有缓存就直接使用，0表示总是重新验证
+    params = params or {}
+    url = requests.Request('GET', urljoin(JSON_API_ENDPOINT, endpoint), params=params).prepare().url
+    cacheKey = 'http:' + url
+    cached = xdnmb.cache.lruCacheGet('http', cacheKey)
+    entry: dict|None = None
+    if cached:
+        header, body = gzip.decompress(cached).split(b'\n', 1)
+        entry = json.loads(header)
+        invalidated = max(
+            cacheInvalidated.get((endpoint, None), 0),
+            cacheInvalidated.get((endpoint, str(params['id'])), 0) if 'id' in params else 0,
+        )
+        if (
+            entry['time'] > invalidated
+            and time.time() - entry['time'] < (CACHE_TTL[endpoint](params) if ttl is None else ttl)
+        ):
+            return cachedResponse(url, entry, body)
+
+    headers = {}
+    if entry and entry['etag']:
+        headers['If-None-Match'] = entry['etag']
+    if entry and entry['lastModified']:
+        headers['If-Modified-Since'] = entry['lastModified']
+    # 记录发送请求的时间，请求期间发串的话，响应的内容不一定包括刚发的内容
+    requestTime = time.time()
+    try:
+        r = session.get(url, headers=headers)
+    except (requests.ConnectionError, requests.Timeout):
+        # 离线时使用已经过期的缓存
+        if entry:
+            return cachedResponse(url, entry, body)
+        raise
+    if r.status_code == 304 and entry:
+        entry['time'] = requestTime
+        r = cachedResponse(url, entry, body)
+    else:
+        entry = {
+            'time': requestTime,
+            'etag': r.headers.get('ETag'),
+            'lastModified': r.headers.get('Last-Modified'),
+            'contentType': r.headers.get('Content-Type', 'application/json'),
+        }
+        body = r.content
+    xdnmb.cache.lruCacheSet('http', cacheKey, gzip.compress(json.dumps(entry).encode('utf-8') + b'\n' + body))
+    return r
+
+def cachedResponse(url: str, entry: dict, body: bytes) -> requests.Response:
+    r = requests.Response()
+    r.status_code = 200
+    r.url = url
+    r.encoding = 'utf-8'
+    r.headers['Content-Type'] = entry['contentType']
+    r._content = body
+    return r
+
 # https://github.com/seven332/Nimingban/blob/master/app/src/main/java/com/hippo/nimingban/client/ac/ACUrl.java
 
-def getCDNPath() -> str:
+def findForum(fid: int|str) -> xdnmb.model.Forum|None:
+    return xdnmb.globals.forumIndex.get(int(fid))
+
+# 串和回应的JSON对应的字段：(字段名, JSON中的键名, 转换函数)
+# 重复出现的饼干、名称和标题使用sys.intern，避免每一条回应都保存一份相同的字符串
+REPLY_SCHEMA: tuple[tuple[str, str, typing.Callable[[typing.Any], typing.Any]], ...] = (
+    ('tid', 'id', int),
+    ('imgName', 'img', lambda x: x or ''),
+    ('imgExt', 'ext', lambda x: x or ''),
+    ('now', 'now', xdnmb.util.parseThreadTime),
+    ('userHash', 'user_hash', sys.intern),
+    ('name', 'name', sys.intern),
+    ('title', 'title', sys.intern),
+    ('content', 'content', xdnmb.util.stripHTML),
+    ('admin', 'admin', lambda x: bool(int(x))),
+)
+POST_SCHEMA: dict[type, tuple[tuple[str, str, typing.Callable[[typing.Any], typing.Any]], ...]] = {
+    xdnmb.model.Reply: REPLY_SCHEMA,
+    xdnmb.model.Thread: REPLY_SCHEMA + (
+        ('replyCount', 'ReplyCount', int),
+        ('sage', 'sage', lambda x: bool(int(x))),
+        ('forum', 'fid', findForum),
+    ),
+}
+
+def decodePost(raw: dict, cls: type[xdnmb.model.Reply] = xdnmb.model.Reply, **kwargs) -> xdnmb.model.Reply:
+    # kwargs中已经给出的字段不会再从JSON中读取
+    for field, key, convert in POST_SCHEMA[cls]:
+        if field not in kwargs:
+            kwargs[field] = convert(raw[key])
+    post = cls(**kwargs)
+    # 在线程池中提前处理好正文的格式，创建界面时不需要再解析
+    post.contentFragments
+    return post
+
+def getCDNPath(ttl: float|None = None) -> str:
     # https://image.nmb.best/
-    return max(session.get(urljoin(JSON_API_ENDPOINT, 'getCDNPath')).json(), key=lambda e: e['rate'])['url']
+    return max(cachedGet('getCDNPath', ttl=ttl).json(), key=lambda e: e['rate'])['url']
 
-def getForumList() -> tuple[xdnmb.model.ForumGroup, ...]:
-    r = session.get(urljoin(JSON_API_ENDPOINT, 'getForumList'))
+def getForumList(ttl: float|None = None) -> tuple[xdnmb.model.ForumGroup, ...]:
+    r = cachedGet('getForumList', ttl=ttl)
 
     groups: list[xdnmb.model.ForumGroup] = []
     for groupRaw in r.json():
@@ -71,8 +233,8 @@ def getForumList() -> tuple[xdnmb.model.ForumGroup, ...]:
         ))
     return tuple(groups)
 
-def getTimelineList() -> tuple[xdnmb.model.Timeline, ...]:
-    r = session.get(urljoin(JSON_API_ENDPOINT, 'getTimelineList'))
+def getTimelineList(ttl: float|None = None) -> tuple[xdnmb.model.Timeline, ...]:
+    r = cachedGet('getTimelineList', ttl=ttl)
 
     timelines: list[xdnmb.model.Timeline] = []
     for timelineRaw in r.json():
@@ -89,101 +251,84 @@ def getForum(forum: xdnmb.model.Forum|xdnmb.model.Timeline, page: int = 1) -> tu
         xdnmb.model.Forum: 'showf',
         xdnmb.model.Timeline: 'timeline',
     }[type(forum)]
-    r = session.get(urljoin(JSON_API_ENDPOINT, c), params={
+    r = cachedGet(c, {
         'id': forum.fid,
         'page': page,
     })
-    threads: list[xdnmb.model.Thread] = []
-    for threadRaw in r.json():
-        threads.append(xdnmb.model.Thread(
-            tid=threadRaw['id'],
-            replyCount=threadRaw['ReplyCount'],
-            img=(
-                (CDN_PATH + 'image/' + threadRaw['img'] + threadRaw['ext'])
-                if threadRaw['img'] and threadRaw['ext']
-                else None
-            ),
-            imgThumb=(
-                (CDN_PATH + 'thumb/' + threadRaw['img'] + threadRaw['ext'])
-                if threadRaw['img'] and threadRaw['ext']
-                else None
-            ),
-            now=xdnmb.util.parseThreadTime(threadRaw['now']),
-            userHash=threadRaw['user_hash'],
-            name=threadRaw['name'],
-            title=threadRaw['title'],
-            content=xdnmb.util.stripHTML(threadRaw['content']),
-            sage=bool(threadRaw['sage']),
-            admin=bool(threadRaw['admin']),
-            forum=next(
-                (forum for forum in xdnmb.globals.forums if forum.fid == threadRaw['fid']),
-                None,
-            ),
-            isPo=False,
-        ))
-    return tuple(threads)
+    threads = tuple(decodePost(threadRaw, xdnmb.model.Thread) for threadRaw in r.json())
+    indexThreads(threads)
+    return threads
 
-def getThread(thread: xdnmb.model.Thread, page: int = 1) -> xdnmb.model.Thread:
-    r = session.get(
-        urljoin(JSON_API_ENDPOINT, 'po' if xdnmb.globals.config['Config'].getboolean('PoOnly') else 'thread'),
-        params={
-            'id': thread.tid,
+def getThread(thread: xdnmb.model.Thread|int, page: int = 1, ttl: float|None = None) -> xdnmb.model.Thread:
+    import xdnmb.search
+    # 只知道串号时（例如从搜索结果打开）使用接口返回的串的内容
+    poOnly = xdnmb.globals.config['Config'].getboolean('PoOnly')
+    r = cachedGet(
+        'po' if poOnly else 'thread',
+        {
+            'id': thread if isinstance(thread, int) else thread.tid,
             'page': page,
         },
+        ttl,
     )
-    thread = dataclasses.replace(thread)
-    thread.replyCount = r.json()['ReplyCount']
-    thread.replies = []
-    for replyRaw in r.json()['Replies']:
-        thread.replies.append(xdnmb.model.Reply(
-            tid=replyRaw['id'],
-            img=(
-                (CDN_PATH + 'image/' + replyRaw['img'] + replyRaw['ext'])
-                if replyRaw['img'] and replyRaw['ext']
-                else None
-            ),
-            imgThumb=(
-                (CDN_PATH + 'thumb/' + replyRaw['img'] + replyRaw['ext'])
-                if replyRaw['img'] and replyRaw['ext']
-                else None
-            ),
-            now=xdnmb.util.parseThreadTime(replyRaw['now']),
-            userHash=replyRaw['user_hash'],
-            name=replyRaw['name'],
-            title=replyRaw['title'],
-            content=xdnmb.util.stripHTML(replyRaw['content']),
-            admin=bool(replyRaw['admin']),
-            isPo=replyRaw['user_hash'] == thread.userHash,
-        ))
-    thread.replies = tuple(thread.replies)
+    threadRaw = r.json()
+    if isinstance(thread, int):
+        thread = decodePost(threadRaw, xdnmb.model.Thread)
+    thread = dataclasses.replace(
+        thread,
+        replyCount=int(threadRaw['ReplyCount']),
+        replies=tuple(
+            decodePost(replyRaw, isPo=replyRaw['user_hash'] == thread.userHash)
+            for replyRaw in threadRaw['Replies']
+        ),
+    )
+    # 只看PO时的页数和完整的串不同
+    xdnmb.search.indexPosts((
+        (thread, thread.forum.fid if thread.forum else None, thread.tid, 1),
+        *((r, thread.forum.fid if thread.forum else None, thread.tid, None if poOnly else page) for r in thread.replies),
+    ))
     return thread
 
-@functools.lru_cache(1024)
-def getReference(tid: int) -> xdnmb.model.Reply:
-    r = session.get(urljoin(JSON_API_ENDPOINT, 'ref'), params={
+def indexThreads(threads: tuple[xdnmb.model.Thread, ...]):
+    import xdnmb.search
+    xdnmb.search.indexPosts((t, t.forum.fid if t.forum else None, t.tid, 1) for t in threads)
+
+# 引用的串，显示版面或串之后会在后台同时请求页面中所有的引用，查看引用时可以直接显示
+# 接口响应在磁盘缓存中的有效期为7天，重新启动之后也不需要重新请求
+# 同一个串号只会请求一次，正在请求的引用再次查看时等待同一个Future；请求失败的Future不会保留，下次查看时重新请求
+REFERENCE_CACHE_SIZE = 1024
+REFERENCE_CONCURRENCY = 4
+referenceExecutor = concurrent.futures.ThreadPoolExecutor(REFERENCE_CONCURRENCY)
+referenceFutures: collections.OrderedDict[int, concurrent.futures.Future] = collections.OrderedDict()
+referenceLock = threading.Lock()
+
+def fetchReference(tid: int) -> xdnmb.model.Reply:
+    import xdnmb.search
+    r = cachedGet('ref', {
         'id': tid,
     })
-    refRaw = r.json()
-    return xdnmb.model.Reply(
-        tid=tid,
-        img=(
-            (CDN_PATH + 'image/' + refRaw['img'] + refRaw['ext'])
-            if refRaw['img'] and refRaw['ext']
-            else None
-        ),
-        imgThumb=(
-            (CDN_PATH + 'thumb/' + refRaw['img'] + refRaw['ext'])
-            if refRaw['img'] and refRaw['ext']
-            else None
-        ),
-        now=xdnmb.util.parseThreadTime(refRaw['now']),
-        userHash=refRaw['user_hash'],
-        name=refRaw['name'],
-        title=refRaw['title'],
-        content=xdnmb.util.stripHTML(refRaw['content']),
-        admin=bool(refRaw['admin']),
-        isPo=False,
-    )
+    reply = decodePost(r.json(), tid=tid)
+    xdnmb.search.indexPosts(((reply, None, None, None), ))
+    return reply
+
+def getReferenceFuture(tid: int) -> concurrent.futures.Future:
+    with referenceLock:
+        future = referenceFutures.get(tid)
+        if future is not None and not (future.done() and future.exception()):
+            referenceFutures.move_to_end(tid)
+            return future
+        future = referenceExecutor.submit(fetchReference, tid)
+        referenceFutures[tid] = future
+        while len(referenceFutures) > REFERENCE_CACHE_SIZE:
+            referenceFutures.popitem(False)
+        return future
+
+def getReference(tid: int) -> xdnmb.model.Reply:
+    return getReferenceFuture(tid).result()
+
+def prefetchReferences(tids: typing.Iterable[int]):
+    for tid in tids:
+        getReferenceFuture(tid)
 
 def postThread(
     forumOrThread: xdnmb.model.Forum|xdnmb.model.Thread,
@@ -209,6 +354,12 @@ def postThread(
     if image:
         if image in xdnmb.globals.STICKERS:
             image = xdnmb.globals.STICKERS[image]
+            if not (image.startswith('https://') or image.startswith('http://')):
+                # 图片CDN的地址在后台获取，还没有获取到时在这里获取，否则拼接出的是本地的相对路径
+                cdnPath = CDN_PATH or getCDNPath()
+                if not cdnPath:
+                    raise Exception('无法获取图片CDN的地址，请稍后再试')
+                image = urljoin(cdnPath, image)
         f['image'] = (
             secrets.token_urlsafe(12) + os.path.splitext(image.split('?')[0])[1],
             (
@@ -221,45 +372,48 @@ def postThread(
         if water:
             f['water'] = (None, 'true')
     r = session.post(urljoin(HTML_API_ENDPOINT, c), files=f)
-    soup = BeautifulSoup(r.text, features='html.parser')
-    errorNode = soup.select_one('.error')
-    if errorNode:
-        raise Exception(xdnmb.util.stripHTML(errorNode))
+    error = parseErrorPage(r.text)
+    if error is not None:
+        raise Exception(error)
+    if isinstance(forumOrThread, xdnmb.model.Forum):
+        cachedGetInvalidate('showf', forumOrThread.fid)
+    else:
+        cachedGetInvalidate('thread', forumOrThread.tid)
+        cachedGetInvalidate('po', forumOrThread.tid)
+        if isinstance(forumOrThread.forum, xdnmb.model.Forum):
+            cachedGetInvalidate('showf', forumOrThread.forum.fid)
+    cachedGetInvalidate('timeline')
 
-def getFeed(page: int = 1) -> tuple[xdnmb.model.Thread, ...]:
-    r = session.get(urljoin(JSON_API_ENDPOINT, 'feed'), params={
+def parseErrorPage(text: str) -> str|None:
+    # 只有发串和订阅失败时才需要解析网页，bs4在这里才导入，以减少启动时间
+    import warnings
+    from bs4 import BeautifulSoup
+    from bs4 import MarkupResemblesLocatorWarning
+    warnings.filterwarnings('ignore', category=MarkupResemblesLocatorWarning)
+    errorNode = BeautifulSoup(text, features='html.parser').select_one('.error')
+    return xdnmb.util.stripHTML(errorNode) if errorNode else None
+
+def getFeed(page: int = 1, index: bool = True) -> tuple[xdnmb.model.Thread, ...]:
+    # 后台检查新回应时每次都会获取完整的订阅列表，这时index为False，不重复写入搜索索引
+    r = cachedGet('feed', {
         'uuid': xdnmb.globals.config['Config'].get('FeedUUID'),
         'page': page,
     })
-    threads: list[xdnmb.model.Thread] = []
-    for threadRaw in r.json():
-        threads.append(xdnmb.model.Thread(
-            tid=int(threadRaw['id']),
+    # 订阅列表的格式和版面不同：数字都是字符串，没有sage，回应数量的键名也不同
+    threads = tuple(
+        decodePost(
+            threadRaw,
+            xdnmb.model.Thread,
             replyCount=int(threadRaw['reply_count']),
-            img=(
-                (CDN_PATH + 'image/' + threadRaw['img'] + threadRaw['ext'])
-                if threadRaw['img'] and threadRaw['ext']
-                else None
-            ),
-            imgThumb=(
-                (CDN_PATH + 'thumb/' + threadRaw['img'] + threadRaw['ext'])
-                if threadRaw['img'] and threadRaw['ext']
-                else None
-            ),
-            now=xdnmb.util.parseThreadTime(threadRaw['now']),
-            userHash=threadRaw['user_hash'],
-            name=threadRaw['name'] or '无名氏',
-            title=threadRaw['title'] or '无标题',
-            content=xdnmb.util.stripHTML(threadRaw['content']),
+            name=sys.intern(threadRaw['name'] or '无名氏'),
+            title=sys.intern(threadRaw['title'] or '无标题'),
             sage=False,
-            admin=bool(int(threadRaw['admin'])),
-            forum=next(
-                (forum for forum in xdnmb.globals.forums if forum.fid == int(threadRaw['fid'])),
-                None,
-            ),
-            isPo=False,
-        ))
-    return tuple(threads)
+        )
+        for threadRaw in r.json()
+    )
+    if index:
+        indexThreads(threads)
+    return threads
 
 def addFeed(thread: xdnmb.model.Thread):
     r = session.post(urljoin(JSON_API_ENDPOINT, 'addFeed'), data={
@@ -270,9 +424,10 @@ def addFeed(thread: xdnmb.model.Thread):
         if 'application/json' in r.headers['Content-Type']:
             raise Exception(r.json())
         elif 'text/html' in r.headers['Content-Type']:
-            raise Exception(xdnmb.util.stripHTML(BeautifulSoup(r.text, features='html.parser').select_one('.error')))
+            raise Exception(parseErrorPage(r.text) or r.text)
         else:
             raise Exception(r.text)
+    cachedGetInvalidate('feed')
 
 def delFeed(thread: xdnmb.model.Thread):
     r = session.post(urljoin(JSON_API_ENDPOINT, 'delFeed'), data={
@@ -283,6 +438,7 @@ def delFeed(thread: xdnmb.model.Thread):
         if 'application/json' in r.headers['Content-Type']:
             raise Exception(r.json())
         elif 'text/html' in r.headers['Content-Type']:
-            raise Exception(xdnmb.util.stripHTML(BeautifulSoup(r.text, features='html.parser').select_one('.error')))
+            raise Exception(parseErrorPage(r.text) or r.text)
         else:
             raise Exception(r.text)
+    cachedGetInvalidate('feed')
@@ -0,0 +1,197 @@
+from __future__ import annotations
+import concurrent.futures
+import html
+import json
+import math
+import os
+import sys
+import typing
+import xdnmb.api
+import xdnmb.globals
+
+from urllib.parse import urljoin
+
+# 存档的目录结构：
+# <ArchivePath>/<串号>/pages/0001.json  每一页的原始响应，用于断点续传
+# <ArchivePath>/<串号>/thread.json      合并后的完整的串
+# <ArchivePath>/<串号>/thread.html      可以直接用浏览器打开的页面
+# <ArchivePath>/<串号>/image/...        原图
+# <ArchivePath>/<串号>/thumb/...        缩略图
+
+def archivePath() -> str:
+    return (
+        xdnmb.globals.args.archivePath
+        or xdnmb.globals.config['Config'].get('ArchivePath')
+        or os.path.join(xdnmb.globals.XDG_DATA_PATH, 'archive')
+    )
+
+def writeAtomic(path: str, data: bytes):
+    # 先写入临时文件再重命名，中断时不会留下不完整的文件
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+
+def fetchPage(tid: int, page: int, pagePath: str) -> dict:
+    # 不经过接口缓存，避免大量的页面把缓存中的缩略图挤出去
+    r = xdnmb.api.session.get(urljoin(xdnmb.api.JSON_API_ENDPOINT, 'thread'), params={
+        'id': tid,
+        'page': page,
+    })
+    writeAtomic(pagePath, r.content)
+    return r.json()
+
+def countReplies(page: dict) -> int:
+    # 每一页都会出现的Tips不算在内
+    return sum(int(reply['id']) != 9999999 for reply in page['Replies'])
+
+def fetchImage(url: str, imagePath: str):
+    with xdnmb.api.session.get(url, timeout=30) as r:
+        writeAtomic(imagePath, r.content)
+
+def archiveThread(
+    tid: int,
+    path: str,
+    images: bool = False,
+    concurrency: int = 4,
+    progress: typing.Callable[[int, int], None]|None = None,
+) -> tuple[str, list[int], list[str]]:
+    threadPath = os.path.join(path, str(tid))
+    pagePath = lambda page: os.path.join(threadPath, 'pages', f'{page:04d}.json')
+
+    # 第一页总是重新获取，用于得到最新的回应数量
+    first = fetchPage(tid, 1, pagePath(1))
+    maxPage = max(math.ceil(int(first['ReplyCount']) / 19), 1)
+    pages: dict[int, dict] = {1: first}
+    failedPages: list[int] = []
+    failedImages: list[str] = []
+    done = 1
+    if progress:
+        progress(done, maxPage)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures: dict[concurrent.futures.Future, int] = {}
+        for page in range(2, maxPage + 1):
+            # 已经存档过的完整的页面不需要重新获取
+            # 存档时是最后一页的页面可能不满19条回应，之后串有了新的回应时需要重新获取
+            if page < maxPage and os.path.exists(pagePath(page)):
+                with open(pagePath(page), 'rb') as f:
+                    stored = json.loads(f.read())
+                if countReplies(stored) >= 19:
+                    pages[page] = stored
+                    done += 1
+                    continue
+            futures[executor.submit(fetchPage, tid, page, pagePath(page))] = page
+        if progress:
+            progress(done, maxPage)
+        for future in concurrent.futures.as_completed(futures):
+            page = futures[future]
+            try:
+                pages[page] = future.result()
+            except Exception:
+                failedPages.append(page)
+            done += 1
+            if progress:
+                progress(done, maxPage)
+
+        replies: dict[int, dict] = {}
+        for page in sorted(pages):
+            for reply in pages[page]['Replies']:
+                # 每一页都会出现的Tips
+                if int(reply['id']) == 9999999:
+                    continue
+                replies[int(reply['id'])] = reply
+        thread = {k: v for k, v in first.items() if k != 'Replies'}
+        thread['Replies'] = [replies[k] for k in sorted(replies)]
+
+        if images:
+            futures = {}
+            for post in (thread, *thread['Replies']):
+                if not (post['img'] and post['ext']):
+                    continue
+                for kind in ('image', 'thumb'):
+                    imagePath = os.path.join(threadPath, kind, post['img'] + post['ext'])
+                    if os.path.exists(imagePath):
+                        continue
+                    url = xdnmb.api.CDN_PATH + kind + '/' + post['img'] + post['ext']
+                    futures[executor.submit(fetchImage, url, imagePath)] = url
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception:
+                    failedImages.append(futures[future])
+
+    writeAtomic(
+        os.path.join(threadPath, 'thread.json'),
+        json.dumps(thread, ensure_ascii=False, indent=2).encode('utf-8'),
+    )
+    writeAtomic(
+        os.path.join(threadPath, 'thread.html'),
+        renderHTML(thread, images).encode('utf-8'),
+    )
+    failedPages.sort()
+    return threadPath, failedPages, failedImages
+
+def renderHTML(thread: dict, images: bool) -> str:
+    def renderPost(post: dict) -> str:
+        result = (
+            '<div class="post">'
+            f'<div class="info"><span class="title">{html.escape(post["title"])}</span> '
+            f'<span class="name">{html.escape(post["name"])}</span> '
+            f'{html.escape(post["now"])} ID:{html.escape(post["user_hash"])} '
+            f'<a id="{post["id"]}" href="#{post["id"]}">No.{post["id"]}</a></div>'
+        )
+        if post['img'] and post['ext']:
+            src = lambda kind: (
+                f'{kind}/{post["img"]}{post["ext"]}'
+                if images else
+                f'{xdnmb.api.CDN_PATH}{kind}/{post["img"]}{post["ext"]}'
+            )
+            result += f'<a href="{html.escape(src("image"))}"><img src="{html.escape(src("thumb"))}"></a>'
+        # 正文是X岛返回的HTML，和网页版一样直接使用
+        result += f'<div class="content">{post["content"]}</div></div>'
+        return result
+
+    return ''.join((
+        '<!DOCTYPE html><html><head><meta charset="utf-8">',
+        f'<title>No.{thread["id"]} - X岛匿名版</title>',
+        '<style>',
+        'body{background:#ffffee;color:#800000;font-family:sans-serif}',
+        '.post{margin:1em 0;padding:.5em;background:#f0e0d6}',
+        '.title{color:#cc1105;font-weight:bold}',
+        '.name{color:#117743;font-weight:bold}',
+        '.content{white-space:normal;margin-top:.5em}',
+        'img{display:block;max-width:250px}',
+        '</style></head><body>',
+        renderPost(thread),
+        *(renderPost(reply) for reply in thread['Replies']),
+        '</body></html>',
+    ))
+
+def archiveFromCommandLine() -> int:
+    config = xdnmb.globals.config['Config']
+    args = xdnmb.globals.args
+
+    def progress(done: int, total: int):
+        print(f'\r正在存档 No.{args.archive}：{done}/{total} 页', end='', file=sys.stderr, flush=True)
+
+    try:
+        if not xdnmb.api.CDN_PATH:
+            xdnmb.api.CDN_PATH = xdnmb.api.getCDNPath()
+        threadPath, failedPages, failedImages = archiveThread(
+            args.archive,
+            archivePath(),
+            args.archiveImages or config.getboolean('ArchiveImages'),
+            args.archiveConcurrency or config.getint('ArchiveConcurrency'),
+            progress,
+        )
+    except Exception as ex:
+        print(f'\n存档失败：{type(ex).__name__}: {ex}', file=sys.stderr)
+        return 1
+    print(file=sys.stderr)
+    if failedPages:
+        print(f'以下页面获取失败，重新执行可以继续存档：{", ".join(str(x) for x in failedPages)}', file=sys.stderr)
+    if failedImages:
+        print(f'{len(failedImages)} 张图片下载失败', file=sys.stderr)
+    print(threadPath)
+    return 1 if failedPages or failedImages else 0
@@ -0,0 +1,369 @@
+import argparse
+import atexit
+import dataclasses
+import os
+import sqlite3
+import sys
+import threading
+import time
+import typing
+
+# 图片预览和接口缓存共用的LRU缓存（保存在lru-cache.db）
+# 写入只需要一条UPSERT；读取时只在内存中记下访问时间，攒够一批或者隔一段时间之后再一起写回
+# 缓存按用途分为几个命名空间，每个命名空间有各自的容量上限（字节数，在配置文件中设定）
+# 占用超过上限的一定比例（高水位）之后才在后台线程中按访问时间淘汰到上限，不再在每次写入时对整个表排序
+# 每个线程使用自己的连接（WAL模式下读取互不阻塞，写入由SQLite自己排队），图片预览的线程池中的线程可以同时读写缓存
+# 这个模块不依赖xdnmb中的其他模块，由xdnmb.globals在读取配置后打开数据库
+
+NAMESPACE_NAMES = {
+    'http': '接口响应',
+    'chafa': '缩略图预览',
+    'thumb': '缩略图',
+}
+
+# 积累了这么多条访问时间或者距离上次写回超过这么多秒就写回
+TOUCH_FLUSH_COUNT = 256
+TOUCH_FLUSH_INTERVAL = 30
+# 占用超过上限的这个倍数时开始淘汰
+HIGH_WATER_RATIO = 1.125
+# 每次淘汰时最多删除的行数，分成小的事务可以避免长时间占用写锁
+EVICT_BATCH_SIZE = 1024
+# 其他线程正在写入时等待的毫秒数
+BUSY_TIMEOUT = 10000
+
+@dataclasses.dataclass
+class NamespaceStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    bytesRead: int = 0
+    bytesWritten: int = 0
+    lookupTime: float = 0
+
+    @property
+    def lookups(self) -> int:
+        return self.hits + self.misses
+
+path: str|None = None
+local = threading.local()
+# 关闭数据库之前调用，用于让其他模块在后台写入数据库的线程写完并停止
+closeHooks: list[typing.Callable[[], None]] = []
+# 各个命名空间的容量上限，没有设定的命名空间不会被淘汰
+budgets: dict[str, int] = {}
+# 保护下面这些在线程之间共享的状态，不会在持有锁的时候访问数据库
+lock = threading.Lock()
+# 访问时间使用浮点数，同一秒内的先后也能区分
+pendingTouches: dict[str, float] = {}
+lastFlush = time.monotonic()
+# 各个命名空间的大致占用，写入时累加（覆盖已有的行时会偏大），淘汰时重新统计
+usedBytes: dict[str, int] = {}
+# 本次运行的统计数据，退出时累加到数据库的stats表中
+stats: dict[str, NamespaceStats] = {}
+maintaining = False
+maintenanceThread: threading.Thread|None = None
+
+def connect(dbPath: str):
+    global path
+    path = dbPath
+    db = connection()
+    columns = {row[1] for row in db.execute('PRAGMA table_info("cache")')}
+    db.executescript(''.join(x.strip() for x in '''
+    CREATE TABLE IF NOT EXISTS "cache" (
+        "id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+        "timestamp" DATE NOT NULL,
+        "key" TEXT NOT NULL,
+        "value" BLOB,
+        "namespace" TEXT NOT NULL DEFAULT '',
+        "size" INTEGER NOT NULL DEFAULT 0,
+        CONSTRAINT "const_key" UNIQUE ("key")
+    );
+    CREATE TABLE IF NOT EXISTS "stats" (
+        "namespace" TEXT NOT NULL PRIMARY KEY,
+        "hits" INTEGER NOT NULL DEFAULT 0,
+        "misses" INTEGER NOT NULL DEFAULT 0,
+        "evictions" INTEGER NOT NULL DEFAULT 0,
+        "bytesRead" INTEGER NOT NULL DEFAULT 0,
+        "bytesWritten" INTEGER NOT NULL DEFAULT 0,
+        "lookupTime" REAL NOT NULL DEFAULT 0
+    );
+    '''.splitlines()))
+    # 旧版本的缓存没有命名空间和大小，按照键的格式补上
+    if columns and 'namespace' not in columns:
+        db.executescript('''
+        BEGIN;
+        ALTER TABLE "cache" ADD COLUMN "namespace" TEXT NOT NULL DEFAULT '';
+        ALTER TABLE "cache" ADD COLUMN "size" INTEGER NOT NULL DEFAULT 0;
+        UPDATE "cache" SET
+            "namespace" = CASE WHEN "key" LIKE 'http:%' THEN 'http' ELSE 'chafa' END,
+            "size" = length(CAST("key" AS BLOB)) + ifnull(length("value"), 0);
+        DROP INDEX IF EXISTS "idx_timestamp";
+        COMMIT;
+        ''')
+    db.executescript(''.join(x.strip() for x in '''
+    CREATE UNIQUE INDEX IF NOT EXISTS "main"."idx_key"
+    ON "cache" (
+        "key"
+    );
+    CREATE INDEX IF NOT EXISTS "main"."idx_namespace_timestamp"
+    ON "cache" (
+        "namespace",
+        "timestamp",
+        "size"
+    );
+    '''.splitlines()))
+    atexit.register(close)
+
+def connection() -> sqlite3.Connection|None:
+    # 返回当前线程的连接，数据库已经关闭时返回None
+    if path is None:
+        return None
+    db: sqlite3.Connection|None = getattr(local, 'db', None)
+    if db is None:
+        db = sqlite3.connect(path, isolation_level=None)
+        db.executescript(f'''
+        PRAGMA journal_mode = wal;
+        PRAGMA busy_timeout = {BUSY_TIMEOUT};
+        PRAGMA synchronous = normal;
+        PRAGMA mmap_size = 268435456;
+        PRAGMA temp_store = memory;
+        ''')
+        local.db = db
+    return db
+
+def close():
+    # 只关闭当前线程的连接，其他线程可能正在事务中，不能从这里关闭它们的连接
+    # 关闭之后connection()总是返回None，其他线程不会再开始新的读写，它们的连接在线程结束时随着threading.local一起被回收
+    global path
+    db = connection()
+    if db is None:
+        return
+    for hook in closeHooks:
+        hook()
+    path = None
+    # 后台的淘汰会在当前这一批删除完成后停止
+    thread = maintenanceThread
+    if thread is not None:
+        thread.join(BUSY_TIMEOUT / 1000)
+    flushTouches(db)
+    with lock:
+        sessionStats = tuple((namespace, *dataclasses.astuple(s)) for namespace, s in stats.items())
+        stats.clear()
+    db.executemany(
+        'INSERT INTO `stats`(`namespace`, `hits`, `misses`, `evictions`, `bytesRead`, `bytesWritten`, `lookupTime`) VALUES (?, ?, ?, ?, ?, ?, ?) '
+        'ON CONFLICT(`namespace`) DO UPDATE SET '
+        '`hits` = `hits` + excluded.`hits`, '
+        '`misses` = `misses` + excluded.`misses`, '
+        '`evictions` = `evictions` + excluded.`evictions`, '
+        '`bytesRead` = `bytesRead` + excluded.`bytesRead`, '
+        '`bytesWritten` = `bytesWritten` + excluded.`bytesWritten`, '
+        '`lookupTime` = `lookupTime` + excluded.`lookupTime`',
+        sessionStats,
+    )
+    local.db = None
+    # 退出时把WAL合并回数据库并清空，下次启动时不需要再重放
+    db.execute('PRAGMA wal_checkpoint(truncate)')
+    db.close()
+
+def flushTouches(db: sqlite3.Connection):
+    global pendingTouches, lastFlush
+    with lock:
+        touches = pendingTouches
+        pendingTouches = {}
+        lastFlush = time.monotonic()
+    if not touches:
+        return
+    try:
+        db.execute('BEGIN IMMEDIATE')
+        db.executemany(
+            'UPDATE `cache` SET `timestamp` = ? WHERE `key` = ?',
+            ((timestamp, key) for key, timestamp in touches.items()),
+        )
+        db.execute('COMMIT')
+    except sqlite3.Error:
+        # 写回失败只会让这些缓存的访问时间偏旧，不影响读写
+        if db.in_transaction:
+            db.execute('ROLLBACK')
+
+def lruCacheGet(namespace: str, key: str) -> bytes | None:
+    db = connection()
+    if db is None:
+        return None
+    start = time.perf_counter()
+    row = db.execute(
+        'SELECT `value` FROM `cache` WHERE `key` = ?',
+        (key, ),
+    ).fetchone()
+    elapsed = time.perf_counter() - start
+    with lock:
+        s = stats.setdefault(namespace, NamespaceStats())
+        s.lookupTime += elapsed
+        if not row:
+            s.misses += 1
+            return None
+        s.hits += 1
+        s.bytesRead += len(row[0]) if row[0] else 0
+        pendingTouches[key] = time.time()
+        flush = len(pendingTouches) >= TOUCH_FLUSH_COUNT or time.monotonic() - lastFlush > TOUCH_FLUSH_INTERVAL
+    if flush:
+        flushTouches(db)
+    return row[0]
+
+def lruCacheSet(namespace: str, key: str, value: bytes | None):
+    db = connection()
+    if db is None:
+        return
+    size = len(key.encode('utf-8')) + (len(value) if value else 0)
+    db.execute(
+        'INSERT INTO `cache`(`timestamp`, `key`, `value`, `namespace`, `size`) VALUES (?, ?, ?, ?, ?) '
+        'ON CONFLICT(`key`) DO UPDATE SET '
+        '`timestamp` = excluded.`timestamp`, `value` = excluded.`value`, `namespace` = excluded.`namespace`, `size` = excluded.`size`',
+        (time.time(), key, value, namespace, size),
+    )
+    with lock:
+        pendingTouches.pop(key, None)
+        stats.setdefault(namespace, NamespaceStats()).bytesWritten += size
+        usedBytes[namespace] = usedBytes.get(namespace, 0) + size
+        overHighWater = namespace in budgets and usedBytes[namespace] > budgets[namespace] * HIGH_WATER_RATIO
+    if overHighWater:
+        startMaintenance()
+
+def startMaintenance():
+    # 在后台统计各个命名空间的占用并淘汰超出上限的部分
+    # 启动时也会执行一次，这样修改了配置中的上限之后同样会淘汰
+    global maintaining, maintenanceThread
+    with lock:
+        if maintaining or path is None:
+            return
+        maintaining = True
+        maintenanceThread = threading.Thread(target=maintain, daemon=True)
+    maintenanceThread.start()
+
+def maintain():
+    global maintaining
+    try:
+        while True:
+            evict(HIGH_WATER_RATIO)
+            # 淘汰期间的写入可能又超过了高水位
+            with lock:
+                if path is None or not any(usedBytes.get(namespace, 0) > budget * HIGH_WATER_RATIO for namespace, budget in budgets.items()):
+                    break
+        db = connection()
+        if db is not None:
+            db.execute('PRAGMA wal_checkpoint(passive)')
+    finally:
+        maintaining = False
+
+def evict(highWaterRatio: float = 1) -> int:
+    # 把占用超过上限×highWaterRatio的命名空间按访问时间淘汰到上限以下，返回删除的行数
+    db = connection()
+    if db is None:
+        return 0
+    flushTouches(db)
+    total = 0
+    for namespace, used in db.execute('SELECT `namespace`, SUM(`size`) FROM `cache` GROUP BY `namespace`').fetchall():
+        # 之后的写入会继续累加，淘汰的部分再减去
+        with lock:
+            usedBytes[namespace] = used
+        if namespace not in budgets or used <= budgets[namespace] * highWaterRatio:
+            continue
+        evicted = 0
+        while used > budgets[namespace] and path is not None:
+            # 淘汰期间其他线程仍然会读取缓存，选出要删除的行之前再写回一次访问时间
+            flushTouches(db)
+            ids = []
+            freed = 0
+            for rowId, size in db.execute(
+                'SELECT `id`, `size` FROM `cache` WHERE `namespace` = ? ORDER BY `timestamp`, `id` LIMIT ?',
+                (namespace, EVICT_BATCH_SIZE),
+            ).fetchall():
+                ids.append((rowId, ))
+                freed += size
+                if used - freed <= budgets[namespace]:
+                    break
+            if not ids:
+                break
+            db.execute('BEGIN IMMEDIATE')
+            db.executemany('DELETE FROM `cache` WHERE `id` = ?', ids)
+            db.execute('COMMIT')
+            used -= freed
+            evicted += len(ids)
+            with lock:
+                usedBytes[namespace] -= freed
+                stats.setdefault(namespace, NamespaceStats()).evictions += len(ids)
+        total += evicted
+    return total
+
+def clear(namespace: str|None = None) -> int:
+    # namespace为None时清除所有的缓存，返回删除的行数
+    db = connection()
+    if db is None:
+        return 0
+    flushTouches(db)
+    if namespace is None:
+        count = db.execute('DELETE FROM `cache`').rowcount
+    else:
+        count = db.execute('DELETE FROM `cache` WHERE `namespace` = ?', (namespace, )).rowcount
+    with lock:
+        if namespace is None:
+            usedBytes.clear()
+        else:
+            usedBytes.pop(namespace, None)
+    return count
+
+def formatBytes(size: float) -> str:
+    if size < 1024:
+        return f'{size:.0f} B'
+    for unit in ('KiB', 'MiB', 'GiB'):
+        size /= 1024
+        if size < 1024:
+            break
+    return f'{size:.1f} {unit}'
+
+def formatStats(accumulated: bool = False) -> str:
+    # accumulated为True时显示历次运行累计的统计数据，否则只显示本次运行的
+    db = connection()
+    if db is None:
+        return ''
+    usage = {
+        namespace: (rows, used)
+        for namespace, rows, used in db.execute('SELECT `namespace`, COUNT(*), SUM(`size`) FROM `cache` GROUP BY `namespace`')
+    }
+    with lock:
+        current = {namespace: dataclasses.replace(s) for namespace, s in stats.items()}
+    if accumulated:
+        for namespace, *values in db.execute('SELECT `namespace`, `hits`, `misses`, `evictions`, `bytesRead`, `bytesWritten`, `lookupTime` FROM `stats`'):
+            s = current.setdefault(namespace, NamespaceStats())
+            for field, value in zip(dataclasses.fields(NamespaceStats), values):
+                setattr(s, field.name, getattr(s, field.name) + value)
+
+    lines = []
+    for namespace in sorted(set(NAMESPACE_NAMES) | set(usage) | set(current)):
+        rows, used = usage.get(namespace, (0, 0))
+        s = current.get(namespace, NamespaceStats())
+        lines.extend((
+            f'{NAMESPACE_NAMES.get(namespace, namespace)} ({namespace})',
+            f'  占用 {formatBytes(used)}' + (f' / {formatBytes(budgets[namespace])}' if namespace in budgets else '') + f'，共 {rows} 条',
+            f'  命中 {s.hits} 次，未命中 {s.misses} 次' + (f'，命中率 {s.hits / s.lookups:.1%}' if s.lookups else ''),
+            f'  淘汰 {s.evictions} 条，读取 {formatBytes(s.bytesRead)}，写入 {formatBytes(s.bytesWritten)}',
+            f'  平均查找耗时 ' + (f'{s.lookupTime / s.lookups * 1000:.3f} ms' if s.lookups else '-'),
+        ))
+    fileSize = sum(os.path.getsize(p) for p in (path, path + '-wal') if os.path.exists(p))
+    lines.append(f'数据库文件 {formatBytes(fileSize)}')
+    return '\n'.join(lines)
+
+def cacheFromCommandLine(args: argparse.Namespace) -> int:
+    # args.cacheClear为空字符串时清除所有的缓存
+    if args.cacheClear and args.cacheClear not in NAMESPACE_NAMES:
+        print(f'未知的命名空间：{args.cacheClear}，可以使用的命名空间：{", ".join(NAMESPACE_NAMES)}', file=sys.stderr)
+        return 1
+    if args.cacheClear is not None:
+        print(f'已清除 {clear(args.cacheClear or None)} 条缓存', file=sys.stderr)
+    if args.cachePrune:
+        print(f'已淘汰 {evict()} 条缓存', file=sys.stderr)
+    if args.cacheClear is not None or args.cachePrune:
+        # 删除之后收缩数据库文件
+        connection().execute('VACUUM')
+        connection().execute('PRAGMA wal_checkpoint(truncate)')
+    if args.cacheStats:
+        print(formatStats(True))
+    return 0
@@ -0,0 +1,175 @@
+from __future__ import annotations
+import asyncio
+import concurrent.futures
+import random
+import sqlite3
+import threading
+import typing
+import xdnmb.api
+import xdnmb.cache
+import xdnmb.globals
+import xdnmb.model
+
+from prompt_toolkit.application.current import get_app
+
+# 订阅的串的新回应提醒
+# 在后台定期获取订阅列表，和上次查看这个串时的回应数量比较得到新回应的数量
+# 每个串上次查看时和最新的回应数量保存在缓存数据库（lru-cache.db）的feed表中，重新启动之后仍然有效
+# 订阅列表的接口响应总是发送条件请求，没有变化时服务器只返回304；逐页获取，每两页之间稍微等待一下
+# 订阅列表不保证按照最后回应的时间排序，某一页没有变化不代表之后的页也没有变化，而且只有获取了完整的订阅列表才能知道哪些串已经取消订阅
+# 后台获取的订阅列表不写入搜索索引，只有浏览订阅列表时才写入
+# 写入数据库在单独的一个线程中排队进行，打开串时标记为已查看不会因为等待写锁（例如正在写入搜索索引）而阻塞界面
+# 订阅列表没有变化时逐渐延长获取的间隔，有变化之后恢复，间隔加上随机的抖动，同一个IP下的多个客户端不会同时请求
+
+BACKOFF_FACTOR = 2
+JITTER_RATIO = .2
+PAGE_INTERVAL = 1
+
+# 串号 -> (上次查看时的回应数量, 最新的回应数量)
+counts: dict[int, tuple[int, int]] = {}
+lock = threading.Lock()
+saveExecutor = concurrent.futures.ThreadPoolExecutor(1)
+closed = False
+
+def load():
+    db = xdnmb.cache.connection()
+    if db is None:
+        return
+    try:
+        db.execute(''.join(x.strip() for x in '''
+        CREATE TABLE IF NOT EXISTS "feed" (
+            "tid" INTEGER NOT NULL PRIMARY KEY,
+            "seen" INTEGER NOT NULL,
+            "latest" INTEGER NOT NULL
+        )
+        '''.splitlines()))
+        rows = db.execute('SELECT `tid`, `seen`, `latest` FROM `feed`').fetchall()
+    except sqlite3.Error:
+        return
+    with lock:
+        counts.update((tid, (seen, latest)) for tid, seen, latest in rows)
+    xdnmb.cache.closeHooks.append(close)
+
+def close():
+    # 关闭数据库之前写完已经排队的修改
+    global closed
+    with lock:
+        closed = True
+    saveExecutor.shutdown(wait=True)
+
+def save(changed: dict[int, tuple[int, int]|None]):
+    # None表示已经取消订阅
+    if not changed:
+        return
+    with lock:
+        if not closed:
+            saveExecutor.submit(writeCounts, changed)
+
+def writeCounts(changed: dict[int, tuple[int, int]|None]):
+    db = xdnmb.cache.connection()
+    if db is None:
+        return
+    try:
+        db.execute('BEGIN IMMEDIATE')
+        db.executemany(
+            'INSERT INTO `feed`(`tid`, `seen`, `latest`) VALUES (?, ?, ?) '
+            'ON CONFLICT(`tid`) DO UPDATE SET `seen` = excluded.`seen`, `latest` = excluded.`latest`',
+            ((tid, *c) for tid, c in changed.items() if c is not None),
+        )
+        db.executemany('DELETE FROM `feed` WHERE `tid` = ?', ((tid, ) for tid, c in changed.items() if c is None))
+        db.execute('COMMIT')
+    except sqlite3.Error:
+        if db.in_transaction:
+            db.execute('ROLLBACK')
+
+def update(threads: typing.Iterable[xdnmb.model.Thread], complete: bool = False) -> bool:
+    # 根据订阅列表更新最新的回应数量，第一次出现的串没有新回应，返回是否有变化
+    # complete为True时threads是完整的订阅列表，不在其中的串已经取消订阅
+    changed: dict[int, tuple[int, int]|None] = {}
+    with lock:
+        for t in threads:
+            seen = counts.get(t.tid, (t.replyCount, ))[0]
+            c = (min(seen, t.replyCount), t.replyCount)
+            if counts.get(t.tid) != c:
+                counts[t.tid] = changed[t.tid] = c
+        if complete:
+            present = {t.tid for t in threads}
+            for tid in tuple(counts):
+                if tid not in present:
+                    del counts[tid]
+                    changed[tid] = None
+    save(changed)
+    return bool(changed)
+
+def markSeen(thread: xdnmb.model.Thread):
+    # 打开订阅的串时把最新的回应数量记为已经查看
+    with lock:
+        if thread.tid not in counts:
+            return
+        c = (max(counts[thread.tid][1], thread.replyCount), ) * 2
+        if counts[thread.tid] == c:
+            return
+        counts[thread.tid] = c
+    save({thread.tid: c})
+    xdnmb.globals.bumpUiVersion()
+
+def watch(thread: xdnmb.model.Thread):
+    update((thread, ))
+
+def unwatch(thread: xdnmb.model.Thread):
+    with lock:
+        if counts.pop(thread.tid, None) is None:
+            return
+    save({thread.tid: None})
+    xdnmb.globals.bumpUiVersion()
+
+def unread(tid: int) -> int:
+    c = counts.get(tid)
+    return c[1] - c[0] if c else 0
+
+def totalUnread() -> int:
+    with lock:
+        return sum(latest - seen for seen, latest in counts.values())
+
+async def poll() -> bool:
+    # 获取完整的订阅列表，返回是否有变化
+    loop = asyncio.get_running_loop()
+    threads: list[xdnmb.model.Thread] = []
+    page = 1
+    pageSize = None
+    while True:
+        result = await loop.run_in_executor(None, xdnmb.api.getFeed, page, False)
+        threads.extend(result)
+        # 比第一页少的一页就是最后一页
+        if not result or (pageSize is not None and len(result) < pageSize):
+            break
+        pageSize = pageSize or len(result)
+        page += 1
+        await asyncio.sleep(PAGE_INTERVAL)
+    return update(threads, True)
+
+async def run():
+    config = xdnmb.globals.config['Config']
+    interval = config.getfloat('FeedWatchInterval')
+    maxInterval = max(config.getfloat('FeedWatchMaxInterval'), interval)
+    # 第一次获取没有变化时等待interval
+    delay = interval / BACKOFF_FACTOR
+    while True:
+        try:
+            changed = await poll()
+        except Exception:
+            # 请求失败（包括被限制频率）时同样延长间隔
+            changed = False
+        if changed:
+            delay = interval
+            xdnmb.globals.bumpUiVersion()
+            get_app().invalidate()
+        else:
+            delay = min(delay * BACKOFF_FACTOR, maxInterval)
+        await asyncio.sleep(delay * random.uniform(1 - JITTER_RATIO, 1 + JITTER_RATIO))
+
+def start():
+    config = xdnmb.globals.config['Config']
+    if not config.get('FeedUUID') or config.getfloat('FeedWatchInterval') <= 0:
+        return
+    get_app().create_background_task(run())
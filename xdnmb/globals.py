@@ -1,16 +1,20 @@
 import argparse
+import asyncio
+import concurrent.futures
 import configparser
 import functools
 import os
 import platform
 import re
-import sqlite3
 import sys
 import typing
 import xdnmb.action
 import xdnmb.api
+import xdnmb.cache
 import xdnmb.model
+import xdnmb.profiler
 import xdnmb.util
+import xdnmb.virtuallist
 
 from concurrent.futures import ThreadPoolExecutor
 from prompt_toolkit.application.current import get_app
@@ -48,6 +52,8 @@ try:
 except ImportError:
     COMMIT_HASH = None
 
+xdnmb.profiler.mark('导入模块')
+
 is_mac = platform.system() == "Darwin"
 
 BASE_PATH: str = os.path.realpath(sys._MEIPASS if hasattr(sys, '_MEIPASS') else '')
@@ -60,28 +66,12 @@ XDG_CACHE_PATH = os.path.join(
     os.environ.get('XDG_CACHE_HOME', os.path.expanduser(os.path.join('~', '.cache'))),
     'xdcmd',
 )
+XDG_DATA_PATH = os.path.join(
+    os.environ.get('XDG_DATA_HOME', os.path.expanduser(os.path.join('~', '.local', 'share'))),
+    'xdcmd',
+)
 os.makedirs(XDG_CONFIG_PATH, exist_ok=True)
 os.makedirs(XDG_CACHE_PATH, exist_ok=True)
-LRU_CACHE_DB = sqlite3.connect(os.path.join(XDG_CACHE_PATH, 'lru-cache.db'), isolation_level=None)
-LRU_CACHE_DB.executescript(''.join(x.strip() for x in '''
-PRAGMA journal_mode = wal;
-CREATE TABLE IF NOT EXISTS "cache" (
-    "id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
-    "timestamp" DATE NOT NULL,
-    "key" TEXT NOT NULL,
-    "value" BLOB,
-    CONSTRAINT "const_key" UNIQUE ("key")
-);
-CREATE UNIQUE INDEX IF NOT EXISTS "main"."idx_key"
-ON "cache" (
-    "key"
-);
-CREATE INDEX IF NOT EXISTS "main"."idx_timestamp"
-ON "cache" (
-    "timestamp"
-);
-'''.splitlines()))
-LRU_CACHE_DB_CURSOR = LRU_CACHE_DB.cursor()
 
 argparser = argparse.ArgumentParser(
     description='X岛匿名版（https://nmbxd.com/）命令行客户端',
@@ -93,6 +83,69 @@ argparser.add_argument(
     default=os.path.join(XDG_CONFIG_PATH, 'config.ini'),
     help='配置文件路径',
 )
+argparser.add_argument(
+    '--archive',
+    dest='archive',
+    type=int,
+    metavar='TID',
+    help='存档指定的串（不需要输入 No.），完成后退出',
+)
+argparser.add_argument(
+    '--archive-path',
+    dest='archivePath',
+    help='存档保存的目录，默认使用配置文件中的 ArchivePath',
+)
+argparser.add_argument(
+    '--archive-images',
+    dest='archiveImages',
+    action='store_true',
+    help='存档时同时下载缩略图和原图',
+)
+argparser.add_argument(
+    '--archive-concurrency',
+    dest='archiveConcurrency',
+    type=int,
+    help='存档时同时获取的页面数量，默认使用配置文件中的 ArchiveConcurrency',
+)
+argparser.add_argument(
+    '--profile-startup',
+    dest='profileStartup',
+    action='store_true',
+    help='输出启动过程中各个阶段的耗时，显示第一帧后退出',
+)
+argparser.add_argument(
+    '--cache-stats',
+    dest='cacheStats',
+    action='store_true',
+    help='输出缓存的占用和历次运行累计的命中率等统计数据',
+)
+argparser.add_argument(
+    '--cache-prune',
+    dest='cachePrune',
+    action='store_true',
+    help='立即把超出容量上限的缓存淘汰掉并收缩缓存数据库',
+)
+argparser.add_argument(
+    '--cache-clear',
+    dest='cacheClear',
+    nargs='?',
+    const='',
+    metavar='NAMESPACE',
+    help='清除指定命名空间（http、chafa、thumb）的缓存，不指定则清除所有的缓存',
+)
+argparser.add_argument(
+    '--search',
+    dest='search',
+    metavar='QUERY',
+    help='在浏览过的串和回应中搜索（空格分隔的关键词需要同时出现），输出结果后退出',
+)
+argparser.add_argument(
+    '--search-limit',
+    dest='searchLimit',
+    type=int,
+    default=20,
+    help='搜索结果的最大数量',
+)
 args = argparser.parse_args()
 
 config = configparser.RawConfigParser()
@@ -100,15 +153,38 @@ config['DEFAULT'] = {
     'CDNPath': '',
     'Cookie': '',
     'FeedUUID': '',
+    'FeedWatchInterval': 120,
+    'FeedWatchMaxInterval': 1800,
     'Monochrome': False,
     'Simplify': False,
     'ImagePreview': True,
     'ImagePreviewWidth': 24,
     'ImagePreviewHeight': 6,
+    'ImagePreviewTimeout': 15,
     'HideTips': False,
     'HideCookie': False,
     'PoOnly': False,
     'IgnoreNotice': False,
+    'PrefetchDepth': 1,
+    'PrefetchPrevious': False,
+    'PrefetchIdleOnly': True,
+    'PrefetchThumbnail': False,
+    'PrefetchReferences': True,
+    'ArchivePath': '',
+    'ArchiveImages': False,
+    'ArchiveConcurrency': 4,
+    'ContinuousScroll': False,
+    'ContinuousScrollMaxPages': 5,
+    'AutoRefreshInterval': 0,
+    'HttpCacheSize': 32,
+    'ImagePreviewCacheSize': 64,
+    'ThumbnailCacheSize': 64,
+    'SearchIndex': True,
+    'SearchIndexSize': 500000,
+    'ImageRenderer': 'auto',
+    'ChafaConcurrency': 2,
+    'ChafaWork': 9,
+    'ChafaOptimize': 9,
 }
 config['Config'] = {}
 configLoaded = False
@@ -127,12 +203,44 @@ if not configLoaded:
     with open(os.path.join(XDG_CONFIG_PATH, 'config.ini'), 'w', encoding='utf-8') as f:
         config.write(f)
 
+# 没有设置CDNPath时，在启动时和版面列表一起获取（xdnmb.action.loadForumGroup）
 if config['Config'].get('CDNPath'):
     xdnmb.api.CDN_PATH = config['Config'].get('CDNPath')
-else:
-    xdnmb.api.CDN_PATH = xdnmb.api.getCDNPath()
 if config['Config'].get('Cookie'):
     xdnmb.api.session.cookies.set('userhash', config['Config'].get('Cookie'))
+xdnmb.profiler.mark('读取配置')
+
+# 缓存的容量上限在配置文件中以MiB为单位
+xdnmb.cache.budgets['http'] = config['Config'].getint('HttpCacheSize') * 1048576
+xdnmb.cache.budgets['chafa'] = config['Config'].getint('ImagePreviewCacheSize') * 1048576
+xdnmb.cache.budgets['thumb'] = config['Config'].getint('ThumbnailCacheSize') * 1048576
+xdnmb.cache.connect(os.path.join(XDG_CACHE_PATH, 'lru-cache.db'))
+xdnmb.profiler.mark('打开缓存数据库')
+
+class ContinuousScrollablePane(xdnmb.virtuallist.VirtualList):
+    # 每次渲染后检查bottomWindow（底部的翻页按钮）是否已经接近可见区域，用于连续滚动模式
+    def __init__(
+        self,
+        getChildren: typing.Callable[[], typing.Sequence[Container]],
+        bottomWindow: Window,
+        onNearBottom: typing.Callable[[], None],
+        **kwargs,
+    ) -> None:
+        self.bottomWindow = bottomWindow
+        self.onNearBottom = onNearBottom
+        super().__init__(getChildren, **kwargs)
+
+    def write_to_screen(self, screen, mouse_handlers, write_position, parent_style, erase_bg, z_index):
+        super().write_to_screen(screen, mouse_handlers, write_position, parent_style, erase_bg, z_index)
+        # 翻页按钮不一定会被渲染，直接根据它在列表中的位置判断
+        offset = self.itemOffset(self.bottomWindow)
+        if offset is not None and offset < self.vertical_scroll + write_position.height * 2:
+            self.onNearBottom()
+
+    def scrollPastRemoved(self, removed: typing.Sequence):
+        # 从顶部移除内容时向上滚动相同的高度，保持可见区域的内容不变
+        height = sum(self.itemHeight(c) + self.padding for c in removed)
+        self.vertical_scroll = max(self.vertical_scroll - height, 0)
 
 class PathCompleterWithWords(PathCompleter):
     def __init__(
@@ -279,6 +387,7 @@ replyCompleterMeta = {
     ">>No.": '引用',
 }
 
+# 凉宫Tips娘的表情包是相对于CDN地址的路径，发送时再拼接（xdnmb.api.postThread）
 STICKERS: dict[str, str] = {f'${k}$': v for k, v in ({
     '芦苇娘:|∀ﾟ': 'https://gcore.jsdelivr.net/gh/TransparentLC/xdcmd@reedgirl-mono/OIo6BwF2.gif',
     '芦苇娘:(´ﾟДﾟ`)': 'https://gcore.jsdelivr.net/gh/TransparentLC/xdcmd@reedgirl-mono/zJ2VBLNr.gif',
@@ -418,32 +527,75 @@ STICKERS: dict[str, str] = {f'${k}$': v for k, v in ({
     '彩色芦苇娘:⊂彡☆))∀`)': 'https://gcore.jsdelivr.net/gh/TransparentLC/xdcmd@reedgirl-colored/aIUu872T.gif',
     '彩色芦苇娘:(´∀((☆ミつ': 'https://gcore.jsdelivr.net/gh/TransparentLC/xdcmd@reedgirl-colored/GlfdxYg3.gif',
     '彩色芦苇娘:( ´_ゝ`)旦': 'https://gcore.jsdelivr.net/gh/TransparentLC/xdcmd@reedgirl-colored/Bj7189TU.gif',
-    '凉宫Tips娘:害羞': xdnmb.api.CDN_PATH + 'image/2022-08-21/6302122aac4a1.png',
-    '凉宫Tips娘:怒': xdnmb.api.CDN_PATH + 'image/2022-08-21/6302126774399.png',
-    '凉宫Tips娘:无语': xdnmb.api.CDN_PATH + 'image/2022-08-21/63021285e5e32.png',
-    '凉宫Tips娘:kira': xdnmb.api.CDN_PATH + 'image/2022-08-21/6302129d68127.png',
-    '凉宫Tips娘:尴尬': xdnmb.api.CDN_PATH + 'image/2022-08-21/630212b85961f.png',
-    '凉宫Tips娘:晕': xdnmb.api.CDN_PATH + 'image/2022-08-21/630212d5c3b84.png',
-    '凉宫Tips娘:汗': xdnmb.api.CDN_PATH + 'image/2022-08-21/630212ed9616d.png',
-    '凉宫Tips娘:咋回事': xdnmb.api.CDN_PATH + 'image/2022-08-21/6302130783f36.png',
-    '凉宫Tips娘:笑': xdnmb.api.CDN_PATH + 'image/2022-08-21/63021334de5bb.png',
-    '凉宫Tips娘:弱智': xdnmb.api.CDN_PATH + 'image/2022-08-21/63021352a351f.png',
-    '凉宫Tips娘:指责': xdnmb.api.CDN_PATH + 'image/2022-08-21/6302137130c0b.png',
-    '凉宫Tips娘:右看': xdnmb.api.CDN_PATH + 'image/2022-08-21/6302138e9718c.png',
-    '凉宫Tips娘:囧': xdnmb.api.CDN_PATH + 'image/2022-08-21/630213a9d0aa7.png',
-    '凉宫Tips娘:小哭': xdnmb.api.CDN_PATH + 'image/2022-08-21/630213c95e30d.png',
-    '凉宫Tips娘:大哭': xdnmb.api.CDN_PATH + 'image/2022-08-21/630212010be9d.png',
-    '凉宫Tips娘:睡': xdnmb.api.CDN_PATH + 'image/2022-08-21/63021212bebe9.png',
+    '凉宫Tips娘:害羞': 'image/2022-08-21/6302122aac4a1.png',
+    '凉宫Tips娘:怒': 'image/2022-08-21/6302126774399.png',
+    '凉宫Tips娘:无语': 'image/2022-08-21/63021285e5e32.png',
+    '凉宫Tips娘:kira': 'image/2022-08-21/6302129d68127.png',
+    '凉宫Tips娘:尴尬': 'image/2022-08-21/630212b85961f.png',
+    '凉宫Tips娘:晕': 'image/2022-08-21/630212d5c3b84.png',
+    '凉宫Tips娘:汗': 'image/2022-08-21/630212ed9616d.png',
+    '凉宫Tips娘:咋回事': 'image/2022-08-21/6302130783f36.png',
+    '凉宫Tips娘:笑': 'image/2022-08-21/63021334de5bb.png',
+    '凉宫Tips娘:弱智': 'image/2022-08-21/63021352a351f.png',
+    '凉宫Tips娘:指责': 'image/2022-08-21/6302137130c0b.png',
+    '凉宫Tips娘:右看': 'image/2022-08-21/6302138e9718c.png',
+    '凉宫Tips娘:囧': 'image/2022-08-21/630213a9d0aa7.png',
+    '凉宫Tips娘:小哭': 'image/2022-08-21/630213c95e30d.png',
+    '凉宫Tips娘:大哭': 'image/2022-08-21/630212010be9d.png',
+    '凉宫Tips娘:睡': 'image/2022-08-21/63021212bebe9.png',
 }).items()}
 
 forumGroups: list[xdnmb.model.ForumGroup] = []
 forums: list[xdnmb.model.Forum] = []
+# 按版面ID和名称查找版面，时间线的ID和版面的ID是分开的，所以这里只有版面
+forumIndex: dict[int, xdnmb.model.Forum] = {}
+forumNameIndex: dict[str, xdnmb.model.Forum] = {}
 forum: xdnmb.model.Forum = None
 forumPage: int = None
 forumThreads: list[xdnmb.model.Thread] = []
+# 当前显示的页面及每一页的串/回应数量，不使用连续滚动模式时只有一页
+forumResidentPages: list[tuple[int, int]] = []
+forumLastPageReached = False
 thread: xdnmb.model.Thread = None
 threadPage: int = None
+threadResidentPages: list[tuple[int, int]] = []
+# 版面和串中的引用关系，分开保存，从串返回版面时不需要重新建立
+forumReferenceGraph = xdnmb.model.ReferenceGraph()
+threadReferenceGraph = xdnmb.model.ReferenceGraph()
+
+def currentReferenceGraph() -> xdnmb.model.ReferenceGraph:
+    return threadReferenceGraph if thread else forumReferenceGraph
+
 showReplyForm = False
+loadingTask: asyncio.Task|None = None
+loadingFrame = 0
+LOADING_SPINNER = '⠋⠙⠹⠸⠼⠴⠦⠧⠇⠏'
+prefetchTask: asyncio.Task|None = None
+archiveTask: asyncio.Task|None = None
+archiveProgress: tuple[int, int] = (0, 0)
+
+# 界面状态的版本号，修改上面这些会影响界面的状态之后需要调用bumpUiVersion()
+# 根据这些状态创建的容器会一直复用到版本号或者终端的大小发生变化为止，不需要在每次按键、移动光标导致重绘时重新创建
+uiVersion = 0
+
+def bumpUiVersion():
+    global uiVersion
+    uiVersion += 1
+
+def memoizeUi(func: typing.Callable[[], typing.Any]) -> typing.Callable[[], typing.Any]:
+    key = None
+    result = None
+
+    @functools.wraps(func)
+    def wrapper():
+        nonlocal key, result
+        k = (uiVersion, get_app().renderer.output.get_size())
+        if k != key:
+            key = k
+            result = func()
+        return result
+
+    return wrapper
 
 homepageLabelText = '\n'.join((
     '',
@@ -463,13 +615,7 @@ homepageLabelText = '\n'.join((
     'https://github.com/TransparentLC/xdcmd',
     '',
 ))
-try:
-    if not config['Config'].getboolean('IgnoreNotice'):
-        notice = xdnmb.api.session.get('https://nmb.ovear.info/nmb-notice.json').json()
-        if notice['enable']:
-            homepageLabelText += f'\n== 公告 ==\n{str(notice["date"])[0:4]}-{str(notice["date"])[4:6]}-{str(notice["date"])[6:8]}\n\n{xdnmb.util.stripHTML(notice["content"])}'
-except:
-    pass
+# 公告在启动后由xdnmb.action.loadNotice在后台获取
 homepageLabel = Label(text=ANSI(homepageLabelText), align=WindowAlign.CENTER)
 forumBottomButton = Button('按 PgUp(h)/PgDn(l) 翻页')
 
@@ -488,40 +634,55 @@ def postThread():
         replyImageTextarea.text,
         replyWaterCheckbox.checked,
     )
+    xdnmb.api.pageCacheClear()
     global showReplyForm
     showReplyForm = False
+    bumpUiVersion()
     replyNameTextarea.text = ''
     replyTitleTextarea.text = ''
     replyContentTextarea.text = ''
     replyImageTextarea.text = ''
     xdnmb.util.floatAlert('发串', '发表成功')
 
-replyNameTextarea = TextArea(multiline=False)
-replyTitleTextarea = TextArea(multiline=False)
-replyContentTextarea = TextArea(
-    multiline=True,
-    height=8,
-)
-replyImageTextarea = TextArea(
-    multiline=False,
-    completer=PathCompleterWithWords(words=[k for k in STICKERS]),
-)
-replyWaterCheckbox = Checkbox('水印')
-replySendButton = Button('发送', handler=postThread)
-for textarea in (
-    replyNameTextarea,
-    replyTitleTextarea,
-    replyContentTextarea,
-    replyImageTextarea,
-):
-    textarea.window.style = functools.partial(
-        lambda w: 'class:text-area class:form-textarea' +
-        (' bg:#dddddd' if get_app().layout.current_window == w else ''),
-        textarea.window,
+# 发串/回复的表单在第一次打开时才创建
+replyNameTextarea: TextArea = None
+replyTitleTextarea: TextArea = None
+replyContentTextarea: TextArea = None
+replyImageTextarea: TextArea = None
+replyWaterCheckbox: Checkbox = None
+replySendButton: Button = None
+
+def createReplyForm():
+    global replyNameTextarea, replyTitleTextarea, replyContentTextarea, replyImageTextarea, replyWaterCheckbox, replySendButton
+    if replySendButton:
+        return
+    replyNameTextarea = TextArea(multiline=False)
+    replyTitleTextarea = TextArea(multiline=False)
+    replyContentTextarea = TextArea(
+        multiline=True,
+        height=8,
+    )
+    replyImageTextarea = TextArea(
+        multiline=False,
+        completer=PathCompleterWithWords(words=[k for k in STICKERS]),
     )
+    replyWaterCheckbox = Checkbox('水印')
+    replySendButton = Button('发送', handler=postThread)
+    for textarea in (
+        replyNameTextarea,
+        replyTitleTextarea,
+        replyContentTextarea,
+        replyImageTextarea,
+    ):
+        textarea.window.style = functools.partial(
+            lambda w: 'class:text-area class:form-textarea' +
+            (' bg:#dddddd' if get_app().layout.current_window == w else ''),
+            textarea.window,
+        )
 
 imagePreloadExecutor = ThreadPoolExecutor()
 
+@memoizeUi
 def forumGroupControlContainer() -> Container:
     return HSplit(
         forumGroups if forumGroups else tuple(),
@@ -529,9 +690,11 @@ def forumGroupControlContainer() -> Container:
         style='class:nav',
     )
 
-def forumContentControlContainer() -> Container:
+@memoizeUi
+def forumContentControlChildren() -> typing.Sequence[Container]:
+    # 每一项之间空一行，由forumContentControl负责只渲染可见的部分
     if showReplyForm:
-        children = (
+        return (HSplit((
             VSplit((
                 Label(text='名称', width=8, style='class:form-label'),
                 replyNameTextarea,
@@ -564,69 +727,60 @@ def forumContentControlContainer() -> Container:
                     '芦苇娘人物形象原作者为 ddzx1323，表情包由 Anime801 制作。'
                     '凉宫 Tips 娘人物形象原作者为饼干为“iVUmXcE”的肥肥（No.50666176），表情包由饼干为“9QybryU”的肥肥制作（No.51412777）。\n'
             )),
-        )
+        )),)
     elif not forum:
-        children = (
+        return (
             homepageLabel,
         )
     elif not thread:
-        children = (
+        return (
             *forumThreads,
             forumBottomButton.window,
         )
     else:
-        children = (
-            thread,
+        return (
+            thread.headContainer,
+            *thread.visibleReplies,
             forumBottomButton.window,
         )
 
-    preload: list[xdnmb.model.Reply|xdnmb.model.Thread] = []
-    for c in children:
-        if (
-            isinstance(c, xdnmb.model.Reply)
-            and c.imagePreviewAvailable
-            and not getattr(c, 'imagePreviewLoaded', None)
-        ):
-            preload.append(c)
-            if isinstance(c, xdnmb.model.Thread) and c.replies:
-                for r in c.replies:
-                    if (
-                        r.imagePreviewAvailable
-                        and not getattr(r, 'imagePreviewLoaded', None)
-                    ):
-                        preload.append(r)
-    preloadIter = imagePreloadExecutor.map(lambda c: c.imagePreviewLabel, preload)
-    while True:
-        try:
-            next(preloadIter)
-        except StopIteration:
-            break
-        except:
-            pass
-
-    return HSplit(
-        children,
-        style='class:content',
-        width=get_app().renderer.output.get_size().columns - 23,
-    )
-
+@memoizeUi
 def titleControlContainer() -> Container:
+    import xdnmb.feedwatch
     title = 'X岛匿名版'
     if thread and threadPage:
-        title += f' - {thread.forum.name} - No.{thread.tid} - 第 {threadPage}/{thread.maxPage} 页'
+        pages = f'{threadResidentPages[0][0]}-{threadPage}' if threadResidentPages[0][0] != threadPage else threadPage
+        if thread.forum:
+            title += f' - {thread.forum.name}'
+        title += f' - No.{thread.tid} - 第 {pages}/{thread.maxPage} 页'
         if showReplyForm:
             title += ' - 回复'
     elif forum and forumPage:
-        title += f' - {forum.name} - 第 {forumPage} 页'
+        pages = f'{forumResidentPages[0][0]}-{forumPage}' if forumResidentPages[0][0] != forumPage else forumPage
+        title += f' - {forum.name} - 第 {pages} 页'
         if showReplyForm:
             title += ' - 发串'
     else:
         title += ' - 写作绅士，读作丧尸'
+    unread = xdnmb.feedwatch.totalUnread()
+    if unread:
+        title += f' - 订阅的串有 {unread} 篇新回应'
+    if archiveTask:
+        title += f' - 存档中 {archiveProgress[0]}/{archiveProgress[1]}'
+    if loadingTask:
+        title += f' - {LOADING_SPINNER[loadingFrame % len(LOADING_SPINNER)]} 加载中'
     return Window(content=FormattedTextControl(title), height=1)
 
 titleControl = DynamicContainer(titleControlContainer)
 forumGroupControl = ScrollablePane(DynamicContainer(forumGroupControlContainer))
-forumContentControl = ScrollablePane(DynamicContainer(forumContentControlContainer))
+forumContentControl = ContinuousScrollablePane(
+    forumContentControlChildren,
+    forumBottomButton.window,
+    xdnmb.action.loadMore,
+    padding=1,
+    width=lambda: get_app().renderer.output.get_size().columns - 23,
+    style='class:content',
+)
 
 container = FloatContainer(
     HSplit((
@@ -662,6 +816,16 @@ container = FloatContainer(
                     ('Tab', '将光标指向版面/串/悬浮窗按钮'),
                 )
             )),
+            VSplit(tuple(
+                Label(text=HTML('<content-rev>[{0}]</content-rev>{1}').format(k, d), style='class:content')
+                for k, d in (
+                    ('Ctrl+D' if is_mac else 'Alt+D', '存档串'),
+                    ('Ctrl+T' if is_mac else 'Alt+T', '缓存统计'),
+                    ('Ctrl+O' if is_mac else 'Alt+O', '查看回应'),
+                    ('Ctrl+F' if is_mac else 'Alt+F', '搜索'),
+                    ('F5/' + ('Ctrl+G' if is_mac else 'Alt+R'), '刷新串'),
+                )
+            )),
         )),
     )),
     [
@@ -680,38 +844,41 @@ condition = Condition(lambda: not (len(container.floats) > 1 or showReplyForm))
 @keyBinding.add('up', filter=condition)
 @keyBinding.add('k', filter=condition)
 def _(e):
-    focus_previous(e)
+    if not forumContentControl.focusNext(-1):
+        focus_previous(e)
 
 @keyBinding.add('down', filter=condition)
 @keyBinding.add('j', filter=condition)
 def _(e):
-    focus_next(e)
+    if not forumContentControl.focusNext(1):
+        focus_next(e)
 
 @ (keyBinding.add('c-e') if is_mac else keyBinding.add('escape', 'e'))
 def _(e): 
-    LRU_CACHE_DB.close(),
+    xdnmb.cache.close(),
     get_app().exit(),
 
+@ (keyBinding.add('c-t') if is_mac else keyBinding.add('escape', 't'))
+def _(e: KeyPressEvent):
+    xdnmb.util.floatAlert('缓存统计', xdnmb.cache.formatStats() + '\n' + xdnmb.util.formatRenderStats())
+
 @keyBinding.add('pageup')
 @keyBinding.add('h', filter=condition)
 def _(e: KeyPressEvent):
     if not forum:
         return
     elif not thread:
-        global forumPage
-        if forumPage <= 1:
+        page = forumResidentPages[0][0]
+        if page <= 1:
             xdnmb.util.floatAlert('别翻啦', f'这已经是第 1 页了⊂彡☆))∀`)')
             return
-        xdnmb.action.loadForum(forum, forumPage - 1)
-        xdnmb.util.focusToButton(None, xdnmb.model.ButtonType.Thread)
+        xdnmb.action.loadForum(forum, page - 1)
     else:
-        global threadPage
-        if threadPage <= 1:
+        page = threadResidentPages[0][0]
+        if page <= 1:
             xdnmb.util.floatAlert('别翻啦', f'这已经是第 1 页了⊂彡☆))∀`)')
             return
-        xdnmb.action.loadThread(thread, threadPage - 1)
-        xdnmb.util.focusToButton(None, xdnmb.model.ButtonType.Forum)
-    xdnmb.util.focusToButton(None, xdnmb.model.ButtonType.Forum)
+        xdnmb.action.loadThread(thread, page - 1)
 
 @keyBinding.add('pagedown')
 @keyBinding.add('l', filter=condition)
@@ -747,17 +914,21 @@ def _(e: KeyPressEvent):
 def _(e: KeyPressEvent):
     if not forum:
         return
+    rulesForum = thread.forum if thread and thread.forum else forum
     xdnmb.util.floatAlert(
-        f'{thread.forum.name if thread else forum.name}版规',
-        thread.forum.notice if thread else forum.notice,
+        f'{rulesForum.name}版规',
+        rulesForum.notice,
     )
 
 @ (keyBinding.add('c-q') if is_mac else keyBinding.add('escape', 'q'))
 def _(e: KeyPressEvent):
-    global thread
+    global thread, threadReferenceGraph
     if not thread or len(container.floats) > 1 or showReplyForm:
         return
+    xdnmb.util.cancelLoading()
     thread = None
+    threadReferenceGraph = xdnmb.model.ReferenceGraph()
+    bumpUiVersion()
     forumContentControl.vertical_scroll = 0
     xdnmb.util.focusToButton(None, xdnmb.model.ButtonType.Forum)
 
@@ -775,18 +946,13 @@ def _(e: KeyPressEvent):
         xdnmb.action.loadThread(thread, s)
     xdnmb.util.floatPrompt('跳转页面', f'请输入页数（共 {thread.maxPage} 页）：', callback)
 
-@ (keyBinding.add('c-l') if is_mac else keyBinding.add('escape', 'l'))
-def _(e: KeyPressEvent):
+def showReference(tid: int):
     @xdnmb.util.floatAlertExceptionCatch
-    def callback(s: str):
-        try:
-            s = int(s.strip())
-        except ValueError:
-            return
+    def show(future: concurrent.futures.Future):
         b = Button('确定')
         d = Float(Dialog(
             title='查看引用',
-            body=xdnmb.api.getReference(s),
+            body=future.result(),
             buttons=(
                 b,
             ),
@@ -798,22 +964,26 @@ def _(e: KeyPressEvent):
         container.floats.append(d)
         layout.focus(b.window)
 
-    refw = set()
-    refm = {}
-    if thread:
-        refw.update(thread.references)
-        refm.update({str(k): f'被“{thread.summary(24)}”引用' for k in thread.references})
-        for r in thread.replies:
-            refw.update(r.references)
-            refm.update({str(k): f'被“{r.summary(24)}”引用' for k in r.references})
-    elif forum:
-        for t in forumThreads:
-            refw.update(t.references)
-            refm.update({str(k): f'被“{t.summary(24)}”引用' for k in t.references})
-    refw = list(refw)
-    refw.sort()
-    refw = list(str(x) for x in refw)
+    # 已经预加载的引用直接显示，否则在后台等待请求完成，不阻塞界面
+    future = xdnmb.api.getReferenceFuture(tid)
+    if future.done():
+        show(future)
+        return
+    async def wait():
+        await asyncio.wait((asyncio.wrap_future(future),))
+        show(future)
+    get_app().create_background_task(wait())
+
+@ (keyBinding.add('c-l') if is_mac else keyBinding.add('escape', 'l'))
+def _(e: KeyPressEvent):
+    def callback(s: str):
+        try:
+            s = int(s.strip())
+        except ValueError:
+            return
+        showReference(s)
 
+    refw, refm = currentReferenceGraph().referenceCompletion()
     xdnmb.util.floatPrompt(
         '查看引用',
         f'请输入串号：\n（不需要输入 No.）',
@@ -821,29 +991,80 @@ def _(e: KeyPressEvent):
         WordCompleter(refw, meta_dict=refm),
     )
 
+@ (keyBinding.add('c-o') if is_mac else keyBinding.add('escape', 'o'))
+def _(e: KeyPressEvent):
+    if not forum or len(container.floats) > 1 or showReplyForm:
+        return
+    # 光标所在的串/回应，光标不在串/回应上时在串中使用串本身
+    tid: int|None = getattr(e.app.layout.current_window, 'tid', None)
+    if tid is None and thread:
+        tid = thread.tid
+    if tid is None:
+        return
+    replies = currentReferenceGraph().repliesTo(tid)
+    if not replies:
+        xdnmb.util.floatAlert('查看回应', f'当前页面中没有引用 No.{tid} 的串/回应')
+        return
+
+    xdnmb.util.floatSelect(
+        f'引用了 No.{tid} 的串/回应（{len(replies)}）',
+        tuple((f'No.{r.tid} {r.summary(40)}', functools.partial(xdnmb.action.focusPost, r)) for r in replies),
+    )
+
+@ (keyBinding.add('c-f') if is_mac else keyBinding.add('escape', 'f'))
+def _(e: KeyPressEvent):
+    import xdnmb.search
+    if len(container.floats) > 1 or showReplyForm:
+        return
+
+    @xdnmb.util.floatAlertExceptionCatch
+    def callback(s: str):
+        if not s.split():
+            return
+        results = xdnmb.search.search(s)
+        if not results:
+            xdnmb.util.floatAlert('搜索', f'没有找到包含“{s}”的串/回应')
+            return
+        xdnmb.util.floatSelect(
+            f'搜索“{s}”（{len(results)}）',
+            tuple(
+                (
+                    f'No.{r.tid} {r.time:%Y-%m-%d} {r.snippet(s.split(), 48)}',
+                    (
+                        functools.partial(showReference, r.tid)
+                        if r.thread is None else
+                        functools.partial(xdnmb.action.loadThread, r.thread, r.page or 1, r.tid)
+                    ),
+                )
+                for r in results
+            ),
+        )
+
+    xdnmb.util.floatPrompt('搜索', '请输入关键词：\n（在浏览过的串中搜索）', callback)
+
+@keyBinding.add('f5')
+@ (keyBinding.add('c-g') if is_mac else keyBinding.add('escape', 'r'))
+def _(e: KeyPressEvent):
+    if not thread or len(container.floats) > 1 or showReplyForm:
+        return
+    xdnmb.action.refreshThread()
+
 @ (keyBinding.add('c-n') if is_mac else keyBinding.add('escape', 'n'))
 def _(e: KeyPressEvent):
     if (not forum or isinstance(forum, xdnmb.model.Timeline)) and not thread:
         return
     global showReplyForm
+    createReplyForm()
     showReplyForm = not showReplyForm
+    bumpUiVersion()
     forumContentControl.vertical_scroll = 0
     if showReplyForm:
-        cw = list(replyCompleterWords)
-        cm = replyCompleterMeta.copy()
-        if thread:
-            cw.append(f'>>No.{thread.tid}')
-            cm[f'>>No.{thread.tid}'] = f'引用：“{thread.summary(24)}”'
-            for r in thread.replies:
-                cw.append(f'>>No.{r.tid}')
-                cm[f'>>No.{r.tid}'] = f'引用：“{r.summary(24)}”'
-        elif forum:
-            for t in forumThreads:
-                cw.append(f'>>No.{t.tid}')
-                cm[f'>>No.{t.tid}'] = f'引用：“{t.summary(24)}”'
+        pw, pm = currentReferenceGraph().replyCompletion()
+        cw = [*replyCompleterWords, *pw]
+        cm = {**replyCompleterMeta, **pm}
 
         replyContentTextarea.completer = WordCompleter(cw, meta_dict=cm)
-        layout.focus(replyContentTextarea)
+        forumContentControl.focus(replyContentTextarea)
     else:
         xdnmb.util.focusToButton(None, xdnmb.model.ButtonType.Forum)
 
@@ -860,11 +1081,7 @@ def _(e: KeyPressEvent):
     if tid is None:
         return
 
-    watchroom: xdnmb.model.Forum = None
-    for f in forums:
-        if f.name == '值班室':
-            watchroom = f
-            break
+    watchroom = forumNameIndex.get('值班室')
     if watchroom is None:
         xdnmb.util.floatAlert('错误', '找不到值班室 (*ﾟーﾟ)')
         return
@@ -906,15 +1123,69 @@ def _(e: KeyPressEvent):
 @ (keyBinding.add('c-s') if is_mac else keyBinding.add('escape', '='))
 @xdnmb.util.floatAlertExceptionCatch
 def _(e: KeyPressEvent):
+    import xdnmb.feedwatch
     if not thread:
         return
     xdnmb.api.addFeed(thread)
+    xdnmb.api.pageCacheClear()
+    xdnmb.feedwatch.watch(thread)
     xdnmb.util.floatAlert('订阅', '订阅大成功→_→')
 
 @ (keyBinding.add('c-u') if is_mac else keyBinding.add('escape', '-'))
 @xdnmb.util.floatAlertExceptionCatch
 def _(e: KeyPressEvent):
+    import xdnmb.feedwatch
     if not thread:
         return
     xdnmb.api.delFeed(thread)
+    xdnmb.api.pageCacheClear()
+    xdnmb.feedwatch.unwatch(thread)
     xdnmb.util.floatAlert('订阅', '取消订阅大成功←_←')
+
+@ (keyBinding.add('c-d') if is_mac else keyBinding.add('escape', 'd'))
+def _(e: KeyPressEvent):
+    global archiveTask, archiveProgress
+    import xdnmb.archive
+    if not thread or archiveTask:
+        return
+    tid = thread.tid
+
+    def progress(done: int, total: int):
+        global archiveProgress
+        archiveProgress = (done, total)
+        bumpUiVersion()
+        e.app.invalidate()
+
+    async def task():
+        global archiveTask
+        loop = asyncio.get_running_loop()
+        try:
+            threadPath, failedPages, failedImages = await loop.run_in_executor(
+                None,
+                xdnmb.archive.archiveThread,
+                tid,
+                xdnmb.archive.archivePath(),
+                config['Config'].getboolean('ArchiveImages'),
+                config['Config'].getint('ArchiveConcurrency'),
+                # 存档时在线程池中调用，回到事件循环中再修改界面的状态
+                lambda done, total: loop.call_soon_threadsafe(progress, done, total),
+            )
+        except Exception as ex:
+            xdnmb.util.floatAlert('存档失败', f'{type(ex).__name__}: {ex}')
+        else:
+            message = f'No.{tid} 已保存到：\n{threadPath}'
+            if failedPages:
+                message += f'\n\n以下页面获取失败，再次存档可以继续：{", ".join(str(x) for x in failedPages)}'
+            if failedImages:
+                message += f'\n\n{len(failedImages)} 张图片下载失败'
+            xdnmb.util.floatAlert('存档', message)
+        finally:
+            archiveTask = None
+            bumpUiVersion()
+            e.app.invalidate()
+
+    archiveProgress = (0, thread.maxPage)
+    archiveTask = e.app.create_background_task(task())
+    bumpUiVersion()
+
+xdnmb.profiler.mark('创建界面')
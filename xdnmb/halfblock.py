@@ -0,0 +1,69 @@
+import io
+
+try:
+    import numpy
+    from PIL import Image
+except ImportError:
+    numpy = None
+    Image = None
+
+# 不依赖chafa的缩略图预览（ImageRenderer = builtin），需要安装Pillow和NumPy
+# 用Pillow解码和缩小图片，每个字符用上半块“▀”表示上下两个像素，前景色是上方的像素，背景色是下方的像素
+# 输出的格式和chafa相同：24位色的ANSI转义序列，每行以重置属性结尾，行与行之间用换行分隔
+# 和chafa一样假设字符的高度是宽度的两倍，这样每个像素都是正方形的
+# 半透明的像素按照alpha是否超过一半当作完全透明或者完全不透明，透明的部分使用终端默认的背景色
+
+def available() -> bool:
+    return Image is not None
+
+def renderHalfBlock(data: bytes, width: int, height: int) -> str:
+    image = Image.open(io.BytesIO(data))
+    # JPEG可以在解码时直接按1/2、1/4、1/8缩小，比解码完整的图片再缩小快很多
+    image.draft('RGB', (width, height * 2))
+    image = image.convert('RGBA')
+    scale = min(width / image.width, height * 2 / image.height)
+    pixels = numpy.asarray(image.resize(
+        (max(1, round(image.width * scale)), max(1, round(image.height * scale))),
+        Image.Resampling.BOX,
+        reducing_gap=2.0,
+    ))
+    if pixels.shape[0] & 1:
+        # 最后一行只有上半部分，下半部分当作透明
+        pixels = numpy.concatenate((pixels, numpy.zeros((1, *pixels.shape[1:]), pixels.dtype)))
+
+    opaque = pixels[..., 3] >= 128
+    colors = (
+        (pixels[..., 0].astype(numpy.int32) << 16)
+        | (pixels[..., 1].astype(numpy.int32) << 8)
+        | pixels[..., 2]
+    )
+    top, bottom = colors[0::2], colors[1::2]
+    topOpaque, bottomOpaque = opaque[0::2], opaque[1::2]
+    bothOpaque = topOpaque & bottomOpaque
+    # 上下两个像素颜色相同或者都透明时输出只有背景色的空格，前景色保持不变（-1）
+    blank = (bothOpaque & (top == bottom)) | ~(topOpaque | bottomOpaque)
+    # 只有下方的像素不透明时使用下半块“▄”，前景色是下方的像素
+    chars = numpy.where(blank, ' ', numpy.where(topOpaque, '▀', '▄'))
+    fg = numpy.where(blank, -1, numpy.where(topOpaque, top, bottom))
+    # 背景色为-1表示使用默认的背景色
+    bg = numpy.where(bothOpaque, bottom, -1)
+
+    lines = []
+    for charRow, fgRow, bgRow in zip(chars.tolist(), fg.tolist(), bg.tolist()):
+        parts = []
+        currentFg = -1
+        currentBg = -1
+        for c, f, b in zip(charRow, fgRow, bgRow):
+            sgr = []
+            if f != -1 and f != currentFg:
+                sgr.append(f'38;2;{f >> 16};{f >> 8 & 255};{f & 255}')
+                currentFg = f
+            if b != currentBg:
+                sgr.append('49' if b == -1 else f'48;2;{b >> 16};{b >> 8 & 255};{b & 255}')
+                currentBg = b
+            if sgr:
+                parts.append('\033[' + ';'.join(sgr) + 'm')
+            parts.append(c)
+        parts.append('\033[0m')
+        lines.append(''.join(parts))
+    return '\n'.join(lines)
@@ -1,15 +1,21 @@
+import array
+import asyncio
+import bisect
+import concurrent.futures
 import dataclasses
 import datetime
 import enum
 import functools
-import html
 import math
 import re
+import typing
 import wcwidth
 import xdnmb.action
 
+from prompt_toolkit.application.current import get_app
 from prompt_toolkit.formatted_text import ANSI
 from prompt_toolkit.formatted_text import HTML
+from prompt_toolkit.formatted_text import StyleAndTextTuples
 from prompt_toolkit.layout.containers import Container
 from prompt_toolkit.layout.containers import HSplit
 from prompt_toolkit.layout.containers import VSplit
@@ -104,20 +110,84 @@ class ForumGroup:
             children.append(forum.__pt_container__())
         return HSplit(tuple(children))
 
-@dataclasses.dataclass(unsafe_hash=True)
+# 摘要中需要去掉的ASCII控制字符（wcwidth小于1）
+ASCII_CONTROL_TABLE = dict.fromkeys((*range(32), 127))
+
+class WidthPrefix:
+    # 按照显示宽度截断文本，宽度小于1的字符（换行等控制字符）不计入结果
+    # 记录已经处理过的字符的显示宽度的前缀和，截断时二分查找位置，只在需要更长的结果时才继续往后计算
+    # 只有ASCII字符时每个字符的宽度都是1，前缀和就是下标，不需要逐个调用wcwidth
+    __slots__ = ('text', 'pos', 'chars', 'widths')
+
+    def __init__(self, text: str) -> None:
+        if text.isascii():
+            self.text = None
+            self.chars = text.translate(ASCII_CONTROL_TABLE)
+        else:
+            self.text = text
+            self.pos = 0
+            self.chars = []
+            self.widths = array.array('I', (0,))
+
+    def truncate(self, length: int) -> str:
+        if self.text is None:
+            return self.chars if len(self.chars) <= length else self.chars[:length] + '...'
+        text = self.text
+        total = self.widths[-1]
+        # 多算一个字符，用于判断后面是否还有内容
+        while total <= length and self.pos < len(text):
+            c = text[self.pos]
+            self.pos += 1
+            w = wcwidth.wcwidth(c)
+            if w < 1:
+                continue
+            total += w
+            self.chars.append(c)
+            self.widths.append(total)
+        count = bisect.bisect_right(self.widths, length) - 1
+        result = ''.join(self.chars[:count])
+        return result if count == len(self.chars) else result + '...'
+
+# 串和回应在长时间浏览和存档时会大量存在，使用__slots__以减少内存占用
+# 各种缓存也直接放在实例中，不使用functools.cache（会让所有的实例一直无法被回收）和functools.cached_property（需要__dict__）
+# 缓存不参与比较和哈希，dataclasses.replace得到的新实例的缓存也会被清空
+cacheField = functools.partial(dataclasses.field, default=None, init=False, repr=False, compare=False)
+
+@dataclasses.dataclass(unsafe_hash=True, slots=True, kw_only=True)
 class Reply:
     tid: int
-    img: str|None
-    imgThumb: str|None
+    # 图片的路径和扩展名，完整的URL在需要时才拼接
+    imgName: str = ''
+    imgExt: str = ''
     now: datetime.datetime
     userHash: str
     name: str
     title: str
     content: str
     admin: bool
-    isPo: bool
+    isPo: bool = False
 
-    @functools.cached_property
+    containerCache: Container|None = cacheField()
+    referencesCache: tuple[int, ...]|None = cacheField()
+    contentWithoutReferencesCache: str|None = cacheField()
+    summaryCache: dict[int, str]|None = cacheField()
+    summaryPrefixCache: WidthPrefix|None = cacheField()
+    contentFragmentsCache: StyleAndTextTuples|None = cacheField()
+    imagePreviewAvailableCache: bool|None = cacheField()
+    imagePreviewLabelCache: Label|None = cacheField()
+    imagePreviewFuture: concurrent.futures.Future|None = cacheField()
+
+    @property
+    def img(self) -> str|None:
+        import xdnmb.api
+        return (xdnmb.api.CDN_PATH + 'image/' + self.imgName + self.imgExt) if self.imgName and self.imgExt else None
+
+    @property
+    def imgThumb(self) -> str|None:
+        import xdnmb.api
+        return (xdnmb.api.CDN_PATH + 'thumb/' + self.imgName + self.imgExt) if self.imgName and self.imgExt else None
+
+    @property
     def references(self) -> tuple[int, ...]:
         # https://nmbxd.com/t/57491643
         # 根据网页版，以下格式都属于引用：
@@ -131,59 +201,111 @@ class Reply:
         # ＞＞50000001
         # ＞No.50000001
         # ＞＞No.50000001
-        return tuple(int(x) for x in re.findall(r'(?:>{1,2}|>>No\.)(\d+)', self.content))
+        if self.referencesCache is None:
+            self.referencesCache = tuple(int(x) for x in re.findall(r'(?:>{1,2}|>>No\.)(\d+)', self.content))
+        return self.referencesCache
 
-    @functools.cached_property
+    @property
     def contentWithoutReferences(self) -> str:
-        return re.sub(r'(?:>{1,2}|>>No\.)(\d+)\n?', '', self.content)
+        if self.contentWithoutReferencesCache is None:
+            self.contentWithoutReferencesCache = re.sub(r'(?:>{1,2}|>>No\.)(\d+)\n?', '', self.content)
+        return self.contentWithoutReferencesCache
+
+    @property
+    def contentFragments(self) -> StyleAndTextTuples:
+        import xdnmb.util
+        if self.contentFragmentsCache is None:
+            self.contentFragmentsCache = xdnmb.util.formatContent(self.content)
+        return self.contentFragmentsCache
 
-    @functools.lru_cache(8)
     def summary(self, length: int) -> str:
-        result = ''
-        for c in self.contentWithoutReferences:
-            w = wcwidth.wcwidth(c)
-            if w < 1:
-                continue
-            length -= w
-            if length < 0:
-                result += '...'
-                break
-            result += c
+        if self.summaryCache is None:
+            self.summaryCache = {}
+        elif length in self.summaryCache:
+            return self.summaryCache[length]
+        if self.summaryPrefixCache is None:
+            self.summaryPrefixCache = WidthPrefix(self.contentWithoutReferences)
+        result = self.summaryPrefixCache.truncate(length)
+        self.summaryCache[length] = result
         return result
 
-    @functools.cached_property
+    @property
+    def isTips(self) -> bool:
+        return (
+            self.admin
+            and self.title == 'Tips'
+            and self.userHash == 'Tips'
+            and self.tid == 9999999
+        )
+
+    @property
     def imagePreviewAvailable(self) -> bool:
         import xdnmb.globals
         import xdnmb.util
-        return (
-            self.imgThumb
-            and xdnmb.globals.config['Config'].getboolean('ImagePreview')
-            and not xdnmb.globals.config['Config'].getboolean('Monochrome')
-            and xdnmb.util.detectChafa()
-        )
+        if self.imagePreviewAvailableCache is None:
+            self.imagePreviewAvailableCache = bool(
+                self.imgName
+                and self.imgExt
+                and xdnmb.globals.config['Config'].getboolean('ImagePreview')
+                and not xdnmb.globals.config['Config'].getboolean('Monochrome')
+                and xdnmb.util.imageRenderer()
+            )
+        return self.imagePreviewAvailableCache
 
-    # functools.cached_property在执行method和管理缓存时都需要锁
-    # functools.cache仅在管理缓存时需要锁，执行method不受锁的影响
-    # 为了让这个method在多线程下并行，需要用functools.cache和property的组合，而不是functools.cached_property
+    # 缩略图预览先显示和预览高度相同的占位文字，加载完成后直接替换Label的内容，不需要重新创建界面
+    @property
+    def imagePreviewLabel(self) -> Label:
+        if self.imagePreviewLabelCache is None:
+            self.imagePreviewLabelCache = Label(self.imagePreviewTips('⌛ 正在加载缩略图…'))
+        return self.imagePreviewLabelCache
+
+    @staticmethod
+    def imagePreviewTips(text: str) -> StyleAndTextTuples:
+        # 补足换行使提示文字和预览的高度一致，加载完成前后界面不会跳动
+        import xdnmb.globals
+        return [('class:tips', text + '\n' * (xdnmb.globals.config['Config'].getint('ImagePreviewHeight') - 1))]
 
-    # @functools.cached_property
     @property
-    @functools.cache
-    def imagePreviewLabel(self) -> Label|None:
+    def imagePreviewRequested(self) -> bool:
+        return self.imagePreviewFuture is not None
+
+    def requestImagePreview(self):
+        # 在线程池中加载缩略图预览，不会阻塞界面的绘制，需要在事件循环中调用
         import xdnmb.globals
         import xdnmb.util
-        l = Label(ANSI(xdnmb.util.loadChafaImage(
+        if self.imagePreviewFuture is not None:
+            return
+        self.imagePreviewFuture = xdnmb.globals.imagePreloadExecutor.submit(
+            xdnmb.util.loadImagePreview,
             self.imgThumb,
             xdnmb.globals.config['Config'].getint('ImagePreviewWidth'),
             xdnmb.globals.config['Config'].getint('ImagePreviewHeight'),
-        )))
-        setattr(self, 'imagePreviewLoaded', True)
-        return l
+        )
+        get_app().create_background_task(self.waitImagePreview())
+
+    async def waitImagePreview(self):
+        import xdnmb.globals
+        timeout = xdnmb.globals.config['Config'].getfloat('ImagePreviewTimeout')
+        future = asyncio.wrap_future(self.imagePreviewFuture)
+        try:
+            try:
+                # 超时后显示提示，但是仍然继续等待，加载完成后照样显示预览
+                result = await asyncio.wait_for(asyncio.shield(future), timeout)
+            except asyncio.TimeoutError:
+                self.imagePreviewLabel.text = self.imagePreviewTips(f'⚠️ 图片加载超时（{timeout:g} 秒），仍在继续加载')
+                get_app().invalidate()
+                result = await future
+        except Exception as ex:
+            self.imagePreviewLabel.text = self.imagePreviewTips(f'⚠️ 图片加载失败：{type(ex).__name__}: {ex}')
+        else:
+            self.imagePreviewLabel.text = ANSI(result)
+        get_app().invalidate()
 
-    @functools.cache
     def __pt_container__(self) -> Container:
         import xdnmb.globals
 
+        if self.containerCache is not None:
+            return self.containerCache
         b = Button(
             text=f'No.{self.tid}',
             left_symbol='',
@@ -192,6 +314,7 @@ class Reply:
         )
         b.window.align = WindowAlign.LEFT
         setattr(b.window, 'buttonType', ButtonType.Reply)
+        setattr(b.window, 'tid', self.tid)
         children: list[Container] = [
             VSplit((
                 Label(
@@ -224,37 +347,35 @@ class Reply:
                 Label(' '),
             )),
         ]
-        children.append(Label(HTML(re.sub(
-            r'(?:(?:&gt;){1,2}|&gt;&gt;No\.)\d+|^(?:&gt;|＞).+$',
-            lambda m: f'<reference>{m.group(0)}</reference>',
-            html.escape(self.content),
-            0, re.M,
-        ))))
+        children.append(Label(self.contentFragments))
         if self.img:
-            try:
-                if self.imagePreviewAvailable:
-                    children.append(self.imagePreviewLabel)
-            except Exception as ex:
-                children.append(Label(f'⚠️ 图片加载失败：{type(ex).__name__}: {ex}', style='class:tips'))
+            if self.imagePreviewAvailable:
+                self.requestImagePreview()
+                children.append(self.imagePreviewLabel)
             children.append(Label(f'🖼️ 附加图片：{self.img}', style='class:tips'))
-        return HSplit(tuple(children), style='class:content class:reply')
+        self.containerCache = HSplit(tuple(children), style='class:content class:reply')
+        return self.containerCache
 
-@dataclasses.dataclass(unsafe_hash=True)
+@dataclasses.dataclass(unsafe_hash=True, slots=True, kw_only=True)
 class Thread(Reply):
-    forum: Forum
-    sage: bool
+    forum: Forum|Timeline|None
+    sage: bool = False
     replyCount: int
     replies: tuple[Reply, ...]|None = None
+    headContainerCache: Container|None = cacheField()
+    replyCountLabelCache: Label|None = cacheField()
+    visibleRepliesCache: tuple[Reply, ...]|None = cacheField()
 
     @property
     def maxPage(self) -> int:
         return math.ceil(self.replyCount / 19) if self.replyCount else 1
 
-    @functools.cache
-    def __pt_container__(self) -> Container:
+    @property
+    def headContainer(self) -> Container:
         import xdnmb.globals
-        import xdnmb.util
 
+        if self.headContainerCache is not None:
+            return self.headContainerCache
         b = Button(
             text=f'No.{self.tid}',
             left_symbol='',
@@ -264,6 +385,7 @@ class Thread(Reply):
         )
         b.window.align = WindowAlign.LEFT
         setattr(b.window, 'buttonType', ButtonType.Thread)
+        setattr(b.window, 'tid', self.tid)
         children: list[Container] = [
             VSplit((
                 Label(
@@ -289,36 +411,126 @@ class Thread(Reply):
                     dont_extend_width=True,
                 ),
                 b,
-                Label(f' [{self.forum.name}]'),
+                # 从搜索结果打开的串的版面可能不在版面列表中
+                Label(f' [{self.forum.name}]' if self.forum else ''),
             )),
         ]
         if self.sage:
             children.append(Label('👎 SAGE', style='class:sage'))
-        children.append(Label(HTML(re.sub(
-            r'(?:(?:&gt;){1,2}|&gt;&gt;No\.)\d+|^(?:&gt;|＞).+$',
-            lambda m: f'<reference>{m.group(0)}</reference>',
-            html.escape(self.content),
-            0, re.M,
-        ))))
+        children.append(Label(self.contentFragments))
         if self.img:
-            try:
-                if self.imagePreviewAvailable:
-                    children.append(self.imagePreviewLabel)
-            except Exception as ex:
-                children.append(Label(f'⚠️ 图片加载失败：{type(ex).__name__}: {ex}', style='class:tips'))
+            if self.imagePreviewAvailable:
+                self.requestImagePreview()
+                children.append(self.imagePreviewLabel)
             children.append(Label(f'🖼️ 附加图片：{self.img}', style='class:tips'))
-        children.append(Label(f'➕ 回应共有 {self.replyCount} 篇', style='class:tips'))
-        children.append(Window(height=1))
-        if self.replies:
-            for reply in self.replies:
-                if (
-                    xdnmb.globals.config['Config'].getboolean('HideTips')
-                    and reply.admin
-                    and reply.title == 'Tips'
-                    and reply.userHash == 'Tips'
-                    and reply.tid == 9999999
-                ):
-                    continue
-                children.append(reply.__pt_container__())
-                children.append(Window(height=1))
-        return HSplit(tuple(children), style='class:content')
+        # 订阅的串的新回应数量由后台任务更新，每次绘制时重新获取
+        self.replyCountLabelCache = Label(self.replyCountText, style='class:tips')
+        children.append(self.replyCountLabelCache)
+        self.headContainerCache = HSplit(tuple(children), style='class:content')
+        return self.headContainerCache
+
+    def inheritContainers(self, other: 'Thread'):
+        # 刷新或者连续滚动得到的串和原来的串通常只有回应数量和回应不同，直接沿用原来的串的界面和各种缓存，
+        # 不需要重新创建和测量，光标在串上时也不会丢失；依赖回应的containerCache和visibleRepliesCache除外
+        if (
+            (self.tid, self.title, self.name, self.content, self.imgName, self.imgExt, self.sage, self.admin)
+            != (other.tid, other.title, other.name, other.content, other.imgName, other.imgExt, other.sage, other.admin)
+        ):
+            return
+        for f in dataclasses.fields(other):
+            if not f.init and f.name not in ('containerCache', 'visibleRepliesCache'):
+                setattr(self, f.name, getattr(other, f.name))
+        if self.replyCountLabelCache is not None:
+            self.replyCountLabelCache.text = self.replyCountText
+
+    def replyCountText(self) -> str:
+        import xdnmb.feedwatch
+        unread = xdnmb.feedwatch.unread(self.tid)
+        return f'➕ 回应共有 {self.replyCount} 篇' + (f'，{unread} 篇新回应' if unread else '')
+
+    @property
+    def visibleReplies(self) -> tuple[Reply, ...]:
+        import xdnmb.globals
+        if self.visibleRepliesCache is None:
+            self.visibleRepliesCache = tuple(
+                r for r in self.replies or ()
+                if not (xdnmb.globals.config['Config'].getboolean('HideTips') and r.isTips)
+            )
+        return self.visibleRepliesCache
+
+    def __pt_container__(self) -> Container:
+        # 版面中的串连同附带的几条回应作为一项显示，在串的页面中则由VirtualList分别显示串的内容和每一条回应
+        if self.containerCache is not None:
+            return self.containerCache
+        children: list[Container] = [self.headContainer]
+        for reply in self.visibleReplies:
+            children.append(Window(height=1))
+            children.append(reply.__pt_container__())
+        self.containerCache = HSplit(tuple(children), style='class:content')
+        return self.containerCache
+
+class ReferenceGraph:
+    # 当前显示的串（或版面）中的引用关系，加载页面时增量更新，查找和补全时不需要遍历所有的回应
+    # posts：串号 -> 串/回应；quotedBy：串号 -> 引用了它的串/回应（按照加载的顺序）
+    # 被引用的串不一定在页面中，所以quotedBy的键可以不在posts中
+    def __init__(self, posts: typing.Iterable[Reply] = ()) -> None:
+        self.posts: dict[int, Reply] = {}
+        self.quotedBy: dict[int, dict[int, Reply]] = {}
+        self.referenceCompletionCache: tuple[list[str], dict[str, str]]|None = None
+        self.replyCompletionCache: tuple[list[str], dict[str, str]]|None = None
+        self.add(posts)
+
+    def __len__(self) -> int:
+        return len(self.posts)
+
+    def add(self, posts: typing.Iterable[Reply]):
+        for post in posts:
+            if post.tid in self.posts:
+                continue
+            self.posts[post.tid] = post
+            for tid in dict.fromkeys(post.references):
+                self.quotedBy.setdefault(tid, {})[post.tid] = post
+            self.referenceCompletionCache = None
+            self.replyCompletionCache = None
+
+    def remove(self, posts: typing.Iterable[Reply]):
+        for post in posts:
+            if self.posts.pop(post.tid, None) is None:
+                continue
+            for tid in dict.fromkeys(post.references):
+                quotedBy = self.quotedBy.get(tid)
+                if quotedBy is not None:
+                    quotedBy.pop(post.tid, None)
+                    if not quotedBy:
+                        del self.quotedBy[tid]
+            self.referenceCompletionCache = None
+            self.replyCompletionCache = None
+
+    def quotes(self, tid: int) -> tuple[int, ...]:
+        post = self.posts.get(tid)
+        return post.references if post else ()
+
+    def repliesTo(self, tid: int) -> tuple[Reply, ...]:
+        return tuple(self.quotedBy.get(tid, {}).values())
+
+    @property
+    def referenced(self) -> typing.Iterable[int]:
+        return self.quotedBy.keys()
+
+    def referenceCompletion(self) -> tuple[list[str], dict[str, str]]:
+        # 查看引用的补全：被引用过的串号，说明中显示最后一个引用它的串/回应
+        if self.referenceCompletionCache is None:
+            self.referenceCompletionCache = (
+                [str(k) for k in sorted(self.quotedBy)],
+                {str(k): f'被“{next(reversed(v.values())).summary(24)}”引用' for k, v in self.quotedBy.items()},
+            )
+        return self.referenceCompletionCache
+
+    def replyCompletion(self) -> tuple[list[str], dict[str, str]]:
+        # 回复的补全：页面中所有的串/回应
+        if self.replyCompletionCache is None:
+            self.replyCompletionCache = (
+                [f'>>No.{k}' for k in self.posts],
+                {f'>>No.{k}': f'引用：“{v.summary(24)}”' for k, v in self.posts.items()},
+            )
+        return self.replyCompletionCache
@@ -0,0 +1,32 @@
+import sys
+import time
+
+# 记录启动过程中各个阶段的耗时，使用 --profile-startup 启动时在显示第一帧后输出并退出
+# 这个模块需要在其他模块之前导入，所以不能依赖xdnmb中的其他模块
+
+START = time.perf_counter()
+phases: list[tuple[str, float]] = []
+last = START
+reported = False
+
+def mark(phase: str):
+    global last
+    now = time.perf_counter()
+    phases.append((phase, now - last))
+    last = now
+
+def report():
+    import wcwidth
+    rows = phases + [('合计', last - START)]
+    width = max(wcwidth.wcswidth(phase) for phase, _ in rows)
+    for phase, elapsed in rows:
+        print(f'{phase}{" " * (width - wcwidth.wcswidth(phase))}  {elapsed * 1000:8.1f} ms', file=sys.stderr)
+
+def afterRender(app):
+    global reported
+    if reported:
+        return
+    reported = True
+    mark('首次渲染')
+    # 退出全屏之后再由main.py输出结果
+    app.exit()
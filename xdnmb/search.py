@@ -0,0 +1,257 @@
+from __future__ import annotations
+import concurrent.futures
+import dataclasses
+import datetime
+import re
+import sqlite3
+import sys
+import threading
+import time
+import typing
+import xdnmb.cache
+import xdnmb.model
+
+# 浏览过的串和回应的全文搜索，和接口缓存保存在同一个数据库（lru-cache.db）中，但是不参与LRU淘汰
+# post表保存串/回应的内容和所在的串、页数，post_fts是对应的FTS5索引（rowid就是串号）
+# FTS5自带的unicode61分词会把连续的汉字当成一个词，所以写入索引之前先把连续的中日韩字符拆成相邻两个字一组（二元分词），
+# 查询时对关键词做同样的处理再按短语匹配，两个字以上的关键词都可以直接使用索引并按照bm25排序
+# 索引使用contentless表，不再保存一份分词后的文本，删除时根据post表中的内容重新分词
+# 写入在单独的一个线程中排队进行，不会阻塞加载页面，也不会有多个线程同时争抢写锁
+
+# 超过上限的这个倍数时开始删除最旧的串/回应
+HIGH_WATER_RATIO = 1.125
+PRUNE_BATCH_SIZE = 1024
+# 只对最新的这么多条匹配的结果计算相关度，很常见的关键词可能匹配几万条，全部计算bm25需要近百毫秒
+RANK_CANDIDATES = 1000
+
+CJK_RUN_REGEX = re.compile(r'[぀-ヿ㐀-䶿一-鿿豈-﫿가-힯]+')
+
+UPSERT_SQL = (
+    'INSERT INTO `post`(`tid`, `fid`, `thread`, `page`, `userHash`, `time`, `title`, `content`) VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+    'ON CONFLICT(`tid`) DO UPDATE SET '
+    '`fid` = coalesce(excluded.`fid`, `fid`), '
+    '`thread` = coalesce(excluded.`thread`, `thread`), '
+    # 只看PO时不知道回应在完整的串中的页数，不覆盖已知的页数
+    '`page` = coalesce(excluded.`page`, `page`), '
+    '`title` = excluded.`title`, '
+    '`content` = excluded.`content`'
+)
+
+enabled = False
+maxPosts = 0
+# 索引中的大致数量，写入时累加，删除时重新统计
+indexedPosts: int|None = None
+indexExecutor = concurrent.futures.ThreadPoolExecutor(1)
+lock = threading.Lock()
+
+@dataclasses.dataclass
+class SearchResult:
+    tid: int
+    fid: int|None
+    # 所在的串和页数，从引用中得到的回应不知道所在的串
+    thread: int|None
+    page: int|None
+    userHash: str
+    time: datetime.datetime
+    title: str
+    content: str
+
+    @property
+    def url(self) -> str:
+        if self.thread is None:
+            return f'https://www.nmbxd.com/Home/Forum/ref?id={self.tid}'
+        return f'https://www.nmbxd.com/t/{self.thread}' + (f'?page={self.page}' if self.page and self.page > 1 else '')
+
+    def snippet(self, terms: typing.Sequence[str], length: int) -> str:
+        # 从第一个关键词之前一点的位置开始截取一行
+        content = self.content.lower()
+        positions = [p for p in (content.find(t.lower()) for t in terms) if p >= 0]
+        start = max(min(positions, default=0) - 8, 0)
+        text = ('...' if start else '') + re.sub(r'\s+', ' ', self.content[start:]).strip()
+        return xdnmb.model.WidthPrefix(text).truncate(length)
+
+def tokenize(text: str) -> str:
+    return CJK_RUN_REGEX.sub(
+        lambda m: ' ' + ' '.join(m[0][i:i + 2] for i in range(max(len(m[0]) - 1, 1))) + ' ',
+        text,
+    )
+
+def connect():
+    global enabled, maxPosts
+    import xdnmb.globals
+    config = xdnmb.globals.config['Config']
+    db = xdnmb.cache.connection()
+    if enabled or not config.getboolean('SearchIndex') or db is None:
+        return
+    try:
+        db.executescript(''.join(x.strip() for x in '''
+        CREATE TABLE IF NOT EXISTS "post" (
+            "tid" INTEGER NOT NULL PRIMARY KEY,
+            "fid" INTEGER,
+            "thread" INTEGER,
+            "page" INTEGER,
+            "userHash" TEXT NOT NULL,
+            "time" REAL NOT NULL,
+            "title" TEXT NOT NULL,
+            "content" TEXT NOT NULL
+        );
+        CREATE VIRTUAL TABLE IF NOT EXISTS "post_fts" USING fts5(
+            "text",
+            content = '',
+            tokenize = 'unicode61 remove_diacritics 2'
+        );
+        '''.splitlines()))
+    except sqlite3.OperationalError:
+        # SQLite没有编译FTS5时不使用搜索
+        return
+    enabled = True
+    maxPosts = config.getint('SearchIndexSize')
+    xdnmb.cache.closeHooks.append(close)
+
+def close():
+    # 关闭数据库之前写完已经排队的索引，之后不再接受新的写入
+    global enabled
+    with lock:
+        enabled = False
+    indexExecutor.shutdown(wait=True)
+
+def indexPosts(posts: typing.Iterable[tuple[xdnmb.model.Reply, int|None, int|None, int|None]]):
+    # posts中的每一项为(串/回应, 版面ID, 所在的串, 页数)，在后台写入索引
+    if not enabled:
+        return
+    rows = tuple(
+        (post.tid, fid, thread, page, post.userHash, post.now.timestamp(), post.title, post.content)
+        for post, fid, thread, page in posts
+        if not post.isTips
+    )
+    if rows:
+        with lock:
+            if enabled:
+                indexExecutor.submit(writeIndex, rows)
+
+def writeIndex(rows: tuple[tuple, ...]):
+    global indexedPosts
+    db = xdnmb.cache.connection()
+    if db is None:
+        return
+    try:
+        db.execute('BEGIN IMMEDIATE')
+        existing: dict[int, str] = dict(db.execute(
+            f'SELECT `tid`, `content` FROM `post` WHERE `tid` IN ({",".join("?" * len(rows))})',
+            tuple(row[0] for row in rows),
+        ))
+        db.executemany(UPSERT_SQL, rows)
+        # 内容没有变化的只更新post表，不需要重新写入索引
+        changed = [row for row in rows if existing.get(row[0]) != row[7]]
+        db.executemany(
+            "INSERT INTO `post_fts`(`post_fts`, `rowid`, `text`) VALUES ('delete', ?, ?)",
+            ((row[0], tokenize(existing[row[0]])) for row in changed if row[0] in existing),
+        )
+        db.executemany(
+            'INSERT INTO `post_fts`(`rowid`, `text`) VALUES (?, ?)',
+            ((row[0], tokenize(row[7])) for row in changed),
+        )
+        db.execute('COMMIT')
+    except sqlite3.Error:
+        if db.in_transaction:
+            db.execute('ROLLBACK')
+        return
+    with lock:
+        if indexedPosts is None:
+            indexedPosts = db.execute('SELECT COUNT(*) FROM `post`').fetchone()[0]
+        else:
+            indexedPosts += sum(1 for row in rows if row[0] not in existing)
+        overHighWater = indexedPosts > maxPosts * HIGH_WATER_RATIO
+    if overHighWater:
+        prune(db)
+
+def prune(db: sqlite3.Connection):
+    # 按串号删除最旧的串/回应，直到不超过上限
+    global indexedPosts
+    count = db.execute('SELECT COUNT(*) FROM `post`').fetchone()[0]
+    while count > maxPosts:
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            rows = db.execute(
+                'SELECT `tid`, `content` FROM `post` ORDER BY `tid` LIMIT ?',
+                (min(count - maxPosts, PRUNE_BATCH_SIZE), ),
+            ).fetchall()
+            db.executemany(
+                "INSERT INTO `post_fts`(`post_fts`, `rowid`, `text`) VALUES ('delete', ?, ?)",
+                ((tid, tokenize(content)) for tid, content in rows),
+            )
+            db.executemany('DELETE FROM `post` WHERE `tid` = ?', ((tid, ) for tid, _ in rows))
+            db.execute('COMMIT')
+        except sqlite3.Error:
+            if db.in_transaction:
+                db.execute('ROLLBACK')
+            # 下次写入超过高水位时重新统计数量再删除
+            break
+        count -= len(rows)
+    with lock:
+        indexedPosts = count
+
+def search(query: str, limit: int = 50) -> list[SearchResult]:
+    # 空格分隔的多个关键词需要同时出现
+    # 只有一个汉字的关键词无法使用二元分词的索引，改为逐条比较，结果按串号（时间）排序而不是相关度
+    db = xdnmb.cache.connection()
+    if not enabled or db is None:
+        raise Exception('搜索功能没有启用')
+    terms = query.split()
+    if not terms:
+        return []
+    phrases = []
+    likes = []
+    for term in terms:
+        if any(len(m[0]) < 2 for m in CJK_RUN_REGEX.finditer(term)) or not re.search(r'\w', term):
+            likes.append('%' + re.sub(r'([%_\\])', r'\\\1', term) + '%')
+        else:
+            # 不以汉字结尾的关键词按前缀匹配，例如输入串号的一部分
+            phrases.append('"' + tokenize(term).strip().replace('"', '""') + '"' + ('' if CJK_RUN_REGEX.search(term[-1]) else ' *'))
+    columns = '`tid`, `fid`, `thread`, `page`, `userHash`, `time`, `title`, `content`'
+    likeSql = ''.join(" AND `content` LIKE ? ESCAPE '\\'" for _ in likes)
+    if phrases:
+        # 逐条比较的关键词也要在选出候选之前过滤，否则只会在最新的RANK_CANDIDATES条索引匹配中查找
+        rows = db.execute(
+            f'SELECT {columns} FROM ('
+            f'SELECT `post`.*, `post_fts`.`rank` AS `rank` FROM `post_fts` JOIN `post` ON `post`.`tid` = `post_fts`.`rowid` '
+            f'WHERE `post_fts` MATCH ?{likeSql} ORDER BY `post_fts`.`rowid` DESC LIMIT ?'
+            f') ORDER BY `rank` LIMIT ?',
+            (' '.join(phrases), *likes, RANK_CANDIDATES, limit),
+        ).fetchall()
+    else:
+        rows = db.execute(
+            f'SELECT {columns} FROM `post` WHERE 1{likeSql} ORDER BY `tid` DESC LIMIT ?',
+            (*likes, limit),
+        ).fetchall()
+    return [
+        SearchResult(
+            tid=tid,
+            fid=fid,
+            thread=thread,
+            page=page,
+            userHash=userHash,
+            time=datetime.datetime.fromtimestamp(timestamp),
+            title=title,
+            content=content,
+        )
+        for tid, fid, thread, page, userHash, timestamp, title, content in rows
+    ]
+
+def searchFromCommandLine() -> int:
+    import xdnmb.globals
+    args = xdnmb.globals.args
+    terms = args.search.split()
+    connect()
+    try:
+        start = time.perf_counter()
+        results = search(args.search, args.searchLimit)
+        elapsed = time.perf_counter() - start
+    except Exception as ex:
+        print(f'搜索失败：{type(ex).__name__}: {ex}', file=sys.stderr)
+        return 1
+    for r in results:
+        print(f'No.{r.tid} {r.time:%Y-%m-%d %H:%M:%S} ID:{r.userHash} {r.url}')
+        print(f'    {r.snippet(terms, 72)}')
+    print(f'找到 {len(results)} 条结果（{elapsed * 1000:.1f} ms）', file=sys.stderr)
+    return 0 if results else 1
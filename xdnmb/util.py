@@ -1,82 +1,228 @@
 from __future__ import annotations
+import asyncio
+import contextlib
+import dataclasses
 import datetime
 import functools
 import gzip
+import html.entities
+import html.parser
 import os
 import re
 import secrets
 import subprocess
 import tempfile
+import threading
 import time
 import typing
-import warnings
+import wcwidth
 import xdnmb.api
+import xdnmb.cache
 import xdnmb.globals
 import xdnmb.model
 
-from bs4 import BeautifulSoup
-from bs4.element import Tag
-from bs4 import MarkupResemblesLocatorWarning
+try:
+    import resource
+except ImportError:
+    # Windows没有resource模块，不统计chafa的CPU时间
+    resource = None
 
+from prompt_toolkit.application.current import get_app
 from prompt_toolkit.completion import Completer
+from prompt_toolkit.formatted_text import StyleAndTextTuples
 from prompt_toolkit.layout import Float
 from prompt_toolkit.layout import HSplit
+from prompt_toolkit.layout import ScrollablePane
+from prompt_toolkit.layout.containers import WindowAlign
 from prompt_toolkit.widgets import Button
 from prompt_toolkit.widgets import Dialog
 from prompt_toolkit.widgets import Label
 from prompt_toolkit.widgets import TextArea
 
-warnings.filterwarnings('ignore', category=MarkupResemblesLocatorWarning)
-
-def lruCacheGet(key: str) -> bytes | None:
-    row = xdnmb.globals.LRU_CACHE_DB_CURSOR.execute(
-        'SELECT `value` FROM `cache` WHERE `key` = ?',
-        (key, ),
-    ).fetchone()
-    if row:
-        xdnmb.globals.LRU_CACHE_DB_CURSOR.execute(
-            'UPDATE `cache` SET `timestamp` = ? WHERE `key` = ?',
-            (int(time.time()), key),
-        )
-        return row[0]
-    else:
-        return None
-
-
-def lruCacheSet(key: str, value: bytes | None, rowLimit: int):
-    if xdnmb.globals.LRU_CACHE_DB_CURSOR.execute(
-            'SELECT EXISTS(SELECT 1 FROM `cache` WHERE `key` = ?)',
-        (key, ),
-    ).fetchone()[0]:
-        xdnmb.globals.LRU_CACHE_DB_CURSOR.execute(
-            'UPDATE `cache` SET `timestamp` = ?, `value` = ? WHERE `key` = ?',
-            (int(time.time()), value, key),
-        )
-    else:
-        xdnmb.globals.LRU_CACHE_DB_CURSOR.execute(
-            'INSERT INTO `cache`(`timestamp`, `key`, `value`) VALUES (?, ?, ?)',
-            (int(time.time()), key, value),
-        )
-    xdnmb.globals.LRU_CACHE_DB_CURSOR.execute(
-        'DELETE FROM `cache` WHERE `id` NOT IN (SELECT `id` FROM `cache` ORDER BY `timestamp` DESC LIMIT ?)',
-        (rowLimit, ),
-    )
+if typing.TYPE_CHECKING:
+    from bs4 import BeautifulSoup
+    from bs4.element import Tag
+
+# 把原来的BeautifulSoup(text, features='html.parser').text换成了只提取文本的HTMLParser
+# 串和回应的内容都需要经过这里，不再需要为每一条内容建立完整的文档树
+# 以下的处理都和bs4保持一致，保证得到的文本完全相同：
+# 未知的实体原样保留（但是会丢掉末尾的分号），0x80-0x9F的数字字符引用按照Windows-1252解释，非法的码位替换成U+FFFD
+# 两个标签之间只有空白的文本会被替换成一个换行或空格（pre/textarea中除外）
+# 注释、DOCTYPE和处理指令不会出现在结果中，rt/rp/style/script/template中的文本也会被忽略
+
+HTML_ENTITIES: dict[str, str] = {}
+for k, v in sorted(html.entities.html5.items()):
+    HTML_ENTITIES.setdefault(k.removesuffix(';'), v)
+
+HTML_VOID_TAGS = {
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem', 'meta', 'param', 'source', 'track', 'wbr',
+    'basefont', 'bgsound', 'command', 'frame', 'image', 'isindex', 'nextid', 'spacer',
+}
+HTML_IGNORED_TAGS = {'rt', 'rp', 'style', 'script', 'template'}
+HTML_PRESERVE_WHITESPACE_TAGS = {'pre', 'textarea'}
+
+STRIP_HTML_BR_REGEX = re.compile(r'<br ?/?>\r?\n?')
+STRIP_HTML_SPACE_REGEX = re.compile(r'^\s+|\s+$', flags=re.M)
+STRIP_HTML_ASCII_SPACE_REGEX = re.compile(r'[ \t\n\r\f]*')
+STRIP_HTML_CHARREF_REGEX = re.compile(r'^([0-9]+)(.*)')
+STRIP_HTML_HEX_CHARREF_REGEX = re.compile(r'^([0-9a-f]+)(.*)')
+
+
+class HTMLTextExtractor(html.parser.HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.result: list[str] = []
+        self.data: list[str] = []
+        self.tagStack: list[str] = []
+        # 没有结束标签的空元素，之后出现的结束标签会被忽略
+        self.closedVoidTags: list[str] = []
+
+    def flush(self, alwaysKeep: bool = False):
+        if not self.data:
+            return
+        data = ''.join(self.data)
+        self.data.clear()
+        if (
+            STRIP_HTML_ASCII_SPACE_REGEX.fullmatch(data)
+            and not any(tag in HTML_PRESERVE_WHITESPACE_TAGS for tag in self.tagStack)
+        ):
+            data = '\n' if '\n' in data else ' '
+        if alwaysKeep or not any(tag in HTML_IGNORED_TAGS for tag in self.tagStack):
+            self.result.append(data)
+
+    def handle_starttag(self, tag: str, attrs):
+        self.flush()
+        if tag in HTML_VOID_TAGS:
+            self.closedVoidTags.append(tag)
+        else:
+            self.tagStack.append(tag)
+
+    def handle_startendtag(self, tag: str, attrs):
+        self.flush()
+
+    def handle_endtag(self, tag: str):
+        if tag in self.closedVoidTags:
+            self.closedVoidTags.remove(tag)
+            return
+        self.flush()
+        if tag in self.tagStack:
+            del self.tagStack[len(self.tagStack) - 1 - self.tagStack[::-1].index(tag):]
+
+    def handle_data(self, data: str):
+        self.data.append(data)
+
+    def handle_entityref(self, name: str):
+        self.data.append(HTML_ENTITIES.get(name) or '&' + name)
+
+    def handle_charref(self, name: str):
+        if name[0] in 'xX':
+            name = name[1:]
+            base = 16
+            regex = STRIP_HTML_HEX_CHARREF_REGEX
+        else:
+            base = 10
+            regex = STRIP_HTML_CHARREF_REGEX
+        extra = ''
+        try:
+            code = int(name, base)
+        except ValueError:
+            # 没有分号结尾的数字字符引用，数字后面的部分作为普通的文本
+            match = regex.search(name)
+            if match is None:
+                self.data.append(name)
+                return
+            code = int(match.group(1), base)
+            extra = match.group(2)
+        if code == 0 or code > 0x10FFFF or 0xD800 <= code <= 0xDFFF:
+            char = '\uFFFD'
+        elif 0x80 <= code <= 0x9F:
+            try:
+                char = bytes((code, )).decode('cp1252')
+            except UnicodeDecodeError:
+                char = chr(code)
+        else:
+            char = chr(code)
+        self.data.append(char)
+        if extra:
+            self.data.append(extra)
+
+    def unknown_decl(self, data: str):
+        self.flush()
+        if data.upper().startswith('CDATA['):
+            self.data.append(data[6:])
+            self.flush(True)
+
+    def handle_comment(self, data: str):
+        self.flush()
+
+    def handle_decl(self, decl: str):
+        self.flush()
+
+    def handle_pi(self, data: str):
+        self.flush()
+
+    def close(self):
+        super().close()
+        self.flush()
 
 
 def stripHTML(text: str | BeautifulSoup | Tag) -> str:
-    if isinstance(text, (BeautifulSoup, Tag)):
-        return re.sub(r'^\s+|\s+$',
-                      '\n',
-                      text.text.replace('\r', ''),
-                      flags=re.M)
-    text = re.sub(r'<br ?/?>\r?\n?', '\n', text)
-    text = re.sub(r'^\s+|\s+$', '\n', text, flags=re.M)
-    return BeautifulSoup(text, features='html.parser').text
+    if not isinstance(text, str):
+        # 发串失败时从返回的网页中找到的错误信息节点
+        return STRIP_HTML_SPACE_REGEX.sub('\n', text.text.replace('\r', ''))
+    text = STRIP_HTML_BR_REGEX.sub('\n', text)
+    text = STRIP_HTML_SPACE_REGEX.sub('\n', text)
+    # 大部分回应都是没有标签和实体的纯文本，不需要经过解析器
+    if '<' not in text and '&' not in text and not STRIP_HTML_ASCII_SPACE_REGEX.fullmatch(text):
+        return text
+    parser = HTMLTextExtractor()
+    parser.feed(text)
+    parser.close()
+    return ''.join(parser.result)
+
+
+# 正文中高亮显示的部分：引用（>50000001、>>50000001、>>No.50000001）以及以>或＞开头的整行（4chan的绿字），和网页版一致
+# 直接从正文得到prompt_toolkit的StyleAndTextTuples，不需要先转义成HTML、加上<reference>标签再让HTML()用XML解析器解析一遍
+# 在decodePost时调用，也就是在线程池中完成，创建界面时直接使用结果
+# 等价于(?:>{1,2}|>>No\.)\d+|^(?:>|＞).+$，改写成所有分支都以>或＞开头的形式之后re可以直接跳到这两个字符，而不是在每个位置都尝试匹配
+CONTENT_REFERENCE_REGEX = re.compile(r'[>＞](?:(?<=>)>?\d+|(?<=>)>No\.\d+|(?<=^.).+)', re.M)
+
+
+def formatContent(content: str) -> StyleAndTextTuples:
+    result: StyleAndTextTuples = []
+    pos = 0
+    for m in CONTENT_REFERENCE_REGEX.finditer(content):
+        start, end = m.span()
+        if start > pos:
+            result.append(('', content[pos:start]))
+        result.append(('class:reference', content[start:end]))
+        pos = end
+    if pos < len(content):
+        result.append(('', content[pos:]))
+    return result
+
+
+THREAD_TIME_WEEKDAY_REGEX = re.compile(r'\([日一二三四五六]\)')
 
 
+# 同一个串的回应时间经常重复（例如同一秒内的多条回应、每一页都会出现的串本身）
+@functools.lru_cache(1024)
 def parseThreadTime(text: str) -> datetime.datetime:
+    # 接口返回的时间格式是固定的“2022-01-01(六)12:34:56”，检查格式后去掉星期交给fromisoformat，比strptime快得多
+    # 格式不符合时仍然使用原来的方式解析
+    if (
+        len(text) == 21
+        and text[4] == text[7] == '-'
+        and text[10] == '('
+        and text[11] in '日一二三四五六'
+        and text[12] == ')'
+        and text[15] == text[18] == ':'
+    ):
+        digits = text[0:4] + text[5:7] + text[8:10] + text[13:15] + text[16:18] + text[19:21]
+        if digits.isascii() and digits.isdigit():
+            return datetime.datetime.fromisoformat(text[0:10] + ' ' + text[13:21])
     return datetime.datetime.strptime(
-        re.sub(r'\([日一二三四五六]\)', ' ', text),
+        THREAD_TIME_WEEKDAY_REGEX.sub(' ', text),
         '%Y-%m-%d %H:%M:%S',
     )
 
@@ -106,6 +252,40 @@ def floatAlertExceptionCatch(func: typing.Callable):
     return wrapper
 
 
+def cancelLoading():
+    if xdnmb.globals.loadingTask:
+        xdnmb.globals.loadingTask.cancel()
+        xdnmb.globals.loadingTask = None
+        xdnmb.globals.bumpUiVersion()
+
+
+def runInBackground(func: typing.Callable[[], typing.Any], callback: typing.Callable[[typing.Any], None]):
+    # 在线程池中执行func，完成后在事件循环中调用callback(result)，期间标题栏显示加载动画
+    # 新的加载会取消尚未完成的旧加载，旧的请求仍然会在线程池中执行完毕，但是结果会被丢弃
+    cancelLoading()
+
+    async def task():
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(None, func)
+        try:
+            while not (await asyncio.wait((future, ), timeout=.1))[0]:
+                xdnmb.globals.loadingFrame += 1
+                xdnmb.globals.bumpUiVersion()
+                get_app().invalidate()
+            try:
+                callback(future.result())
+            except Exception as ex:
+                floatAlert('错误', f'{type(ex).__name__}: {ex}')
+        finally:
+            if xdnmb.globals.loadingTask is asyncio.current_task():
+                xdnmb.globals.loadingTask = None
+            xdnmb.globals.bumpUiVersion()
+            get_app().invalidate()
+
+    xdnmb.globals.loadingTask = get_app().create_background_task(task())
+    xdnmb.globals.bumpUiVersion()
+
+
 def floatPrompt(title: str,
                 body: str,
                 callback: typing.Callable[[str], None],
@@ -140,6 +320,31 @@ def floatPrompt(title: str,
     xdnmb.globals.layout.focus(t.window)
 
 
+def floatSelect(title: str, options: typing.Sequence[tuple[str, typing.Callable[[], None]]]):
+    # 每一项显示为一个按钮，选中后关闭弹窗再执行对应的函数，项目较多时可以滚动
+    buttons: list[Button] = []
+    for text, handler in options:
+        b = Button(text, left_symbol='', right_symbol='', width=wcwidth.wcswidth(text))
+        b.window.align = WindowAlign.LEFT
+        buttons.append(b)
+    b = Button('取消')
+    d = Float(
+        Dialog(
+            title=title,
+            body=ScrollablePane(HSplit(buttons), height=min(len(buttons), 16)),
+            buttons=(b, ),
+        ))
+    for button, (text, handler) in zip(buttons, options):
+        button.handler = functools.partial(
+            lambda e, handler: (xdnmb.globals.container.floats.remove(e) or xdnmb.globals.
+                                layout.focus(xdnmb.globals.container) or handler()), d, handler)
+    b.handler = functools.partial(
+        lambda e: (xdnmb.globals.container.floats.remove(e) or xdnmb.globals.
+                   layout.focus(xdnmb.globals.container)), d)
+    xdnmb.globals.container.floats.append(d)
+    xdnmb.globals.layout.focus(buttons[0].window if buttons else b.window)
+
+
 def focusToButton(focusFrom: xdnmb.model.ButtonType | None,
                   focusTo: xdnmb.model.ButtonType) -> bool:
     focused = xdnmb.globals.layout.current_window
@@ -170,6 +375,8 @@ def detectChafa() -> tuple[int, int, int] | None:
             stderr=subprocess.PIPE,
         )
         p.wait()
+        # chafa --version使用的CPU时间不计入渲染的统计
+        resetChildrenCpuTime()
         if p.returncode:
             return None
         else:
@@ -181,13 +388,133 @@ def detectChafa() -> tuple[int, int, int] | None:
         return False
 
 
-@functools.lru_cache(256)
-def loadChafaImage(url: str, width: int, height: int) -> str:
-    cacheKey = ':'.join((url, str(width), str(height)))
-    cached = lruCacheGet(cacheKey)
-    if cached:
-        return gzip.decompress(cached).decode('utf-8')
+# 缩略图预览可以使用chafa或者内置的渲染器（xdnmb.halfblock）生成，由ImageRenderer选择
+# 同时进行的渲染数量有上限（ChafaConcurrency），避免一次预加载大量缩略图时占满CPU
+# 下载的缩略图原始数据单独缓存（thumb命名空间），修改缩略图的大小或者同一张图片出现在多个串中时不需要重新下载
+# 每次渲染的排队、下载、渲染耗时和CPU时间都会记录下来，可以在缓存统计中查看，用于调整ChafaWork和ChafaOptimize
+
+
+@functools.cache
+def imageRenderer() -> str | None:
+    # ImageRenderer为auto时优先使用chafa，没有安装chafa时使用内置的渲染器，都不可用时返回None
+    renderer = xdnmb.globals.config['Config'].get('ImageRenderer').lower()
+    if renderer in ('chafa', 'auto') and detectChafa():
+        return 'chafa'
+    if renderer in ('builtin', 'auto'):
+        # 第一次调用是在界面线程中创建带图片的串时，只有确实要使用内置的渲染器时才导入NumPy和Pillow
+        # 函数中的import xdnmb.halfblock会让xdnmb成为局部变量，所以使用别名
+        import xdnmb.halfblock as halfblock
+        if halfblock.available():
+            return 'builtin'
+    return None
+
+
+@dataclasses.dataclass
+class RenderStats:
+    renders: int = 0
+    failures: int = 0
+    downloads: int = 0
+    downloadBytes: int = 0
+    downloadTime: float = 0
+    queueTime: float = 0
+    renderTime: float = 0
+    maxRenderTime: float = 0
+    outputBytes: int = 0
+    # 使用chafa时只有提供resource模块的系统才能统计子进程的CPU时间
+    cpuTime: float = 0
+    cpuTimeRenders: int = 0
+
+
+renderStats = RenderStats()
+renderStatsLock = threading.Lock()
+# 每个键（缩略图的地址、预览的大小）使用单独的锁，同一张图片同时被多个线程加载时只下载和渲染一次，其他线程等待后直接使用缓存
+# 不同的图片之间不会互相等待，没有线程使用的锁会被删除
+# 键 -> [锁, 使用这个锁的线程数量]
+keyLocks: dict[str, list] = {}
+keyLocksLock = threading.Lock()
+
 
+@contextlib.contextmanager
+def keyLock(key: str):
+    with keyLocksLock:
+        entry = keyLocks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with keyLocksLock:
+            entry[1] -= 1
+            if not entry[1]:
+                del keyLocks[key]
+
+
+def childrenCpuTime() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+# 上次统计时所有已经结束的子进程使用的CPU时间，由renderStatsLock保护
+lastChildrenCpuTime = 0
+
+
+def resetChildrenCpuTime():
+    global lastChildrenCpuTime
+    if resource is None:
+        return
+    with renderStatsLock:
+        lastChildrenCpuTime = childrenCpuTime()
+
+
+resetChildrenCpuTime()
+
+
+@functools.cache
+def renderSemaphore() -> threading.BoundedSemaphore:
+    return threading.BoundedSemaphore(max(1, xdnmb.globals.config['Config'].getint('ChafaConcurrency')))
+
+
+def loadThumbnail(url: str) -> bytes:
+    cacheKey = 'thumb:' + url
+    with keyLock(cacheKey):
+        cached = xdnmb.cache.lruCacheGet('thumb', cacheKey)
+        if cached:
+            return cached
+        start = time.perf_counter()
+        r = xdnmb.api.session.get(url, timeout=3)
+        r.raise_for_status()
+        with renderStatsLock:
+            renderStats.downloads += 1
+            renderStats.downloadBytes += len(r.content)
+            renderStats.downloadTime += time.perf_counter() - start
+        xdnmb.cache.lruCacheSet('thumb', cacheKey, r.content)
+        return r.content
+
+
+def runChafa(cmd: tuple[str, ...], data: bytes | None) -> tuple[bytes, float | None]:
+    # 返回chafa的输出和进程使用的CPU时间
+    # 子进程由Popen自己等待结束，CPU时间是所有已经结束的子进程的CPU时间和上次统计时的差
+    # 同时运行多个chafa时，每次得到的时间可能包含了其他进程的一部分，但是总和（也就是平均值）是准确的
+    global lastChildrenCpuTime
+    with subprocess.Popen(
+        cmd,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        creationflags=subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0,
+    ) as p:
+        result, _ = p.communicate(data)
+    if p.returncode:
+        raise subprocess.CalledProcessError(p.returncode, cmd)
+    if resource is None:
+        return result, None
+    with renderStatsLock:
+        current = childrenCpuTime()
+        cpuTime = current - lastChildrenCpuTime
+        lastChildrenCpuTime = current
+    return result, cpuTime
+
+
+def renderChafaImage(data: bytes, width: int, height: int) -> tuple[str, float | None]:
     # Reading image data from stdin raises "Failed to open '-': Unknown file format" error on Windows build · Issue #100 · hpjansson/chafa
     # https://github.com/hpjansson/chafa/issues/100
     # Fixed in Chafa 1.12.4
@@ -199,35 +526,88 @@ def loadChafaImage(url: str, width: int, height: int) -> str:
         '--duration',
         str(0),
         '--optimize',
-        str(9),
+        str(xdnmb.globals.config['Config'].getint('ChafaOptimize')),
         '--size',
         f'{width}x{height}',
         '--work',
-        str(9),
+        str(xdnmb.globals.config['Config'].getint('ChafaWork')),
         '--polite',
         'on',
         temp if useTemp else '-',
     )
-    with xdnmb.api.session.get(url, stream=True, timeout=3) as r:
-        if useTemp:
-            with open(temp, 'wb') as f:
-                for chunk in r.iter_content(8192):
-                    f.write(chunk)
-        with subprocess.Popen(
-            cmd,
-            stdin=subprocess.DEVNULL if useTemp else subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            creationflags=subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0,
-        ) as p:
-            if not useTemp:
-                for chunk in r.iter_content(8192):
-                    p.stdin.write(chunk)
-                p.stdin.close()
-            result = p.stdout.read()
+    if useTemp:
+        with open(temp, 'wb') as f:
+            f.write(data)
+    try:
+        result, cpuTime = runChafa(cmd, None if useTemp else data)
+    finally:
         if useTemp:
             os.remove(temp)
-    if p.returncode:
-        raise subprocess.CalledProcessError(p.returncode, cmd)
-    result = re.split(r'\033\[\d*A', result.decode('utf-8'), 1)[0].replace('\r', '').strip()
-    lruCacheSet(cacheKey, gzip.compress(result.encode('utf-8'), 9), 16384)
+    return re.split(r'\033\[\d*A', result.decode('utf-8'), 1)[0].replace('\r', '').strip(), cpuTime
+
+
+def renderBuiltinImage(data: bytes, width: int, height: int) -> tuple[str, float]:
+    import xdnmb.halfblock
+    start = time.thread_time()
+    result = xdnmb.halfblock.renderHalfBlock(data, width, height)
+    return result, time.thread_time() - start
+
+
+def renderImagePreview(renderer: str, data: bytes, width: int, height: int) -> str:
+    queued = time.perf_counter()
+    try:
+        with renderSemaphore():
+            start = time.perf_counter()
+            result, cpuTime = (renderChafaImage if renderer == 'chafa' else renderBuiltinImage)(data, width, height)
+            elapsed = time.perf_counter() - start
+    except Exception:
+        with renderStatsLock:
+            renderStats.failures += 1
+        raise
+    with renderStatsLock:
+        renderStats.renders += 1
+        renderStats.queueTime += start - queued
+        renderStats.renderTime += elapsed
+        renderStats.maxRenderTime = max(renderStats.maxRenderTime, elapsed)
+        renderStats.outputBytes += len(result.encode('utf-8'))
+        if cpuTime is not None:
+            renderStats.cpuTime += cpuTime
+            renderStats.cpuTimeRenders += 1
     return result
+
+
+@functools.lru_cache(256)
+def loadImagePreview(url: str, width: int, height: int) -> str:
+    renderer = imageRenderer()
+    # 使用chafa时的键和以前的版本保持一致，可以继续使用已有的缓存
+    cacheKey = ':'.join((url, str(width), str(height), *(() if renderer == 'chafa' else (renderer, ))))
+    with keyLock(cacheKey):
+        cached = xdnmb.cache.lruCacheGet('chafa', cacheKey)
+        if cached:
+            return gzip.decompress(cached).decode('utf-8')
+        result = renderImagePreview(renderer, loadThumbnail(url), width, height)
+        xdnmb.cache.lruCacheSet('chafa', cacheKey, gzip.compress(result.encode('utf-8'), 9))
+        return result
+
+
+def formatRenderStats() -> str:
+    with renderStatsLock:
+        s = dataclasses.replace(renderStats)
+    config = xdnmb.globals.config['Config']
+    renderer = imageRenderer()
+    lines = [
+        '缩略图渲染（' + (
+            f'chafa，并发 {config.getint("ChafaConcurrency")}，--work {config.getint("ChafaWork")}，--optimize {config.getint("ChafaOptimize")}'
+            if renderer == 'chafa' else
+            f'内置，并发 {config.getint("ChafaConcurrency")}'
+            if renderer == 'builtin' else
+            '不可用'
+        ) + '）',
+        f'  下载 {s.downloads} 张，共 {xdnmb.cache.formatBytes(s.downloadBytes)}' + (f'，平均耗时 {s.downloadTime / s.downloads * 1000:.1f} ms' if s.downloads else ''),
+        f'  渲染 {s.renders} 张，失败 {s.failures} 张' + (f'，平均输出 {xdnmb.cache.formatBytes(s.outputBytes / s.renders)}' if s.renders else ''),
+    ]
+    if s.renders:
+        lines.append(f'  平均排队 {s.queueTime / s.renders * 1000:.1f} ms，平均渲染 {s.renderTime / s.renders * 1000:.1f} ms，最长渲染 {s.maxRenderTime * 1000:.1f} ms')
+    if s.cpuTimeRenders:
+        lines.append(f'  平均CPU时间 {s.cpuTime / s.cpuTimeRenders * 1000:.1f} ms')
+    return '\n'.join(lines)
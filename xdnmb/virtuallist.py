@@ -0,0 +1,296 @@
+import bisect
+import typing
+
+from prompt_toolkit.application.current import get_app
+from prompt_toolkit.data_structures import Point
+from prompt_toolkit.layout import ScrollablePane
+from prompt_toolkit.layout.containers import AnyContainer
+from prompt_toolkit.layout.containers import Container
+from prompt_toolkit.layout.containers import Window
+from prompt_toolkit.layout.containers import to_container
+from prompt_toolkit.layout.dimension import AnyDimension
+from prompt_toolkit.layout.dimension import Dimension
+from prompt_toolkit.layout.dimension import sum_layout_dimensions
+from prompt_toolkit.layout.dimension import to_dimension
+from prompt_toolkit.layout.layout import walk
+from prompt_toolkit.layout.mouse_handlers import MouseHandlers
+from prompt_toolkit.layout.screen import Char
+from prompt_toolkit.layout.screen import Screen
+from prompt_toolkit.layout.screen import WritePosition
+from prompt_toolkit.mouse_events import MouseEvent
+
+# 只渲染可见部分的列表，用于代替“ScrollablePane套一个包含所有串/回应的HSplit”
+# ScrollablePane每一帧都会测量和渲染全部内容再截取可见的部分，串和回应越多越慢，超过一万行的部分还会被截断
+# 这里按照每一项的高度计算出它们在虚拟画布上的位置，每一帧只渲染和可见区域相交的项以及前后各overscan项
+# 被选中的项即使不在可见区域内也会渲染，ScrollablePane根据它的位置滚动；前后多渲染的几项用于上下键切换焦点
+# 每一项的高度只在第一次出现或者宽度变化时测量，之后只有渲染过的项会重新测量（例如缩略图加载完成后高度会变化）
+# 这个模块不依赖xdnmb中的其他模块
+
+def focusableWindows(container: Container) -> list[Window]:
+    return [c for c in walk(container, skip_hidden=True) if isinstance(c, Window) and c.content.is_focusable()]
+
+class VirtualList(ScrollablePane):
+    def __init__(
+        self,
+        getChildren: typing.Callable[[], typing.Sequence[AnyContainer]],
+        padding: int = 0,
+        overscan: int = 2,
+        width: AnyDimension = None,
+        style: str = '',
+    ) -> None:
+        super().__init__(Window(), max_available_height=2 ** 31, width=width)
+        self.getChildren = getChildren
+        self.padding = padding
+        self.overscan = overscan
+        self.style = style
+        self.virtualWidth = 0
+        self.items: typing.Sequence[AnyContainer] = ()
+        self.children: list[Container] = []
+        self.indexes: dict[Container, int] = {}
+        self.heights: list[int] = []
+        self.offsets: list[int] = [0]
+        self.measured: dict[Container, tuple[int, int]] = {}
+        # 上一帧渲染过的项，layout.walk()只会遍历这些项
+        self.materialized: list[Container] = []
+
+    def __repr__(self) -> str:
+        return f'VirtualList({self.getChildren!r})'
+
+    def reset(self) -> None:
+        for c in self.materialized:
+            c.reset()
+
+    def get_children(self) -> list[Container]:
+        return self.materialized
+
+    def is_modal(self) -> bool:
+        return False
+
+    def get_key_bindings(self) -> None:
+        return None
+
+    def preferred_width(self, max_available_width: int) -> Dimension:
+        # 和ScrollablePane一样，width是内容的宽度，不包括滚动条
+        width = Dimension() if self.width is None else to_dimension(self.width)
+        if self.show_scrollbar():
+            return sum_layout_dimensions([Dimension.exact(1), width])
+        return width
+
+    def preferred_height(self, width: int, max_available_height: int) -> Dimension:
+        if self.height is not None:
+            return to_dimension(self.height)
+        self.update(width - (1 if self.show_scrollbar() else 0))
+        return Dimension(min=0, preferred=self.offsets[-1])
+
+    def measure(self, container: Container, width: int) -> int:
+        return container.preferred_height(width, self.max_available_height).preferred
+
+    def itemHeight(self, child: AnyContainer) -> int:
+        child = to_container(child)
+        m = self.measured.get(child)
+        if m is None or m[0] != self.virtualWidth:
+            m = (self.virtualWidth, self.measure(child, self.virtualWidth))
+            self.measured[child] = m
+        return m[1]
+
+    def itemOffset(self, child: AnyContainer) -> int|None:
+        i = self.indexes.get(to_container(child))
+        return None if i is None else self.offsets[i]
+
+    def update(self, width: int):
+        # 渲染一帧的过程中会多次调用，子项没有变化时跳过，不能用==比较，串和回应的__eq__会比较每一个字段
+        items = self.getChildren()
+        if width == self.virtualWidth and items is self.items:
+            return
+        if (
+            width == self.virtualWidth
+            and len(items) == len(self.items)
+            and all(a is b for a, b in zip(items, self.items))
+        ):
+            return
+        self.items = items
+        children = [to_container(c) for c in items]
+        self.virtualWidth = width
+        self.children = children
+        self.indexes = {c: i for i, c in enumerate(children)}
+        self.heights = [self.itemHeight(c) for c in children]
+        # 只保留仍然在列表中的项的测量结果
+        self.measured = {c: self.measured[c] for c in children}
+        self.updateOffsets()
+
+    def updateOffsets(self):
+        offsets = [0]
+        for h in self.heights:
+            offsets.append(offsets[-1] + h + self.padding)
+        if self.heights:
+            offsets[-1] -= self.padding
+        self.offsets = offsets
+
+    def remeasure(self, first: int, last: int) -> bool:
+        # 重新测量指定范围内的项，高度有变化的项在可见区域之上时同时调整滚动位置，使可见的内容保持不动
+        changed = False
+        for i in range(first, last):
+            c = self.children[i]
+            h = self.measure(c, self.virtualWidth)
+            if h != self.heights[i]:
+                if self.offsets[i] + self.heights[i] <= self.vertical_scroll:
+                    self.vertical_scroll += h - self.heights[i]
+                self.heights[i] = h
+                self.measured[c] = (self.virtualWidth, h)
+                changed = True
+        if changed:
+            self.updateOffsets()
+        return changed
+
+    def visibleRange(self, height: int) -> tuple[int, int]:
+        first = max(bisect.bisect_right(self.offsets, self.vertical_scroll) - 1 - self.overscan, 0)
+        last = min(bisect.bisect_left(self.offsets, self.vertical_scroll + height) + self.overscan, len(self.children))
+        return first, last
+
+    def scrollToOffset(self, offset: int):
+        # 超出范围的滚动位置会在渲染时修正
+        self.vertical_scroll = max(offset, 0)
+
+    def scrollToItem(self, child: AnyContainer):
+        offset = self.itemOffset(child)
+        if offset is not None:
+            self.scrollToOffset(offset)
+
+    def focus(self, target: AnyContainer, child: AnyContainer|None = None):
+        # 还没有渲染过的项不在layout中，需要先加入再设置焦点，下一帧会滚动到这一项
+        # target可以是某一项中的控件，已知所在的项时通过child传入，否则需要在所有项中查找
+        target = to_container(target)
+        self.update(self.virtualWidth)
+        i = self.indexes.get(to_container(child or target))
+        if i is None:
+            i = next((i for i, c in enumerate(self.children) if target in walk(c)), None)
+        if i is not None and self.children[i] not in self.materialized:
+            self.materialized.append(self.children[i])
+        get_app().layout.focus(target)
+
+    def focusedIndex(self) -> int|None:
+        focusedWindow = get_app().layout.current_window
+        for c in self.materialized:
+            if focusedWindow in walk(c):
+                return self.indexes.get(c)
+        return None
+
+    def focusNext(self, step: int = 1) -> bool:
+        # 代替focus_next/focus_previous在列表内移动焦点
+        # 连续按键时两次渲染之间可能会移动多次，只在已经渲染的项中查找的话会跳出列表
+        i = self.focusedIndex()
+        if i is None:
+            return False
+        focusedWindow = get_app().layout.current_window
+        windows = focusableWindows(self.children[i])
+        j = windows.index(focusedWindow) + step if focusedWindow in windows else -1
+        if 0 <= j < len(windows):
+            self.focus(windows[j], self.children[i])
+            return True
+        i += step
+        while 0 <= i < len(self.children):
+            windows = focusableWindows(self.children[i])
+            if windows:
+                self.focus(windows[0 if step > 0 else -1], self.children[i])
+                return True
+            i += step
+        return False
+
+    def write_to_screen(
+        self,
+        screen: Screen,
+        mouse_handlers: MouseHandlers,
+        write_position: WritePosition,
+        parent_style: str,
+        erase_bg: bool,
+        z_index: int|None,
+    ) -> None:
+        parent_style = f'{parent_style} {self.style}'
+        showScrollbar = self.show_scrollbar()
+        virtualWidth = write_position.width - (1 if showScrollbar else 0)
+        self.update(virtualWidth)
+        height = write_position.height
+        self.remeasure(*self.visibleRange(height))
+        virtualHeight = max(self.offsets[-1], height)
+
+        tempScreen = Screen(default_char=Char(char=' ', style=parent_style))
+        tempScreen.show_cursor = screen.show_cursor
+        tempMouseHandlers = MouseHandlers()
+        rendered: set[int] = set()
+
+        def render(i: int):
+            rendered.add(i)
+            self.children[i].write_to_screen(
+                tempScreen,
+                tempMouseHandlers,
+                WritePosition(xpos=0, ypos=self.offsets[i], width=virtualWidth, height=self.heights[i]),
+                parent_style,
+                erase_bg,
+                z_index,
+            )
+
+        # 先渲染被选中的项，根据它的位置调整滚动位置之后再渲染可见的项
+        focusedWindow = get_app().layout.current_window
+        focused = self.focusedIndex()
+        if focused is not None:
+            render(focused)
+            p = tempScreen.visible_windows_to_write_positions.get(focusedWindow)
+            if p:
+                self._make_window_visible(height, virtualHeight, p, tempScreen.cursor_positions.get(focusedWindow))
+        self.vertical_scroll = max(min(self.vertical_scroll, virtualHeight - height), 0)
+
+        first, last = self.visibleRange(height)
+        for i in range(first, last):
+            if i not in rendered:
+                render(i)
+        tempScreen.draw_all_floats()
+        self.materialized = [self.children[i] for i in sorted(rendered)]
+
+        self._copy_over_screen(screen, tempScreen, write_position, virtualWidth)
+        self._copy_over_mouse_handlers(mouse_handlers, tempMouseHandlers, write_position, virtualWidth)
+        xpos = write_position.xpos
+        ypos = write_position.ypos
+        screen.width = max(screen.width, xpos + virtualWidth)
+        screen.height = max(screen.height, ypos + height)
+        self._copy_over_write_positions(screen, tempScreen, write_position)
+        if tempScreen.show_cursor:
+            screen.show_cursor = True
+        for window, point in tempScreen.cursor_positions.items():
+            if 0 <= point.x < write_position.width and self.vertical_scroll <= point.y < height + self.vertical_scroll:
+                screen.cursor_positions[window] = Point(x=point.x + xpos, y=point.y + ypos - self.vertical_scroll)
+        for window, point in tempScreen.menu_positions.items():
+            screen.menu_positions[window] = self._clip_point_to_visible_area(
+                Point(x=point.x + xpos, y=point.y + ypos - self.vertical_scroll),
+                write_position,
+            )
+        if showScrollbar:
+            self._draw_scrollbar(write_position, virtualHeight, screen)
+
+    def _copy_over_mouse_handlers(self, mouse_handlers: MouseHandlers, temp_mouse_handlers: MouseHandlers, write_position: WritePosition, virtual_width: int) -> None:
+        # ScrollablePane的实现在判断某一行是否有鼠标事件时漏掉了滚动的偏移，
+        # 渲染全部内容时不影响结果，只渲染可见部分时会导致滚动后无法点击
+        xpos = write_position.xpos
+        ypos = write_position.ypos
+        wrappers = {}
+
+        def wrap(handler):
+            if handler not in wrappers:
+                def wrapped(event: MouseEvent):
+                    return handler(MouseEvent(
+                        position=Point(x=event.position.x - xpos, y=event.position.y + self.vertical_scroll - ypos),
+                        event_type=event.event_type,
+                        button=event.button,
+                        modifiers=event.modifiers,
+                    ))
+                wrappers[handler] = wrapped
+            return wrappers[handler]
+
+        src = temp_mouse_handlers.mouse_handlers
+        dst = mouse_handlers.mouse_handlers
+        for y in range(write_position.height):
+            if y + self.vertical_scroll in src:
+                srcRow = src[y + self.vertical_scroll]
+                dstRow = dst[y + ypos]
+                for x in range(virtual_width):
+                    if x in srcRow:
+                        dstRow[x + xpos] = wrap(srcRow[x])